@@ -16,7 +16,7 @@
 
 """This file defines the decoder"""
 
-__all__ = ['attention_decoder']
+__all__ = ['attention_decoder', 'dynamic_attention_decoder', 'encoder_attention_features']
 
 import tensorflow as tf
 from tensorflow import logging as log
@@ -29,7 +29,8 @@ from tensorflow.python.ops import math_ops
 # Note: this function is based on tf.contrib.legacy_seq2seq_attention_decoder, which is now outdated.
 # In the future, it would make more sense to write variants on the attention mechanism using the new seq2seq library for tensorflow 1.0: https://www.tensorflow.org/api_guides/python/contrib.seq2seq#Attention
 def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding_mask, cell,
-                      initial_state_attention=False, pointer_gen=True, use_coverage=False, prev_coverage=None):
+                      initial_state_attention=False, pointer_gen=True, use_coverage=False, prev_coverage=None,
+                      encoder_features=None):
     """
     Args:
       decoder_inputs: A list of 2D Tensors [batch_size x input_size].
@@ -43,6 +44,8 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
       use_coverage: boolean. If True, use coverage mechanism.
       prev_coverage:
         If not None, a tensor with shape (batch_size, attn_length). The previous step's coverage vector. This is only not None in decode mode when using coverage.
+      encoder_features:
+        If not None, a tensor with shape (batch_size, attn_length, 1, attn_size). The encoder features (W_h h_i) precomputed by encoder_attention_features, so that they are not recomputed on every decoder step. This is only not None in decode mode.
 
     Returns:
       outputs: A list of the same length as decoder_inputs of 2D Tensors of
@@ -53,96 +56,14 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
       p_gens: List of scalars. The values of p_gen for each decoder step. Empty list if pointer_gen=False.
       coverage: Coverage vector on the last step computed. None if use_coverage=False.
     """
-    with variable_scope.variable_scope("attention_decoder") as scope:
-        batch_size = encoder_states.get_shape()[
-            0].value  # if this line fails, it's because the batch size isn't defined
-        attn_size = encoder_states.get_shape()[
-            2].value  # if this line fails, it's because the attention length isn't defined
-
-        # Reshape encoder_states (need to insert a dim)
-        encoder_states = tf.expand_dims(encoder_states, axis=2)  # now is shape (batch_size, attn_len, 1, attn_size)
-
-        # To calculate attention, we calculate
-        #   v^T tanh(W_h h_i + W_s s_t + b_attn)
-        # where h_i is an encoder state, and s_t a decoder state.
-        # attn_vec_size is the length of the vectors v, b_attn, (W_h h_i) and (W_s s_t).
-        # We set it to be equal to the size of the encoder states.
-        attention_vec_size = attn_size
-
-        # Get the weight matrix W_h and apply it to each encoder state to get (W_h h_i), the encoder features
-        W_h = variable_scope.get_variable("W_h", [1, 1, attn_size, attention_vec_size])
-        encoder_features = nn_ops.conv2d(encoder_states, W_h, [1, 1, 1, 1],
-                                         "SAME")  # shape (batch_size,attn_length,1,attention_vec_size)
-
-        # Get the weight vectors v and w_c (w_c is for coverage)
-        v = variable_scope.get_variable("v", [attention_vec_size])
-        if use_coverage:
-            with variable_scope.variable_scope("coverage"):
-                w_c = variable_scope.get_variable("w_c", [1, 1, 1, attention_vec_size])
+    with variable_scope.variable_scope("attention_decoder"):
+        batch_size, attn_size, attention = _attention_mechanism(encoder_states, enc_padding_mask, use_coverage,
+                                                                encoder_features)
 
         if prev_coverage is not None:  # for beam search mode with coverage
             # reshape from (batch_size, attn_length) to (batch_size, attn_len, 1, 1)
             prev_coverage = tf.expand_dims(tf.expand_dims(prev_coverage, 2), 3)
 
-        def attention(decoder_state, coverage=None):
-            """Calculate the context vector and attention distribution from the decoder state.
-
-            Args:
-              decoder_state: state of the decoder
-              coverage: Optional. Previous timestep's coverage vector, shape (batch_size, attn_len, 1, 1).
-
-            Returns:
-              context_vector: weighted sum of encoder_states
-              attn_dist: attention distribution
-              coverage: new coverage vector. shape (batch_size, attn_len, 1, 1)
-            """
-            with variable_scope.variable_scope("Attention"):
-                # Pass the decoder state through a linear layer (this is W_s s_t + b_attn in the paper)
-                decoder_features = linear(decoder_state, attention_vec_size,
-                                          True)  # shape (batch_size, attention_vec_size)
-                decoder_features = tf.expand_dims(tf.expand_dims(decoder_features, 1),
-                                                  1)  # reshape to (batch_size, 1, 1, attention_vec_size)
-
-                def masked_attention(e):
-                    """Take softmax of e then apply enc_padding_mask and re-normalize"""
-                    attn_dist = nn_ops.softmax(e)  # take softmax. shape (batch_size, attn_length)
-                    attn_dist *= enc_padding_mask  # apply mask
-                    masked_sums = tf.reduce_sum(attn_dist, axis=1)  # shape (batch_size)
-                    return attn_dist / tf.reshape(masked_sums, [-1, 1])  # re-normalize
-
-                if use_coverage and coverage is not None:  # non-first step of coverage
-                    # Multiply coverage vector by w_c to get coverage_features.
-                    coverage_features = nn_ops.conv2d(coverage, w_c, [1, 1, 1, 1],
-                                                      "SAME")  # c has shape (batch_size, attn_length, 1, attention_vec_size)
-
-                    # Calculate v^T tanh(W_h h_i + W_s s_t + w_c c_i^t + b_attn)
-                    e = math_ops.reduce_sum(v * math_ops.tanh(encoder_features + decoder_features + coverage_features),
-                                            [2, 3])  # shape (batch_size,attn_length)
-
-                    # Calculate attention distribution
-                    attn_dist = masked_attention(e)
-
-                    # Update coverage vector
-                    coverage += array_ops.reshape(attn_dist, [batch_size, -1, 1, 1])
-                else:
-                    # Calculate v^T tanh(W_h h_i + W_s s_t + b_attn)
-                    e = math_ops.reduce_sum(v * math_ops.tanh(encoder_features + decoder_features),
-                                            [2, 3])  # calculate e
-
-                    # Calculate attention distribution
-                    attn_dist = masked_attention(e)
-
-                    if use_coverage:  # first step of training
-                        coverage = tf.expand_dims(tf.expand_dims(attn_dist, 2), 2)  # initialize coverage
-
-                # Calculate the context vector from attn_dist and encoder_states
-                context_vector = math_ops.reduce_sum(
-                    array_ops.reshape(attn_dist, [batch_size, -1, 1, 1]) * encoder_states,
-                    [1, 2])  # shape (batch_size, attn_size).
-                context_vector = array_ops.reshape(context_vector, [-1, attn_size])
-
-            return context_vector, attn_dist, coverage
-
         outputs = []
         attn_dists = []
         p_gens = []
@@ -161,36 +82,14 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
             if i > 0:
                 variable_scope.get_variable_scope().reuse_variables()
 
-            # Merge input and previous attentions into one vector x of the same size as inp
-            input_size = inp.get_shape().with_rank(2)[1]
-            if input_size.value is None:
-                raise ValueError("Could not infer input size from input: %s" % inp.name)
-            x = linear([inp] + [context_vector], input_size, True)
-
-            # Run the decoder RNN cell. cell_output = decoder state
-            cell_output, state = cell(x, state)
-
-            # Run the attention mechanism.
-            if i == 0 and initial_state_attention:  # always true in decode mode
-                with variable_scope.variable_scope(variable_scope.get_variable_scope(),
-                                                   reuse=True):  # you need this because you've already run the initial attention(...) call
-                    context_vector, attn_dist, _ = attention(state, coverage)  # don't allow coverage to update
-            else:
-                context_vector, attn_dist, coverage = attention(state, coverage)
+            # On the first step in decode mode, the attention was already computed from initial_state above
+            output, state, context_vector, attn_dist, p_gen, coverage = _decoder_step(
+                inp, state, context_vector, coverage, cell, attention, pointer_gen,
+                update_coverage=not (i == 0 and initial_state_attention))
+            outputs.append(output)
             attn_dists.append(attn_dist)
-
-            # Calculate p_gen
             if pointer_gen:
-                with tf.variable_scope('calculate_pgen'):
-                    p_gen = linear([context_vector, state.c, state.h, x], 1, True)  # a scalar
-                    p_gen = tf.sigmoid(p_gen)
-                    p_gens.append(p_gen)
-
-            # Concatenate the cell_output (= decoder state) and the context vector, and pass them through a linear layer
-            # This is V[s_t, h*_t] + b in the paper
-            with variable_scope.variable_scope("AttnOutputProjection"):
-                output = linear([cell_output] + [context_vector], cell.output_size, True)
-            outputs.append(output)
+                p_gens.append(p_gen)
 
         # If using coverage, reshape it
         if coverage is not None:
@@ -199,6 +98,249 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
         return outputs, state, attn_dists, p_gens, coverage
 
 
+def dynamic_attention_decoder(decoder_inputs, num_steps, initial_state, encoder_states, enc_padding_mask, cell,
+                              pointer_gen=True, use_coverage=False):
+    """The attention decoder of train and eval mode, run in a tf.while_loop for num_steps steps only.
+
+    It computes the same as attention_decoder with initial_state_attention=False, and makes the same variables,
+    so that checkpoints can be used with either.
+
+    Args:
+      decoder_inputs: 3D Tensor [batch_size x max_dec_steps x input_size].
+      num_steps: scalar int32 Tensor, at most max_dec_steps. Number of decoder steps to run, e.g. the length of the longest decoder sequence of the batch.
+      initial_state: 2D Tensor [batch_size x cell.state_size].
+      encoder_states: 3D Tensor [batch_size x attn_length x attn_size].
+      enc_padding_mask: 2D Tensor [batch_size x attn_length] containing 1s and 0s; indicates which of the encoder locations are padding (0) or a real token (1).
+      cell: rnn_cell.RNNCell defining the cell function and size.
+      pointer_gen: boolean. If True, calculate the generation probability p_gen for each decoder step.
+      use_coverage: boolean. If True, use coverage mechanism.
+
+    Returns:
+      outputs: 3D Tensor [batch_size x num_steps x cell.output_size]. The output vectors.
+      state: The final state of the decoder. A tensor shape [batch_size x cell.state_size].
+      attn_dists: 3D Tensor [batch_size x num_steps x attn_length]. The attention distributions for each decoder step.
+      p_gens: 3D Tensor [batch_size x num_steps x 1]. The values of p_gen for each decoder step. None if pointer_gen=False.
+      coverage: Coverage vector on the last step computed. None if use_coverage=False.
+    """
+    with variable_scope.variable_scope("attention_decoder"):
+        batch_size, attn_size, attention = _attention_mechanism(encoder_states, enc_padding_mask, use_coverage)
+
+        # time major, so that the TensorArray holds one step per element
+        inputs = tf.TensorArray(decoder_inputs.dtype, size=num_steps).unstack(
+            tf.transpose(decoder_inputs[:, :num_steps], [1, 0, 2]))
+        context_vector = array_ops.zeros([batch_size, attn_size])
+        context_vector.set_shape([None, attn_size])
+        # A zero coverage vector gives the same attention as no coverage vector, as on the first step of attention_decoder
+        coverage = array_ops.zeros([batch_size, array_ops.shape(encoder_states)[1], 1, 1]) if use_coverage else None
+
+        def body(step, state, context_vector, coverage, outputs, attn_dists, p_gens):
+            output, state, context_vector, attn_dist, p_gen, new_coverage = _decoder_step(
+                inputs.read(step), state, context_vector, coverage if use_coverage else None, cell, attention,
+                pointer_gen)
+            outputs = outputs.write(step, output)
+            attn_dists = attn_dists.write(step, attn_dist)
+            if pointer_gen:
+                p_gens = p_gens.write(step, p_gen)
+            if use_coverage:
+                coverage = new_coverage
+            return step + 1, state, context_vector, coverage, outputs, attn_dists, p_gens
+
+        _, state, _, coverage, outputs, attn_dists, p_gens = tf.while_loop(
+            lambda step, *_: tf.less(step, num_steps),
+            body,
+            (
+                tf.constant(0),
+                initial_state,
+                context_vector,
+                coverage if use_coverage else tf.zeros([]),  # while_loop needs a tensor
+                tf.TensorArray(tf.float32, size=num_steps),
+                tf.TensorArray(tf.float32, size=num_steps),
+                tf.TensorArray(tf.float32, size=num_steps if pointer_gen else 0)
+            ),
+            swap_memory=True)
+
+        def batch_major(ta):
+            return tf.transpose(ta.stack(), [1, 0, 2])
+
+        return (
+            batch_major(outputs),
+            state,
+            batch_major(attn_dists),
+            batch_major(p_gens) if pointer_gen else None,
+            array_ops.reshape(coverage, [batch_size, -1]) if use_coverage else None
+        )
+
+
+def _attention_mechanism(encoder_states, enc_padding_mask, use_coverage, encoder_features=None):
+    """Make the variables of the attention mechanism, in the variable scope of the decoder.
+
+    Returns:
+      batch_size: the batch size, a python int if it is static, otherwise a scalar tensor
+      attn_size: size of the encoder states
+      attention: function of a decoder state and (optional) coverage vector of shape (batch_size, attn_len, 1, 1),
+        that returns the context vector, attention distribution and new coverage vector
+    """
+    # the batch size is static in decode mode, and may vary between batches in train and eval mode
+    batch_size = encoder_states.get_shape()[0].value
+    if batch_size is None:
+        batch_size = array_ops.shape(encoder_states)[0]
+    attn_size = encoder_states.get_shape()[
+        2].value  # if this line fails, it's because the attention length isn't defined
+
+    # Reshape encoder_states (need to insert a dim)
+    encoder_states = tf.expand_dims(encoder_states, axis=2)  # now is shape (batch_size, attn_len, 1, attn_size)
+
+    # To calculate attention, we calculate
+    #   v^T tanh(W_h h_i + W_s s_t + w_c c_i^t + b_attn)
+    # where h_i is an encoder state, and s_t a decoder state.
+    # attn_vec_size is the length of the vectors v, b_attn, (W_h h_i) and (W_s s_t).
+    # We set it to be equal to the size of the encoder states.
+    attention_vec_size = attn_size
+
+    # Get the weight matrix W_h and apply it to each encoder state to get (W_h h_i), the encoder features
+    if encoder_features is None:
+        encoder_features = _encoder_features(encoder_states,
+                                             attention_vec_size)  # shape (batch_size,attn_length,1,attention_vec_size)
+
+    # Get the weight vectors v and w_c (w_c is for coverage)
+    v = variable_scope.get_variable("v", [attention_vec_size])
+    if use_coverage:
+        with variable_scope.variable_scope("coverage"):
+            w_c = variable_scope.get_variable("w_c", [1, 1, 1, attention_vec_size])
+
+    def attention(decoder_state, coverage=None):
+        """Calculate the context vector and attention distribution from the decoder state.
+
+        Args:
+          decoder_state: state of the decoder
+          coverage: Optional. Previous timestep's coverage vector, shape (batch_size, attn_len, 1, 1).
+
+        Returns:
+          context_vector: weighted sum of encoder_states
+          attn_dist: attention distribution
+          coverage: new coverage vector. shape (batch_size, attn_len, 1, 1)
+        """
+        with variable_scope.variable_scope("Attention"):
+            # Pass the decoder state through a linear layer (this is W_s s_t + b_attn in the paper)
+            decoder_features = linear(decoder_state, attention_vec_size,
+                                      True)  # shape (batch_size, attention_vec_size)
+            decoder_features = tf.expand_dims(tf.expand_dims(decoder_features, 1),
+                                              1)  # reshape to (batch_size, 1, 1, attention_vec_size)
+
+            def masked_attention(e):
+                """Take softmax of e then apply enc_padding_mask and re-normalize"""
+                attn_dist = nn_ops.softmax(e)  # take softmax. shape (batch_size, attn_length)
+                attn_dist *= enc_padding_mask  # apply mask
+                masked_sums = tf.reduce_sum(attn_dist, axis=1)  # shape (batch_size)
+                return attn_dist / tf.reshape(masked_sums, [-1, 1])  # re-normalize
+
+            if use_coverage and coverage is not None:  # non-first step of coverage
+                # Multiply coverage vector by w_c to get coverage_features.
+                coverage_features = nn_ops.conv2d(coverage, w_c, [1, 1, 1, 1],
+                                                  "SAME")  # c has shape (batch_size, attn_length, 1, attention_vec_size)
+
+                # Calculate v^T tanh(W_h h_i + W_s s_t + w_c c_i^t + b_attn)
+                e = math_ops.reduce_sum(v * math_ops.tanh(encoder_features + decoder_features + coverage_features),
+                                        [2, 3])  # shape (batch_size,attn_length)
+
+                # Calculate attention distribution
+                attn_dist = masked_attention(e)
+
+                # Update coverage vector
+                coverage += array_ops.reshape(attn_dist, [batch_size, -1, 1, 1])
+            else:
+                # Calculate v^T tanh(W_h h_i + W_s s_t + b_attn)
+                e = math_ops.reduce_sum(v * math_ops.tanh(encoder_features + decoder_features),
+                                        [2, 3])  # calculate e
+
+                # Calculate attention distribution
+                attn_dist = masked_attention(e)
+
+                if use_coverage:  # first step of training
+                    coverage = tf.expand_dims(tf.expand_dims(attn_dist, 2), 2)  # initialize coverage
+
+            # Calculate the context vector from attn_dist and encoder_states
+            context_vector = math_ops.reduce_sum(
+                array_ops.reshape(attn_dist, [batch_size, -1, 1, 1]) * encoder_states,
+                [1, 2])  # shape (batch_size, attn_size).
+            context_vector = array_ops.reshape(context_vector, [-1, attn_size])
+
+        return context_vector, attn_dist, coverage
+
+    return batch_size, attn_size, attention
+
+
+def _decoder_step(inp, state, context_vector, coverage, cell, attention, pointer_gen, update_coverage=True):
+    """Run one step of the attention decoder, in its variable scope.
+
+    Args:
+      inp: 2D Tensor [batch_size x input_size]. The decoder input of this step.
+      state: the decoder state of the previous step
+      context_vector: the context vector of the previous step
+      coverage: the coverage vector of the previous step, or None
+      cell: rnn_cell.RNNCell
+      attention: the attention function made by _attention_mechanism
+      pointer_gen: boolean. If True, calculate the generation probability p_gen.
+      update_coverage: If False, the attention variables must already exist, and the coverage vector is not updated.
+
+    Returns:
+      output, state, context_vector, attn_dist, p_gen (None if not pointer_gen) and coverage of this step
+    """
+    # Merge input and previous attentions into one vector x of the same size as inp
+    input_size = inp.get_shape().with_rank(2)[1]
+    if input_size.value is None:
+        raise ValueError("Could not infer input size from input: %s" % inp.name)
+    x = linear([inp] + [context_vector], input_size, True)
+
+    # Run the decoder RNN cell. cell_output = decoder state
+    cell_output, state = cell(x, state)
+
+    # Run the attention mechanism.
+    if update_coverage:
+        context_vector, attn_dist, coverage = attention(state, coverage)
+    else:
+        with variable_scope.variable_scope(variable_scope.get_variable_scope(),
+                                           reuse=True):  # you need this because you've already run the initial attention(...) call
+            context_vector, attn_dist, _ = attention(state, coverage)  # don't allow coverage to update
+
+    # Calculate p_gen
+    p_gen = None
+    if pointer_gen:
+        with tf.variable_scope('calculate_pgen'):
+            p_gen = linear([context_vector, state.c, state.h, x], 1, True)  # a scalar
+            p_gen = tf.sigmoid(p_gen)
+
+    # Concatenate the cell_output (= decoder state) and the context vector, and pass them through a linear layer
+    # This is V[s_t, h*_t] + b in the paper
+    with variable_scope.variable_scope("AttnOutputProjection"):
+        output = linear([cell_output] + [context_vector], cell.output_size, True)
+    return output, state, context_vector, attn_dist, p_gen, coverage
+
+
+def encoder_attention_features(encoder_states):
+    """Calculate the encoder features (W_h h_i) that the attention mechanism of attention_decoder compares with every decoder state.
+    Call this in the same variable scope as attention_decoder.
+
+    Args:
+      encoder_states: 3D Tensor [batch_size x attn_length x attn_size].
+
+    Returns:
+      encoder_features: 4D Tensor [batch_size x attn_length x 1 x attn_size].
+    """
+    with variable_scope.variable_scope("attention_decoder"):
+        attn_size = encoder_states.get_shape()[
+            2].value  # if this line fails, it's because the attention length isn't defined
+        encoder_states = tf.expand_dims(encoder_states, axis=2)  # now is shape (batch_size, attn_len, 1, attn_size)
+        return _encoder_features(encoder_states, attn_size)
+
+
+def _encoder_features(encoder_states, attention_vec_size):
+    """Apply the weight matrix W_h to each encoder state, of shape (batch_size, attn_len, 1, attn_size)"""
+    attn_size = encoder_states.get_shape()[3].value
+    W_h = variable_scope.get_variable("W_h", [1, 1, attn_size, attention_vec_size])
+    return nn_ops.conv2d(encoder_states, W_h, [1, 1, 1, 1], "SAME")
+
+
 def linear(args, output_size, bias, bias_start=0.0, scope=None):
     """Linear map: sum_i(args[i] * W[i]), where W[i] is a variable.
 
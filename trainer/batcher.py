@@ -16,9 +16,11 @@
 
 """This file contains code to process data into batches"""
 
-from queue import Queue
+from multiprocessing import Pool
+from queue import Queue, Empty
 from random import shuffle
 from threading import Thread
+import itertools
 import time
 import numpy as np
 from tensorflow import logging as log
@@ -27,10 +29,15 @@ from tensorflow.python.estimator.model_fn import ModeKeys as Modes
 import stringx
 
 
+def split_abstract(abstract):
+    """Split a preprocessed abstract into sentences, each ending with a period."""
+    return [sent + ' .' for sent in abstract.split('.')]
+
+
 def to_example(article, abstract, vocab, hps, pointer_gen):
     article = stringx.to_str(article)
     abstract = stringx.to_str(abstract)
-    abstract_sentences = [sent + ' .' for sent in abstract.split('.')]
+    abstract_sentences = split_abstract(abstract)
     return Example(
         article=article,
         abstract_sentences=abstract_sentences,
@@ -50,10 +57,138 @@ def to_batch(articles, abstracts, vocab, hps, pointer_gen):
     return Batch(example_list=example_list, hps=hps, vocab=vocab, pointer_gen=pointer_gen)
 
 
+def encode_example(article, abstract_sentences, vocab, max_enc_steps, max_dec_steps, pointer_gen):
+    """Tokenizes and truncates the article and abstract of an example, and maps their words to ids.
+
+    Args:
+      article: source text; a string. each token is separated by a single space.
+      abstract_sentences: list of strings, one per abstract sentence. In each sentence, each token is separated by a single space.
+      vocab: Vocabulary object
+      max_enc_steps: integer. The article is truncated to this many tokens.
+      max_dec_steps: integer. The decoder input and target sequences are truncated to this many tokens.
+      pointer_gen: If True, also map the article and abstract to ids that use the temporary article OOV ids.
+
+    Returns:
+      A dict with the numpy int32 arrays enc_input, dec_input and target,
+      and if pointer_gen, the numpy int32 array enc_input_extend_vocab and the list of article_oovs (strings).
+    """
+    # Get ids of special tokens
+    start_decoding = vocab.word2id(data.START_DECODING)
+    stop_decoding = vocab.word2id(data.STOP_DECODING)
+
+    # Process the article
+    article_words = article.split()
+    if len(article_words) > max_enc_steps:
+        article_words = article_words[:max_enc_steps]
+    enc_input = [vocab.word2id(w) for w in article_words]  # list of word ids; OOVs are represented by the id for UNK token
+
+    # Process the abstract
+    abstract_words = ' '.join(abstract_sentences).split()  # list of strings
+    abs_ids = [vocab.word2id(w) for w in abstract_words]  # list of word ids; OOVs are represented by the id for UNK token
+
+    # Get the decoder input sequence and target sequence
+    dec_input, target = Example.get_dec_inp_targ_seqs(abs_ids, max_dec_steps, start_decoding, stop_decoding)
+    res = {
+        'enc_input': np.array(enc_input, dtype=np.int32),
+        'dec_input': np.array(dec_input, dtype=np.int32),
+        'target': np.array(target, dtype=np.int32)
+    }
+
+    # If using pointer-generator mode, we need to store some extra info
+    if pointer_gen:
+        # Store a version of the enc_input where in-article OOVs are represented by their temporary OOV id; also store the in-article OOVs words themselves
+        enc_input_extend_vocab, article_oovs = data.article2ids(article_words, vocab)
+
+        # Get a verison of the reference summary where in-article OOVs are represented by their temporary article OOV id
+        abs_ids_extend_vocab = data.abstract2ids(abstract_words, vocab, article_oovs)
+
+        # Overwrite decoder target sequence so it uses the temp article OOV ids
+        _, target = Example.get_dec_inp_targ_seqs(abs_ids_extend_vocab, max_dec_steps, start_decoding, stop_decoding)
+        res['target'] = np.array(target, dtype=np.int32)
+        res['enc_input_extend_vocab'] = np.array(enc_input_extend_vocab, dtype=np.int32)
+        res['article_oovs'] = article_oovs
+    return res
+
+
+# Arguments of encode_example that are the same for every example, set once in each worker process of an example pool
+_worker_args = None
+
+
+def _init_example_worker(vocab, max_enc_steps, max_dec_steps, pointer_gen):
+    global _worker_args
+    _worker_args = (vocab, max_enc_steps, max_dec_steps, pointer_gen)
+
+
+def _encode_in_worker(text):
+    article, abstract_sentences = text
+    return encode_example(article, abstract_sentences, *_worker_args)
+
+
+def encoded_example(article_ids, abstract_ids, article_oovs, vocab, max_enc_steps, max_dec_steps, pointer_gen):
+    """Truncates an example that was already mapped to ids (see etl.encoded_example), giving the same result as encode_example.
+
+    Args:
+      article_ids: numpy int array. Ids of all the article words; OOVs are represented by their temporary article OOV id.
+      abstract_ids: numpy int array. Ids of all the abstract words; in-article OOVs are represented by their temporary article OOV id.
+      article_oovs: list of the OOV words (strings) of the whole article, in the order of their temporary article OOV ids.
+      vocab: Vocabulary object, of the same version as the vocabulary that the ids were encoded with
+      max_enc_steps: integer. The article is truncated to this many tokens.
+      max_dec_steps: integer. The decoder input and target sequences are truncated to this many tokens.
+      pointer_gen: If True, also return the ids that use the temporary article OOV ids.
+
+    Returns:
+      A dict, see encode_example.
+    """
+    vsize = vocab.size()
+    unk_id = vocab.word2id(data.UNKNOWN_TOKEN)
+    start_decoding = vocab.word2id(data.START_DECODING)
+    stop_decoding = vocab.word2id(data.STOP_DECODING)
+
+    enc_input_extend_vocab = article_ids[:max_enc_steps]
+    # Temporary OOV ids are numbered in order of first appearance, so the OOVs of the truncated article are a prefix of
+    # article_oovs. Abstract words that are OOVs of the truncated part of the article only are out-of-article OOVs.
+    num_oovs = max(int(np.max(enc_input_extend_vocab)) - vsize + 1, 0) if len(enc_input_extend_vocab) != 0 else 0
+    abs_ids_extend_vocab = np.where(abstract_ids < vsize + num_oovs, abstract_ids, unk_id)
+    abs_ids = np.where(abs_ids_extend_vocab < vsize, abs_ids_extend_vocab, unk_id)
+
+    dec_input, target = Example.get_dec_inp_targ_seqs(abs_ids.tolist(), max_dec_steps, start_decoding, stop_decoding)
+    res = {
+        'enc_input': np.where(enc_input_extend_vocab < vsize, enc_input_extend_vocab, unk_id).astype(np.int32),
+        'dec_input': np.array(dec_input, dtype=np.int32),
+        'target': np.array(target, dtype=np.int32)
+    }
+    if pointer_gen:
+        _, target = Example.get_dec_inp_targ_seqs(abs_ids_extend_vocab.tolist(), max_dec_steps, start_decoding,
+                                                  stop_decoding)
+        res['target'] = np.array(target, dtype=np.int32)
+        res['enc_input_extend_vocab'] = enc_input_extend_vocab.astype(np.int32)
+        res['article_oovs'] = article_oovs[:num_oovs]
+    return res
+
+
+def to_encoded_batch(article_ids, article_lens, abstract_ids, abstract_lens, article_oovs, num_article_oovs,
+                     vocab, hps, pointer_gen):
+    """Makes a Batch from a batch of etl.encoded_dataset; the arrays are padded to the longest sequence of the batch."""
+    example_list = []
+    for i in range(len(article_lens)):
+        encoded = encoded_example(
+            article_ids=article_ids[i, :article_lens[i]],
+            abstract_ids=abstract_ids[i, :abstract_lens[i]],
+            article_oovs=[stringx.to_str(w) for w in article_oovs[i, :num_article_oovs[i]]],
+            vocab=vocab,
+            max_enc_steps=hps.max_enc_steps,
+            max_dec_steps=hps.max_dec_steps,
+            pointer_gen=pointer_gen
+        )
+        # The original strings are not kept in encoded data
+        example_list.append(Example('', [], vocab=vocab, hps=hps, pointer_gen=pointer_gen, encoded=encoded))
+    return Batch(example_list=example_list, hps=hps, vocab=vocab, pointer_gen=pointer_gen)
+
+
 class Example(object):
     """Class representing a train/val/test example for text summarization."""
 
-    def __init__(self, article, abstract_sentences, vocab, hps, pointer_gen):
+    def __init__(self, article, abstract_sentences, vocab, hps, pointer_gen, encoded=None):
         """Initializes the Example, performing tokenization and truncation to produce the encoder, decoder and target sequences, which are stored in self.
 
         Args:
@@ -61,44 +196,26 @@ class Example(object):
           abstract_sentences: list of strings, one per abstract sentence. In each sentence, each token is separated by a single space.
           vocab: Vocabulary object
           hps: hyperparameters
+          encoded: Optional. The result of encode_example for this article and abstract, if it was already computed
+            (e.g. in a worker process).
         """
         self.hps = hps
         self.pointer_gen = pointer_gen
 
-        # Get ids of special tokens
-        start_decoding = vocab.word2id(data.START_DECODING)
-        stop_decoding = vocab.word2id(data.STOP_DECODING)
-
-        # Process the article
-        article_words = article.split()
-        if len(article_words) > hps.max_enc_steps:
-            article_words = article_words[:hps.max_enc_steps]
-        self.enc_len = len(article_words)  # store the length after truncation but before padding
-        self.enc_input = [vocab.word2id(w) for w in
-                          article_words]  # list of word ids; OOVs are represented by the id for UNK token
-
-        # Process the abstract
-        abstract = ' '.join(abstract_sentences)  # string
-        abstract_words = abstract.split()  # list of strings
-        abs_ids = [vocab.word2id(w) for w in
-                   abstract_words]  # list of word ids; OOVs are represented by the id for UNK token
-
-        # Get the decoder input sequence and target sequence
-        self.dec_input, self.target = self.get_dec_inp_targ_seqs(abs_ids, hps.max_dec_steps, start_decoding,
-                                                                 stop_decoding)
+        if encoded is None:
+            encoded = encode_example(article, abstract_sentences, vocab, hps.max_enc_steps, hps.max_dec_steps,
+                                     pointer_gen)
+        # unpadded numpy int32 arrays; Batch pads them
+        self.enc_input = encoded['enc_input']
+        self.enc_len = len(self.enc_input)  # store the length after truncation but before padding
+        self.dec_input = encoded['dec_input']
+        self.target = encoded['target']
         self.dec_len = len(self.dec_input)
-
-        # If using pointer-generator mode, we need to store some extra info
         if self.pointer_gen:
-            # Store a version of the enc_input where in-article OOVs are represented by their temporary OOV id; also store the in-article OOVs words themselves
-            self.enc_input_extend_vocab, self.article_oovs = data.article2ids(article_words, vocab)
-
-            # Get a verison of the reference summary where in-article OOVs are represented by their temporary article OOV id
-            abs_ids_extend_vocab = data.abstract2ids(abstract_words, vocab, self.article_oovs)
+            self.enc_input_extend_vocab = encoded['enc_input_extend_vocab']
+            self.article_oovs = encoded['article_oovs']
 
-            # Overwrite decoder target sequence so it uses the temp article OOV ids
-            _, self.target = self.get_dec_inp_targ_seqs(abs_ids_extend_vocab, hps.max_dec_steps, start_decoding,
-                                                        stop_decoding)
+        abstract = ' '.join(abstract_sentences)  # string
 
         # Store the original strings
         self.original_article = article
@@ -111,7 +228,8 @@ class Example(object):
             repr(self.original_abstract_sents)
         )
 
-    def get_dec_inp_targ_seqs(self, sequence, max_len, start_id, stop_id):
+    @staticmethod
+    def get_dec_inp_targ_seqs(sequence, max_len, start_id, stop_id):
         """Given the reference summary as a sequence of tokens, return the input sequence for the decoder, and the target sequence which we will use to calculate loss. The sequence will be truncated if it is longer than max_len. The input sequence must start with the start_id and the target sequence must end with the stop_id (but not if it's been truncated).
 
         Args:
@@ -134,20 +252,42 @@ class Example(object):
         assert len(inp) == len(target)
         return inp, target
 
-    def pad_decoder_inp_targ(self, max_len, pad_id):
-        """Pad decoder input and target sequences with pad_id up to max_len."""
-        while len(self.dec_input) < max_len:
-            self.dec_input.append(pad_id)
-        while len(self.target) < max_len:
-            self.target.append(pad_id)
-
-    def pad_encoder_input(self, max_len, pad_id):
-        """Pad the encoder input sequence with pad_id up to max_len."""
-        while len(self.enc_input) < max_len:
-            self.enc_input.append(pad_id)
-        if self.pointer_gen:
-            while len(self.enc_input_extend_vocab) < max_len:
-                self.enc_input_extend_vocab.append(pad_id)
+
+def flatten_sequences(sequences):
+    """Concatenates sequences of ids into one array.
+
+    Args:
+      sequences: list of 1-D arrays (or lists) of ids
+
+    Returns:
+      values: int32 array, the concatenation of the sequences
+      offsets: int64 array of length len(sequences) + 1; sequence i is values[offsets[i]:offsets[i + 1]]
+    """
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in sequences], out=offsets[1:])
+    values = np.concatenate(sequences).astype(np.int32) if offsets[-1] > 0 else np.zeros(0, dtype=np.int32)
+    return values, offsets
+
+
+def pad_sequences(values, offsets, max_len, pad_id):
+    """Pads the sequences concatenated in values (see flatten_sequences) into the rows of a matrix.
+
+    Args:
+      values: 1-D int array, the concatenation of the sequences
+      offsets: 1-D int array; sequence i is values[offsets[i]:offsets[i + 1]]. No sequence is longer than max_len.
+      max_len: number of columns of the matrix
+      pad_id: id that fills the rest of each row
+
+    Returns:
+      padded: int32 array shape (num_sequences, max_len)
+      mask: float32 array shape (num_sequences, max_len), 1 where padded holds an id of a sequence and 0 where it is padding
+    """
+    lengths = np.diff(offsets)
+    is_value = np.arange(max_len)[np.newaxis, :] < lengths[:, np.newaxis]
+    padded = np.full(is_value.shape, pad_id, dtype=np.int32)
+    # the True entries of is_value, in row-major order, are the positions of values
+    padded[is_value] = values
+    return padded, is_value.astype(np.float32)
 
 
 class Batch(object):
@@ -200,25 +340,14 @@ class Batch(object):
             self.enc_batch_extend_vocab:
               Same as self.enc_batch, but in-article OOVs are represented by their temporary article OOV number.
         """
-        # Determine the maximum length of the encoder input sequence in this batch
-        max_enc_seq_len = max([ex.enc_len for ex in example_list])
-
-        # Pad the encoder input sequences up to the length of the longest sequence
-        for ex in example_list:
-            ex.pad_encoder_input(max_enc_seq_len, self.pad_id)
+        # Concatenate the encoder input sequences, one row per example
+        enc_values, enc_offsets = flatten_sequences([ex.enc_input for ex in example_list])
+        self.enc_lens = np.diff(enc_offsets).astype(np.int32)
 
-        # Initialize the numpy arrays
+        # Pad them up to the length of the longest sequence in this batch
         # Note: our enc_batch can have different length (second dimension) for each batch because we use dynamic_rnn for the encoder.
-        self.enc_batch = np.zeros((hps.batch_size, max_enc_seq_len), dtype=np.int32)
-        self.enc_lens = np.zeros((hps.batch_size), dtype=np.int32)
-        self.enc_padding_mask = np.zeros((hps.batch_size, max_enc_seq_len), dtype=np.float32)
-
-        # Fill in the numpy arrays
-        for i, ex in enumerate(example_list):
-            self.enc_batch[i, :] = ex.enc_input[:]
-            self.enc_lens[i] = ex.enc_len
-            for j in range(ex.enc_len):
-                self.enc_padding_mask[i][j] = 1
+        max_enc_seq_len = int(self.enc_lens.max())
+        self.enc_batch, self.enc_padding_mask = pad_sequences(enc_values, enc_offsets, max_enc_seq_len, self.pad_id)
 
         # For pointer-generator mode, need to store some extra info
         if self.pointer_gen:
@@ -227,9 +356,8 @@ class Batch(object):
             # Store the in-article OOVs themselves
             self.art_oovs = [ex.article_oovs for ex in example_list]
             # Store the version of the enc_batch that uses the article OOV ids
-            self.enc_batch_extend_vocab = np.zeros((hps.batch_size, max_enc_seq_len), dtype=np.int32)
-            for i, ex in enumerate(example_list):
-                self.enc_batch_extend_vocab[i, :] = ex.enc_input_extend_vocab[:]
+            extend_values, _ = flatten_sequences([ex.enc_input_extend_vocab for ex in example_list])
+            self.enc_batch_extend_vocab, _ = pad_sequences(extend_values, enc_offsets, max_enc_seq_len, self.pad_id)
 
     def init_decoder_seq(self, example_list, hps):
         """Initializes the following:
@@ -240,22 +368,14 @@ class Batch(object):
             self.dec_padding_mask:
               numpy array of shape (batch_size, max_dec_steps), containing 1s and 0s. 1s correspond to real tokens in dec_batch and target_batch; 0s correspond to padding.
             """
-        # Pad the inputs and targets
-        for ex in example_list:
-            ex.pad_decoder_inp_targ(hps.max_dec_steps, self.pad_id)
+        # Concatenate the inputs and targets, which have the same lengths
+        dec_values, dec_offsets = flatten_sequences([ex.dec_input for ex in example_list])
+        target_values, _ = flatten_sequences([ex.target for ex in example_list])
 
-        # Initialize the numpy arrays.
+        # Pad them up to max_dec_steps
         # Note: our decoder inputs and targets must be the same length for each batch (second dimension = max_dec_steps) because we do not use a dynamic_rnn for decoding. However I believe this is possible, or will soon be possible, with Tensorflow 1.0, in which case it may be best to upgrade to that.
-        self.dec_batch = np.zeros((hps.batch_size, hps.max_dec_steps), dtype=np.int32)
-        self.target_batch = np.zeros((hps.batch_size, hps.max_dec_steps), dtype=np.int32)
-        self.dec_padding_mask = np.zeros((hps.batch_size, hps.max_dec_steps), dtype=np.float32)
-
-        # Fill in the numpy arrays
-        for i, ex in enumerate(example_list):
-            self.dec_batch[i, :] = ex.dec_input[:]
-            self.target_batch[i, :] = ex.target[:]
-            for j in range(ex.dec_len):
-                self.dec_padding_mask[i][j] = 1
+        self.dec_batch, self.dec_padding_mask = pad_sequences(dec_values, dec_offsets, hps.max_dec_steps, self.pad_id)
+        self.target_batch, _ = pad_sequences(target_values, dec_offsets, hps.max_dec_steps, self.pad_id)
 
     def store_orig_strings(self, example_list):
         """Store the original article and abstract strings in the Batch object"""
@@ -289,6 +409,15 @@ class Batcher(object):
         self._batch_queue = Queue(self.BATCH_QUEUE_MAX)
         self._example_queue = Queue(self.BATCH_QUEUE_MAX * self._hps.batch_size)
 
+        # Optionally encode the examples in worker processes instead of example queue threads
+        self._example_pool = None
+        if hps.example_processes > 0:
+            self._example_pool = Pool(
+                processes=hps.example_processes,
+                initializer=_init_example_worker,
+                initargs=(vocab, hps.max_enc_steps, hps.max_dec_steps, pointer_gen)
+            )
+
         # Different settings depending on whether we're in single_pass mode or not
         if single_pass:
             self._num_example_q_threads = 1  # just one thread, so we read through the dataset just once
@@ -299,6 +428,8 @@ class Batcher(object):
             self._num_example_q_threads = 16  # num threads to fill example queue
             self._num_batch_q_threads = 4  # num threads to fill batch queue
             self._bucketing_cache_size = 100  # how many batches-worth of examples to load into cache before bucketing
+        if self._example_pool is not None:
+            self._num_example_q_threads = 1  # one thread feeds the worker processes
 
         # Start the threads that load the queues
         self._example_q_threads = []
@@ -321,7 +452,7 @@ class Batcher(object):
     def next_batch(self):
         """Return a Batch from the batch queue.
 
-        If mode='infer' then each batch contains a single example repeated beam_size-many times; this is necessary for beam search.
+        If mode='infer' then each batch contains decode_batch_articles examples, each repeated beam_size-many times in consecutive rows; this is necessary for beam search.
 
         Returns:
           batch: a Batch object, or None if we're in single_pass mode and we've exhausted the dataset.
@@ -331,17 +462,25 @@ class Batcher(object):
             log.warning(
                 'Bucket input queue is empty when calling next_batch. Bucket queue size: %i, Input queue size: %i',
                 self._batch_queue.qsize(), self._example_queue.qsize())
-            if self._single_pass and self._finished_reading:
+
+        while True:
+            # The batch queue thread stops once it has batched the last examples of the dataset
+            if self._single_pass and self._finished_reading and self._batch_queue.qsize() == 0 and not any(
+                    t.is_alive() for t in self._batch_q_threads):
                 log.info("Finished reading dataset in single_pass mode.")
                 return None
-
-        batch = self._batch_queue.get()  # get the next Batch
-        return batch
+            try:
+                return self._batch_queue.get(timeout=1)  # get the next Batch
+            except Empty:
+                continue
 
     def fill_example_queue(self):
         """Reads data from file and processes into Examples which are then placed into the example queue."""
 
         input_gen = self.text_generator(data.example_generator(self._data_path, self._single_pass))
+        if self._example_pool is not None:
+            self._fill_example_queue_from_pool(input_gen)
+            return
 
         while True:
             try:
@@ -369,10 +508,43 @@ class Batcher(object):
             )
             self._example_queue.put(example)  # place the Example in the example queue.
 
+    def _fill_example_queue_from_pool(self, input_gen):
+        """Encodes the articles and abstracts from input_gen in the example pool and places the Examples in the example queue.
+
+        The strings are kept in this process; only the encoded id arrays are sent back by the worker processes.
+        Texts are read and encoded one chunk at a time, a batch for each worker process, and the next chunk is only
+        read once the Examples of this one are in the example queue, so the bounded queue limits how far ahead the reading gets."""
+        chunk_size = self._hps.example_processes * self._hps.batch_size
+        while True:
+            texts = [(article, [sent.strip() for sent in data.abstract2sents(abstract)])
+                     for (article, abstract) in itertools.islice(input_gen, chunk_size)]
+            if len(texts) == 0:
+                break
+            encoded_texts = self._example_pool.map(_encode_in_worker, texts, chunksize=self._hps.batch_size)
+            for (article, abstract_sentences), encoded in zip(texts, encoded_texts):
+                example = Example(
+                    article,
+                    abstract_sentences,
+                    vocab=self._vocab,
+                    hps=self._hps,
+                    pointer_gen=self._pointer_gen,
+                    encoded=encoded
+                )
+                self._example_queue.put(example)  # place the Example in the example queue.
+
+        log.info("The example generator for this example queue filling thread has exhausted data.")
+        if not self._single_pass:
+            raise Exception("single_pass mode is off but the example generator is out of data; error.")
+        log.info("single_pass mode is on, so we've finished reading dataset. This thread is stopping.")
+        # no more examples will be encoded, so let the worker processes exit
+        self._example_pool.close()
+        self._example_pool.join()
+        self._finished_reading = True
+
     def fill_batch_queue(self):
         """Takes Examples out of example queue, sorts them by encoder sequence length, processes into Batches and places them in the batch queue.
 
-        In decode mode, makes batches that each contain a single example repeated.
+        In decode mode, makes batches that each contain decode_batch_articles examples, each repeated beam_size times.
         """
         while True:
             if self._mode != Modes.PREDICT:
@@ -399,11 +571,29 @@ class Batcher(object):
                     )
 
             else:  # beam search decode mode
-                ex = self._example_queue.get()
-                b = [ex for _ in range(self._hps.batch_size)]
-                self._batch_queue.put(
-                    Batch(b, hps=self._hps, vocab=self._vocab, pointer_gen=self._pointer_gen)
-                )
+                num_articles = self._hps.decode_batch_articles
+                beam_size = self._hps.batch_size // num_articles
+                exs = self._next_examples(num_articles)
+                if len(exs) == 0:  # finished reading dataset in single_pass mode
+                    break
+                # Pad a short final batch by repeating its last article; these rows are not decoded
+                padded = exs + [exs[-1] for _ in range(num_articles - len(exs))]
+                b = [ex for ex in padded for _ in range(beam_size)]
+                batch = Batch(b, hps=self._hps, vocab=self._vocab, pointer_gen=self._pointer_gen)
+                batch.num_articles = len(exs)
+                self._batch_queue.put(batch)
+
+    def _next_examples(self, n):
+        """Takes up to n Examples out of the example queue.
+        Fewer are returned only in single_pass mode, once the dataset has been read completely."""
+        exs = []
+        while len(exs) < n:
+            try:
+                exs.append(self._example_queue.get(timeout=1))
+            except Empty:
+                if self._single_pass and self._finished_reading:
+                    break
+        return exs
 
     def watch_threads(self):
         """Watch example queue and batch queue threads and restart if dead."""
@@ -18,10 +18,11 @@
 
 import numpy as np
 import trainer.data as data
+from tensorflow import logging as log
 
 
 class Hypothesis(object):
-    """Class to represent a hypothesis during beam search. Holds all the information needed for the hypothesis."""
+    """Class to represent a hypothesis found by beam search. Holds all the information needed for the hypothesis."""
 
     def __init__(self, tokens, log_probs, state, attn_dists, p_gens, coverage):
         """Hypothesis constructor.
@@ -29,11 +30,11 @@ class Hypothesis(object):
         Args:
           tokens: List of integers. The ids of the tokens that form the summary so far.
           log_probs: List, same length as tokens, of floats, giving the log probabilities of the tokens so far.
-          state: Current state of the decoder, a LSTMStateTuple.
+          state: Current state of the decoder, a LSTMStateTuple, or None.
           attn_dists: List, same length as tokens, of numpy arrays with shape (attn_length).
-            These are the attention distributions so far.
+            These are the attention distributions so far. Empty if they were not kept.
           p_gens: List, same length as tokens, of floats, or None if not using pointer-generator model.
-            The values of the generation probability so far.
+            The values of the generation probability so far. Empty if they were not kept.
           coverage: Numpy array of shape (attn_length), or None if not using coverage. The current coverage vector.
         """
         self.tokens = tokens
@@ -43,26 +44,6 @@ class Hypothesis(object):
         self.p_gens = p_gens
         self.coverage = coverage
 
-    def extend(self, token, log_prob, state, attn_dist, p_gen, coverage):
-        """Return a NEW hypothesis, extended with the information from the latest step of beam search.
-
-        Args:
-          token: Integer. Latest token produced by beam search.
-          log_prob: Float. Log prob of the latest token.
-          state: Current decoder state, a LSTMStateTuple.
-          attn_dist: Attention distribution from latest step. Numpy array shape (attn_length).
-          p_gen: Generation probability on latest step. Float.
-          coverage: Latest coverage vector. Numpy array shape (attn_length), or None if not using coverage.
-        Returns:
-          New Hypothesis for next step.
-        """
-        return Hypothesis(tokens=self.tokens + [token],
-                          log_probs=self.log_probs + [log_prob],
-                          state=state,
-                          attn_dists=self.attn_dists + [attn_dist],
-                          p_gens=self.p_gens + [p_gen],
-                          coverage=coverage)
-
     @property
     def latest_token(self):
         return self.tokens[-1]
@@ -78,102 +59,284 @@ class Hypothesis(object):
         return self.log_prob / len(self.tokens)
 
 
-def run_beam_search(sess, model, vocab, batch, beam_size, min_dec_steps, max_dec_steps):
-    """Performs beam search decoding on the given example.
+class BeamHistory(object):
+    """Array-backed record of the hypotheses of one article during beam search.
+
+    Row t holds, for each of the beam_size hypotheses alive after decoder step t, the id and log probability of its latest token,
+    and a backpointer to the slot of the hypothesis it extends at step t-1.
+    Attention distributions and generation probabilities are only recorded if keep_attn_dists is True.
+    A Hypothesis is only rebuilt, by following the backpointers, once beam search has finished.
+    """
+
+    def __init__(self, beam_size, max_dec_steps, keep_attn_dists=False, attn_length=0):
+        self.tokens = np.zeros([max_dec_steps, beam_size], dtype=np.int64)
+        self.log_probs = np.zeros([max_dec_steps, beam_size], dtype=np.float32)
+        self.parents = np.zeros([max_dec_steps, beam_size], dtype=np.int32)
+        self.attn_dists = None
+        self.p_gens = None
+        if keep_attn_dists:
+            self.attn_dists = np.zeros([max_dec_steps, beam_size, attn_length], dtype=np.float32)
+            self.p_gens = np.zeros([max_dec_steps, beam_size], dtype=np.float32)
+
+    def add_step(self, step, parents, tokens, log_probs, attn_dists=None, p_gens=None):
+        """Record the beam_size hypotheses alive after this step, as extensions of the given parent slots of the previous step.
+
+        Args:
+          step: Integer. The decoder step.
+          parents: Numpy array of shape (beam_size). The slot of the parent of each hypothesis.
+          tokens: Numpy array of shape (beam_size). The latest token of each hypothesis.
+          log_probs: Numpy array of shape (beam_size). The log probability of the latest token of each hypothesis.
+          attn_dists: Optional numpy array of shape (beam_size, attn_length). The latest attention distributions.
+          p_gens: Optional numpy array of shape (beam_size). The latest generation probabilities.
+        """
+        self.tokens[step] = tokens
+        self.log_probs[step] = log_probs
+        self.parents[step] = parents
+        if self.attn_dists is not None and attn_dists is not None:
+            self.attn_dists[step] = attn_dists
+        if self.p_gens is not None and p_gens is not None:
+            self.p_gens[step] = p_gens
+
+    def hypothesis(self, start_id, step, slot, last=None):
+        """Rebuild the hypothesis in the given slot after the given step (-1 for the initial hypothesis).
+
+        Args:
+          start_id: id of the [START] token
+          step: Integer. The last recorded step of the hypothesis.
+          slot: Integer. The slot of the hypothesis at that step.
+          last: Optional tuple (token, log_prob, attn_dist, p_gen) of a final token, e.g. [STOP], that was not recorded.
+
+        Returns:
+          Hypothesis object
+        """
+        slots = np.zeros([step + 1], dtype=np.int32)
+        for t in range(step, -1, -1):  # follow the backpointers
+            slots[t] = slot
+            slot = self.parents[t, slot]
+        steps = np.arange(step + 1)
+        tokens = [int(t) for t in self.tokens[steps, slots]]
+        log_probs = [float(p) for p in self.log_probs[steps, slots]]
+        attn_dists = [] if self.attn_dists is None else list(self.attn_dists[steps, slots])
+        p_gens = [] if self.p_gens is None else [float(p) for p in self.p_gens[steps, slots]]
+        if last is not None:
+            token, log_prob, attn_dist, p_gen = last
+            tokens.append(int(token))
+            log_probs.append(float(log_prob))
+            if self.attn_dists is not None and attn_dist is not None:
+                attn_dists.append(np.asarray(attn_dist))
+            if self.p_gens is not None and p_gen is not None:
+                p_gens.append(float(np.squeeze(p_gen)))
+        return Hypothesis(tokens=[start_id] + tokens,
+                          log_probs=[0.0] + log_probs,
+                          state=None,
+                          attn_dists=attn_dists,
+                          p_gens=p_gens,
+                          coverage=None)
+
+
+def run_beam_search(sess, model, vocab, batch, beam_size, min_dec_steps, max_dec_steps, keep_attn_dists=False,
+                    early_stop=False, prune_relative=0.0, prune_absolute=0.0, stats=None):
+    """Performs beam search decoding on the articles in the given batch.
+
+    Each article is repeated beam_size times in consecutive rows of the batch,
+    so that one decoder step extends the hypotheses of all the articles at once.
 
     Args:
       :param sess: a tf.Session
       :param model: a seq2seq model
       :param vocab: Vocabulary object
-      :param batch: Batch object that is the same example repeated across the batch
+      :param batch: Batch object where each article is repeated beam_size times in consecutive rows
       :param max_dec_steps:
       :param min_dec_steps:
       :param beam_size:
+      :param keep_attn_dists: If True, keep the attention distributions and generation probabilities of the hypotheses.
+      :param early_stop: If True, stop on an article once no live hypothesis can beat its best finished hypothesis.
+      :param prune_relative: If greater than 0, prune hypotheses whose probability is less than this fraction
+        of the probability of the best hypothesis in the beam.
+      :param prune_absolute: If greater than 0, prune hypotheses whose log probability is more than this much lower
+        than the log probability of the best hypothesis in the beam.
+      :param stats: Optional collections.Counter, to which the numbers of articles, decoder steps run
+        and decoder steps saved (by settling articles before max_dec_steps) are added, see add_beam_search_stats.
 
     Returns:
-      best_hyp: Hypothesis object; the best hypothesis found by beam search.
+      best_hyps: List of Hypothesis objects, one for each article in the batch; the best hypothesis found by beam search.
     """
-    # Run the encoder to get the encoder hidden states and decoder initial state
-    enc_states, dec_in_state = model.run_encoder(sess, batch)
-    # dec_in_state is a LSTMStateTuple
-    # enc_states has shape [batch_size, <=max_enc_steps, 2*hidden_dim].
-
-    # Initialize beam_size-many hyptheses
-    hyps = [Hypothesis(tokens=[vocab.word2id(data.START_DECODING)],
-                       log_probs=[0.0],
-                       state=dec_in_state,
-                       attn_dists=[],
-                       p_gens=[],
-                       coverage=np.zeros([batch.enc_batch.shape[1]])  # zero vector of length attention_length
-                       ) for _ in range(beam_size)]
-    results = []  # this will contain finished hypotheses (those that have emitted the [STOP] token)
+    # Run the encoder to get the encoder hidden states and decoder initial state of each article
+    enc_states, enc_features, dec_in_states = model.run_encoder(sess, batch)
+    # dec_in_states is a list of LSTMStateTuple
+    # enc_states has shape [num_articles, <=max_enc_steps, 2*hidden_dim].
+    # enc_features has shape [num_articles, <=max_enc_steps, 1, 2*hidden_dim].
+    num_articles = len(dec_in_states)
+    attn_length = batch.enc_batch.shape[1]
+    start_id = vocab.word2id(data.START_DECODING)
+    unk_id = vocab.word2id(data.UNKNOWN_TOKEN)
+    stop_id = vocab.word2id(data.STOP_DECODING)
+
+    histories = [BeamHistory(beam_size, max_dec_steps, keep_attn_dists, attn_length) for _ in range(num_articles)]
+    # The beam_size hypotheses alive in each article: the sums of their log probabilities, their latest tokens,
+    # decoder states and coverage vectors. Initially there is only the initial hypothesis, in slot 0 of each article;
+    # the other slots score -inf so that none of their extensions are selected on the first step.
+    scores = np.full([num_articles, beam_size], -np.inf)
+    scores[:, 0] = 0.0
+    latest_tokens = np.full([num_articles, beam_size], start_id, dtype=np.int64)
+    states = [s for dec_in_state in dec_in_states for s in [dec_in_state] * beam_size]
+    coverages = [np.zeros([attn_length]) for _ in range(num_articles * beam_size)]
+    # for each article, this will contain finished hypotheses (those that have emitted the [STOP] token)
+    # as tuples (avg_log_prob, step, parent slot, log_prob, attn_dist, p_gen); attn_dist and p_gen are None
+    # unless keep_attn_dists
+    results = [[] for _ in range(num_articles)]
+    num_results = np.zeros([num_articles], dtype=np.int64)
+    # articles that need no more decoder steps, and the number of steps each of them took
+    done = np.zeros([num_articles], dtype=bool)
+    settled_steps = np.zeros([num_articles], dtype=np.int64)
 
     steps = 0
-    while steps < max_dec_steps and len(results) < beam_size:
-        latest_tokens = [h.latest_token for h in hyps]  # latest token produced by each hypothesis
+    while steps < max_dec_steps and not np.all(done):
+        # Articles that are already done keep feeding their last hypotheses; their outputs are ignored.
         # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
-        latest_tokens = [t if t in range(vocab.size()) else vocab.word2id(data.UNKNOWN_TOKEN) for t in
-                         latest_tokens]
-        states = [h.state for h in hyps]  # list of current decoder states of the hypotheses
-        prev_coverage = [h.coverage for h in hyps]  # list of coverage vectors (or None)
+        tokens = np.where(latest_tokens < vocab.size(), latest_tokens, unk_id).ravel()
 
         # Run one step of the decoder to get the new info
         (topk_ids, topk_log_probs, new_states, attn_dists, p_gens, new_coverage) = model.decode_onestep(
             sess=sess,
             batch=batch,
-            latest_tokens=latest_tokens,
+            latest_tokens=tokens,
             enc_states=enc_states,
+            enc_features=enc_features,
             dec_init_states=states,
-            prev_coverage=prev_coverage
+            prev_coverage=coverages
         )
 
-        # Extend each hypothesis and collect them all in all_hyps
-        all_hyps = []
-        # On the first step, we only had one original hypothesis (the initial hypothesis).
-        # On subsequent steps, all original hypotheses are distinct.
-        num_orig_hyps = 1 if steps == 0 else len(hyps)
-        for i in range(num_orig_hyps):
-            # take the ith hypothesis and new decoder state info
-            h, new_state, attn_dist, p_gen, new_coverage_i = hyps[i], new_states[i], attn_dists[i], p_gens[i], \
-                                                             new_coverage[i]
-            for j in range(beam_size * 2):  # for each of the top 2*beam_size hyps:
-                # Extend the ith hypothesis with the jth option
-                new_hyp = h.extend(token=topk_ids[i, j],
-                                   log_prob=topk_log_probs[i, j],
-                                   state=new_state,
-                                   attn_dist=attn_dist,
-                                   p_gen=p_gen,
-                                   coverage=new_coverage_i)
-                all_hyps.append(new_hyp)
-
-        # Filter and collect any hypotheses that have produced the end token.
-        hyps = []  # will contain hypotheses for the next step
-        for h in sort_hyps(all_hyps):  # in order of most likely h
-            if h.latest_token == vocab.word2id(data.STOP_DECODING):  # if stop token is reached...
-                # If this hypothesis is sufficiently long, put in results. Otherwise discard.
-                if steps >= min_dec_steps:
-                    results.append(h)
-            else:  # hasn't reached stop token, so continue to extend this hypothesis
-                hyps.append(h)
-            if len(hyps) == beam_size or len(results) == beam_size:
-                # Once we've collected beam_size-many hypotheses for the next step,
-                # or beam_size-many complete hypotheses, stop.
-                break
+        # Score the 2*beam_size extensions of each hypothesis, and sort the candidates of each article by score.
+        # Hypotheses all have the same length, so this is also the order of average log probability.
+        num_cands = beam_size * beam_size * 2
+        cand_scores = (np.expand_dims(scores, 2) +
+                       np.reshape(topk_log_probs, [num_articles, beam_size, beam_size * 2])).reshape([num_articles, -1])
+        order = np.argsort(-cand_scores, axis=1, kind='stable')
+        article_idx = np.expand_dims(np.arange(num_articles), 1)
+        cand_ids = np.reshape(topk_ids, [num_articles, num_cands])[article_idx, order]
+        is_stop = cand_ids == stop_id
+        # A stopped hypothesis is a result if it is sufficiently long; otherwise it is discarded.
+        # Extensions of pruned hypotheses (with score -inf) are never results.
+        is_result = is_stop & (steps >= min_dec_steps) & np.isfinite(cand_scores[article_idx, order])
+        # Take candidates in order until we have beam_size hypotheses for the next step, or beam_size results
+        num_live = np.cumsum(~is_stop, axis=1)
+        num_finished = np.cumsum(is_result, axis=1) + np.expand_dims(num_results, 1)
+        cutoff = np.argmax((num_live >= beam_size) | (num_finished >= beam_size), axis=1)
+        taken = np.arange(num_cands) <= np.expand_dims(cutoff, 1)
+
+        next_states, next_coverages = [], []
+        for a in range(num_articles):
+            first_row = a * beam_size
+            if not done[a]:
+                # candidate c extends the ith hypothesis of the article with the jth of its top 2*beam_size options
+                for c in order[a][taken[a] & is_result[a]]:
+                    i, j = divmod(int(c), beam_size * 2)
+                    row = first_row + i
+                    results[a].append((cand_scores[a, c] / (steps + 2), steps, i, topk_log_probs[row, j],
+                                       attn_dists[row] if keep_attn_dists else None,
+                                       p_gens[row] if keep_attn_dists else None))
+                num_results[a] = len(results[a])
+                if num_results[a] >= beam_size:
+                    done[a] = True
+                    settled_steps[a] = steps + 1
+            if done[a]:
+                # Keep the previous hypotheses of a finished article, so that its rows can still be fed
+                next_states.extend(states[first_row:first_row + beam_size])
+                next_coverages.extend(coverages[first_row:first_row + beam_size])
+                continue
+            live = order[a][taken[a] & ~is_stop[a]]
+            parents, options = np.divmod(live, beam_size * 2)
+            rows = first_row + parents
+            live_attn_dists, live_p_gens = None, None
+            if keep_attn_dists and attn_dists[0] is not None:
+                live_attn_dists = np.asarray([attn_dists[r] for r in rows])
+            if keep_attn_dists and p_gens[0] is not None:
+                live_p_gens = np.asarray([np.squeeze(p_gens[r]) for r in rows])
+            histories[a].add_step(steps, parents, topk_ids[rows, options], topk_log_probs[rows, options],
+                                  live_attn_dists, live_p_gens)
+            scores[a] = cand_scores[a, live]
+            latest_tokens[a] = topk_ids[rows, options]
+            next_states.extend(new_states[r] for r in rows)
+            next_coverages.extend(new_coverage[r] for r in rows)
+
+            # Prune the hypotheses that score too far below the best one; they are kept in the beam with score -inf
+            best_score = np.max(scores[a])
+            if prune_relative > 0.0:
+                scores[a][scores[a] < best_score + np.log(prune_relative)] = -np.inf
+            if prune_absolute > 0.0:
+                scores[a][scores[a] < best_score - prune_absolute] = -np.inf
+            # Log probabilities are negative, so the best average log prob a live hypothesis can reach is its score
+            # divided by the longest possible length. If that cannot beat the best result, the article is settled.
+            if early_stop and len(results[a]) != 0 and \
+                    best_score / (max_dec_steps + 1) <= max(r[0] for r in results[a]):
+                done[a] = True
+                settled_steps[a] = steps + 1
+        states = next_states
+        coverages = next_coverages
 
         steps += 1
 
-    # At this point, either we've got beam_size results, or we've reached maximum decoder steps
-    # if we don't have any complete results, add all current hypotheses (incomplete summaries) to results
-    if len(results) == 0:
-        results = hyps
+    settled_steps[~done] = steps
+    log.debug('Beam search ran %i decoder steps for %i articles. Steps saved per article: %s' % (
+        steps, num_articles, (max_dec_steps - settled_steps).tolist()))
+    add_beam_search_stats(stats, num_articles, steps, int(np.sum(max_dec_steps - settled_steps)))
+
+    best_hyps = []
+    for a in range(num_articles):
+        # At this point, either we've got beam_size results, or we've reached maximum decoder steps
+        if len(results[a]) != 0:
+            # Return the finished hypothesis with highest average log prob
+            _, step, parent, log_prob, attn_dist, p_gen = max(results[a], key=lambda r: r[0])
+            best_hyps.append(histories[a].hypothesis(start_id, step - 1, parent, (stop_id, log_prob, attn_dist, p_gen)))
+        else:
+            # if we don't have any complete results, return the current hypothesis (incomplete summary) with highest
+            # log prob. These all have the same length, so this also has the highest average log prob.
+            best_hyps.append(histories[a].hypothesis(start_id, steps - 1, int(np.argmax(scores[a]))))
+    return best_hyps
+
+
+def add_beam_search_stats(stats, num_articles, steps, steps_saved):
+    """Add the numbers of a beam search over a batch to stats (a collections.Counter), if it is not None.
 
-    # Sort hypotheses by average log probability
-    hyps_sorted = sort_hyps(results)
+    Args:
+      num_articles: The number of articles of the batch.
+      steps: The number of decoder steps that were run for the batch.
+      steps_saved: The number of decoder steps below max_dec_steps at which the articles were settled, summed over the articles.
+    """
+    if stats is not None:
+        stats['articles'] += num_articles
+        stats['steps'] += steps
+        stats['steps_saved'] += steps_saved
 
-    # Return the hypothesis with highest average log prob
-    return hyps_sorted[0]
 
+def run_graph_beam_search(sess, model, vocab, batch, max_dec_steps, stats=None):
+    """Performs beam search decoding on the articles in the given batch with a single session run,
+    using the beam search loop in the graph (see SummarizationModel.run_graph_beam_search).
 
-def sort_hyps(hyps):
-    """Return a list of Hypothesis objects, sorted by descending average log probability"""
-    return sorted(hyps, key=lambda h: h.avg_log_prob, reverse=True)
+    Args:
+      :param sess: a tf.Session
+      :param model: a seq2seq model built with hps.graph_beam_search
+      :param vocab: Vocabulary object
+      :param batch: Batch object where each article is repeated beam_size times in consecutive rows
+      :param max_dec_steps:
+      :param stats: Optional collections.Counter of beam search statistics, see run_beam_search.
+
+    Returns:
+      best_hyps: List of Hypothesis objects, one for each article in the batch; the best hypothesis found by beam search.
+    """
+    results = model.run_graph_beam_search(sess, batch)
+    # the loop runs until every article of the batch is settled, so they all save the same steps
+    add_beam_search_stats(stats, len(results['lengths']), int(results['steps']),
+                          len(results['lengths']) * (max_dec_steps - int(results['steps'])))
+    start_id = vocab.word2id(data.START_DECODING)
+    best_hyps = []
+    for i, length in enumerate(results['lengths']):
+        p_gens = results['p_gens'][i, :length].tolist() if 'p_gens' in results else [None for _ in range(length)]
+        best_hyps.append(Hypothesis(tokens=[start_id] + results['tokens'][i, :length].tolist(),
+                                    log_probs=[0.0] + results['log_probs'][i, :length].tolist(),
+                                    state=None,
+                                    attn_dists=list(results['attn_dists'][i, :length]),
+                                    p_gens=p_gens,
+                                    coverage=None))
+    return best_hyps
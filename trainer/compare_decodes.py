@@ -0,0 +1,66 @@
+"""
+Script that checks the accuracy of decoding with a vocabulary shortlist (see --shortlist_size),
+by comparing the decoded summaries of two single_pass decodes of the same data: one with the whole vocabulary, one with the shortlist.
+Run like this:
+  python -m trainer.compare_decodes --full_dir <decode dir> --shortlist_dir <decode dir with shortlist>
+"""
+
+import argparse
+import collections
+import os
+import tensorflow as tf
+import tensorflow.logging as log
+
+
+def read_decoded(decode_dir):
+    """Read the decoded summaries of a single_pass decode dir, as a dict from example index to list of tokens"""
+    decoded = {}
+    for path in tf.gfile.Glob(os.path.join(decode_dir, 'decoded', '*_decoded.txt')):
+        index = int(os.path.basename(path).split('_')[0])
+        with tf.gfile.GFile(path) as f:
+            decoded[index] = f.read().split()
+    return decoded
+
+
+def token_f1(reference, candidate):
+    """F1 of the tokens of candidate against the tokens of reference, counted as bags of words"""
+    overlap = sum((collections.Counter(reference) & collections.Counter(candidate)).values())
+    if overlap == 0:
+        return 1.0 if not reference and not candidate else 0.0
+    precision = overlap / len(candidate)
+    recall = overlap / len(reference)
+    return 2 * precision * recall / (precision + recall)
+
+
+def __main(full_dir, shortlist_dir):
+    log.set_verbosity(log.INFO)
+    full = read_decoded(full_dir)
+    shortlist = read_decoded(shortlist_dir)
+    indices = sorted(set(full) & set(shortlist))
+    if not indices:
+        raise ValueError('No decoded summaries in common between {} and {}'.format(full_dir, shortlist_dir))
+    if len(indices) < max(len(full), len(shortlist)):
+        log.warning('Only comparing the {} summaries decoded in both dirs'.format(len(indices)))
+
+    exact = sum(full[i] == shortlist[i] for i in indices)
+    f1 = sum(token_f1(full[i], shortlist[i]) for i in indices) / len(indices)
+    full_tokens = sum(len(full[i]) for i in indices)
+    shortlist_tokens = sum(len(shortlist[i]) for i in indices)
+    log.info('summaries={} identical={:.4f} token_f1={:.4f} length_ratio={:.4f}'.format(
+        len(indices), exact / len(indices), f1, shortlist_tokens / max(full_tokens, 1)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--full_dir',
+        type=str,
+        required=True,
+        help='single_pass decode dir of the decode with the whole vocabulary')
+    parser.add_argument(
+        '--shortlist_dir',
+        type=str,
+        required=True,
+        help='single_pass decode dir of the decode with --shortlist_size')
+    args = parser.parse_args()
+    __main(**vars(args))
@@ -17,9 +17,14 @@
 """This file contains code to read the train/eval/test data from file and process it, and read the vocab data from file and process it"""
 
 from tensorflow.gfile import Glob
+import hashlib
+import mmap
 import random
 import struct
+import sys
 import csv
+import zlib
+import numpy as np
 from tensorflow.core.example import example_pb2
 from tensorflow import logging as log
 from tensorflow.python.lib.io import file_io
@@ -35,6 +40,17 @@ STOP_DECODING = '[STOP]'  # This has a vocab id, which is used at the end of unt
 
 
 # Note: none of <s>, </s>, [PAD], [UNK], [START], [STOP] should appear in the vocab file.
+RESERVED_WORDS = frozenset([SENTENCE_START, SENTENCE_END, UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING])
+
+# Compiled vocab file format (see compile_vocab):
+# header of magic, number of words (uint32), hash index size (uint32), string table size in bytes (uint64),
+# version (40 ascii bytes); then the string table offsets (uint64, number of words + 1), the hash index (int32)
+# and the string table (the utf-8 words in id order).
+# The words are kept in id order rather than sorted: id2word then reads the word of an id from its offsets directly,
+# and word2id finds the id of a word from its crc32 in the open-addressing hash index, without a binary search
+# over a sorted table and a second table from sorted position to id.
+COMPILED_VOCAB_MAGIC = b'PGVOCAB1'
+COMPILED_VOCAB_HEADER = struct.Struct('<8sIIQ40s')
 
 
 class Vocab(object):
@@ -47,13 +63,13 @@ class Vocab(object):
           vocab_file: path to the vocab file, which is assumed to contain "<word> <frequency>" on each line, sorted with most frequent word first. This code doesn't actually use the frequencies, though.
           max_size: integer. The maximum size of the resulting Vocabulary."""
         self._word_to_id = {}
-        self._id_to_word = {}
+        self._id_to_word = []
         self._count = 0  # keeps track of total number of words in the Vocab
 
         # [UNK], [PAD], [START] and [STOP] get the ids 0,1,2,3.
         for w in [UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING]:
             self._word_to_id[w] = self._count
-            self._id_to_word[self._count] = w
+            self._id_to_word.append(w)
             self._count += 1
 
         # Read the vocab file and add words up to max_size
@@ -64,13 +80,13 @@ class Vocab(object):
                     log.warn('Warning: incorrectly formatted line in vocabulary file: %s\n' % line)
                     continue
                 w = pieces[0]
-                if w in [SENTENCE_START, SENTENCE_END, UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING]:
+                if w in RESERVED_WORDS:
                     raise Exception(
                         '<s>, </s>, [UNK], [PAD], [START] and [STOP] shouldn\'t be in the vocab file, but %s is' % w)
                 if w in self._word_to_id:
                     raise Exception('Duplicated word in vocabulary file: %s' % w)
                 self._word_to_id[w] = self._count
-                self._id_to_word[self._count] = w
+                self._id_to_word.append(w)
                 self._count += 1
                 if max_size != 0 and self._count >= max_size:
                     log.info("max_size of vocab was specified as %i; we now have %i words. Stopping reading." % (
@@ -88,7 +104,7 @@ class Vocab(object):
 
     def id2word(self, word_id):
         """Returns the word (string) corresponding to an id (integer)."""
-        if word_id not in self._id_to_word:
+        if not 0 <= word_id < self._count:
             raise ValueError('Id not found in vocab: %d' % word_id)
         return self._id_to_word[word_id]
 
@@ -96,6 +112,15 @@ class Vocab(object):
         """Returns the total size of the vocabulary"""
         return self._count
 
+    def version(self):
+        """Returns a hash (string) of the words of the vocabulary in id order.
+
+        Data that was encoded as ids with one vocabulary can only be used with a vocabulary of the same version."""
+        h = hashlib.sha1()
+        for i in range(self._count):
+            h.update(self.id2word(i).encode('utf-8') + b'\n')
+        return h.hexdigest()
+
     def write_metadata(self, fpath):
         """Writes metadata file for Tensorboard word embedding visualizer as described here:
           https://www.tensorflow.org/get_started/embedding_viz
@@ -108,7 +133,107 @@ class Vocab(object):
             fieldnames = ['word']
             writer = csv.DictWriter(f, delimiter="\t", fieldnames=fieldnames)
             for i in range(self.size()):
-                writer.writerow({"word": self._id_to_word[i]})
+                writer.writerow({"word": self.id2word(i)})
+
+
+class CompiledVocab(Vocab):
+    """Vocabulary read from a file written by compile_vocab.
+
+    The file is memory-mapped read-only, so loading it does not depend on the size of the vocabulary,
+    and processes that load the same file share its memory."""
+
+    def __init__(self, compiled_file):
+        """Args:
+          compiled_file: path to a local file written by compile_vocab"""
+        with open(compiled_file, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, index_size, table_size, version = COMPILED_VOCAB_HEADER.unpack_from(self._buf, 0)
+        if magic != COMPILED_VOCAB_MAGIC:
+            raise ValueError('Not a compiled vocab file: %s' % compiled_file)
+        self._version = version.decode('ascii')
+        offset = COMPILED_VOCAB_HEADER.size
+        # word2id runs for every token of every example, so the offsets and the index are read as Python ints:
+        # memoryviews of the mmap on little-endian hosts, as the file is, and lists otherwise
+        self._offsets = self._ints(offset, 'Q', '<u8', self._count + 1)
+        offset += 8 * (self._count + 1)
+        self._index = self._ints(offset, 'i', '<i4', index_size)
+        self._index_mask = index_size - 1
+        self._table_start = offset + 4 * index_size
+        self._unk_id = self.word2id(UNKNOWN_TOKEN)
+        log.info("Loaded compiled vocabulary of %i total words from %s" % (self._count, compiled_file))
+
+    def _ints(self, offset, format, dtype, count):
+        if sys.byteorder == 'little':
+            return memoryview(self._buf)[offset:offset + struct.calcsize(format) * count].cast(format)
+        return np.frombuffer(self._buf, dtype=dtype, count=count, offset=offset).tolist()
+
+    def _word_bytes(self, word_id):
+        return self._buf[self._table_start + self._offsets[word_id]:self._table_start + self._offsets[word_id + 1]]
+
+    def word2id(self, word):
+        """Returns the id (integer) of a word (string). Returns [UNK] id if word is OOV."""
+        key = word.encode('utf-8')
+        slot = zlib.crc32(key) & self._index_mask
+        while True:  # linear probing
+            word_id = self._index[slot]
+            if word_id < 0:
+                return self._unk_id
+            if self._word_bytes(word_id) == key:
+                return word_id
+            slot = (slot + 1) & self._index_mask
+
+    def id2word(self, word_id):
+        """Returns the word (string) corresponding to an id (integer)."""
+        if not 0 <= word_id < self._count:
+            raise ValueError('Id not found in vocab: %d' % word_id)
+        return self._word_bytes(word_id).decode('utf-8')
+
+    def version(self):
+        return self._version
+
+
+def compile_vocab(vocab, compiled_file):
+    """Writes the vocab in the compiled format that is read by CompiledVocab.
+
+    Args:
+      vocab: Vocabulary object
+      compiled_file: path to the local file to write
+    """
+    words = [vocab.id2word(i).encode('utf-8') for i in range(vocab.size())]
+    offsets = np.zeros([len(words) + 1], dtype='<u8')
+    offsets[1:] = np.cumsum([len(w) for w in words])
+    # hash index: a power of two at least twice the number of words, so that probe sequences are short
+    index_size = 1
+    while index_size < 2 * len(words):
+        index_size *= 2
+    index = np.full([index_size], -1, dtype='<i4')
+    for word_id, w in enumerate(words):
+        slot = zlib.crc32(w) & (index_size - 1)
+        while index[slot] >= 0:
+            slot = (slot + 1) & (index_size - 1)
+        index[slot] = word_id
+    with open(compiled_file, 'wb') as f:
+        f.write(COMPILED_VOCAB_HEADER.pack(COMPILED_VOCAB_MAGIC, len(words), index_size, int(offsets[-1]),
+                                           vocab.version().encode('ascii')))
+        f.write(offsets.tobytes())
+        f.write(index.tobytes())
+        f.write(b''.join(words))
+    log.info("Wrote compiled vocabulary of %i words to %s" % (len(words), compiled_file))
+
+
+def load_vocab(vocab_file, max_size):
+    """Returns a CompiledVocab if vocab_file is a compiled vocab file, otherwise a Vocab of the text vocab file.
+
+    A compiled vocab already has its size, so max_size must be 0 or at least that size."""
+    with file_io.FileIO(vocab_file, 'rb') as f:
+        magic = f.read(len(COMPILED_VOCAB_MAGIC))
+    if magic != COMPILED_VOCAB_MAGIC:
+        return Vocab(vocab_file, max_size)
+    vocab = CompiledVocab(vocab_file)
+    if max_size != 0 and max_size < vocab.size():
+        raise ValueError('Compiled vocab %s has %i words, but vocab size %i was asked for' % (
+            vocab_file, vocab.size(), max_size))
+    return vocab
 
 
 def example_generator(data_path, single_pass):
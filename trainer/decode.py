@@ -18,6 +18,7 @@
 including running ROUGE evaluation.
 """
 
+import collections
 import os
 import time
 import tensorflow as tf
@@ -67,6 +68,7 @@ class BeamSearchDecoder(object):
         self._saver = tf.train.Saver()  # we use this to load checkpoints for decoding
         self._sess = tf.Session(config=conf.session_config)
         self._conf = conf
+        self._beam_search_stats = collections.Counter()  # see beam_search.run_beam_search
 
         # Load an initial checkpoint to use for decoding
         ckpt_path = util.load_ckpt(self._saver, self._sess, log_root=self._conf.model_dir)
@@ -80,7 +82,8 @@ class BeamSearchDecoder(object):
                 beam_size=self._beam_size,
                 max_enc_steps=hps.max_enc_steps,
                 min_dec_steps=hps.min_dec_steps,
-                max_dec_steps=hps.max_dec_steps
+                max_dec_steps=hps.max_dec_steps,
+                shortlist_size=hps.shortlist_size
             )
             self._decode_dir = os.path.join(self._conf.model_dir, dir_name)
             if os.path.exists(self._decode_dir):
@@ -107,64 +110,83 @@ class BeamSearchDecoder(object):
         t0 = time.time()
         counter = 0
         while True:
-            batch = self._batcher.next_batch()  # 1 example repeated across batch
+            batch = self._batcher.next_batch()  # each article repeated beam_size times across batch
             if batch is None:  # finished decoding dataset in single_pass mode
                 assert self._single_pass, "Dataset exhausted, but we are not in single_pass mode"
                 log.info("Decoder has finished reading dataset for single_pass.")
+                self.log_beam_search_stats()
                 log.info("Output has been saved in %s and %s. Now starting ROUGE eval...", self._rouge_ref_dir,
                          self._rouge_dec_dir)
                 results_dict = rouge_eval(self._rouge_ref_dir, self._rouge_dec_dir)
                 rouge_log(results_dict, self._decode_dir)
                 return
 
-            original_article = batch.original_articles[0]  # string
-            original_abstract = batch.original_abstracts[0]  # string
-            original_abstract_sents = batch.original_abstracts_sents[0]  # list of strings
-
-            article_withunks = data.show_art_oovs(original_article, self._vocab)  # string
-            abstract_withunks = data.show_abs_oovs(original_abstract, self._vocab,
-                                                   (batch.art_oovs[0] if self._pointer_gen else None))  # string
-
-            # Run beam search to get best Hypothesis
-            best_hyp = beam_search.run_beam_search(
-                self._sess,
-                self._model,
-                self._vocab,
-                batch=batch,
-                beam_size=self._beam_size,
-                min_dec_steps=self._hps.min_dec_steps,
-                max_dec_steps=self._hps.max_dec_steps
-            )
-
-            # Extract the output ids from the hypothesis and convert back to words
-            output_ids = [int(t) for t in best_hyp.tokens[1:]]
-            decoded_words = data.outputids2words(output_ids, self._vocab,
-                                                 (batch.art_oovs[0] if self._pointer_gen else None))
-
-            # Remove the [STOP] token from decoded_words, if necessary
-            try:
-                fst_stop_idx = decoded_words.index(data.STOP_DECODING)  # index of the (first) [STOP] symbol
-                decoded_words = decoded_words[:fst_stop_idx]
-            except ValueError:
-                decoded_words = decoded_words
-            decoded_output = ' '.join(decoded_words)  # single string
-
-            if self._single_pass:
-                self.write_for_rouge(original_abstract_sents, decoded_words,
-                                     counter)  # write ref summary and decoded summary to file, to eval with pyrouge later
-                counter += 1  # this is how many examples we've decoded
+            # Run beam search to get best Hypothesis for each article in the batch
+            if self._hps.graph_beam_search:
+                best_hyps = beam_search.run_graph_beam_search(self._sess, self._model, self._vocab, batch=batch,
+                                                              max_dec_steps=self._hps.max_dec_steps,
+                                                              stats=self._beam_search_stats)
             else:
-                print_results(article_withunks, abstract_withunks, decoded_output)  # log output to screen
-
+                best_hyps = beam_search.run_beam_search(
+                    self._sess,
+                    self._model,
+                    self._vocab,
+                    batch=batch,
+                    beam_size=self._beam_size,
+                    min_dec_steps=self._hps.min_dec_steps,
+                    max_dec_steps=self._hps.max_dec_steps,
+                    early_stop=self._hps.beam_early_stop,
+                    prune_relative=self._hps.beam_prune_relative,
+                    prune_absolute=self._hps.beam_prune_absolute,
+                    stats=self._beam_search_stats
+                )
+
+            for i in range(batch.num_articles):
+                row = i * self._beam_size  # first row of the ith article in the batch
+                original_article = batch.original_articles[row]  # string
+                original_abstract = batch.original_abstracts[row]  # string
+                original_abstract_sents = batch.original_abstracts_sents[row]  # list of strings
+                art_oovs = batch.art_oovs[row] if self._pointer_gen else None
+
+                # Extract the output ids from the hypothesis and convert back to words
+                output_ids = [int(t) for t in best_hyps[i].tokens[1:]]
+                decoded_words = data.outputids2words(output_ids, self._vocab, art_oovs)
+
+                # Remove the [STOP] token from decoded_words, if necessary
+                try:
+                    fst_stop_idx = decoded_words.index(data.STOP_DECODING)  # index of the (first) [STOP] symbol
+                    decoded_words = decoded_words[:fst_stop_idx]
+                except ValueError:
+                    decoded_words = decoded_words
+                decoded_output = ' '.join(decoded_words)  # single string
+
+                if self._single_pass:
+                    self.write_for_rouge(original_abstract_sents, decoded_words,
+                                         counter)  # write ref summary and decoded summary to file, to eval with pyrouge later
+                    counter += 1  # this is how many examples we've decoded
+                else:
+                    article_withunks = data.show_art_oovs(original_article, self._vocab)  # string
+                    abstract_withunks = data.show_abs_oovs(original_abstract, self._vocab, art_oovs)  # string
+                    print_results(article_withunks, abstract_withunks, decoded_output)  # log output to screen
+
+            if not self._single_pass:
                 # Check if SECS_UNTIL_NEW_CKPT has elapsed; if so return so we can load a new checkpoint
                 t1 = time.time()
                 if t1 - t0 > SECS_UNTIL_NEW_CKPT:
                     log.info(
                         'We\'ve been decoding with same checkpoint for %i seconds. Time to load new checkpoint',
                         t1 - t0)
+                    self.log_beam_search_stats()
                     _ = util.load_ckpt(self._saver, self._sess, log_root=self._conf.model_dir)
                     t0 = time.time()
 
+    def log_beam_search_stats(self):
+        """Log the decoder steps that beam search ran and saved so far, over all the decoded articles"""
+        stats = self._beam_search_stats
+        log.info('Beam search decoded %i articles in %i decoder steps; %i steps saved (%.2f per article)',
+                 stats['articles'], stats['steps'], stats['steps_saved'],
+                 stats['steps_saved'] / max(stats['articles'], 1))
+
     def write_for_rouge(self, reference_sents, decoded_words, ex_index):
         """Write output to file in correct format for eval with pyrouge. This is called in single_pass mode.
 
@@ -256,7 +278,7 @@ def rouge_log(results_dict, dir_to_write):
         f.write(log_str)
 
 
-def get_decode_dir_name(ckpt_name, data_path, beam_size, max_enc_steps, min_dec_steps, max_dec_steps):
+def get_decode_dir_name(ckpt_name, data_path, beam_size, max_enc_steps, min_dec_steps, max_dec_steps, shortlist_size=0):
     """Make a descriptive name for the decode dir,
     including the name of the checkpoint we use to decode. This is called in single_pass mode."""
 
@@ -270,6 +292,8 @@ def get_decode_dir_name(ckpt_name, data_path, beam_size, max_enc_steps, min_dec_
         raise ValueError("FLAGS.data_path %s should contain one of train, val or test" % data_path)
     dirname = "decode_%s_%imaxenc_%ibeam_%imindec_%imaxdec" % (
         dataset, max_enc_steps, beam_size, min_dec_steps, max_dec_steps)
+    if shortlist_size > 0:
+        dirname += "_%ishortlist" % shortlist_size
     if ckpt_name is not None:
         dirname += "_%s" % ckpt_name
     return dirname
@@ -1,13 +1,34 @@
+import json
 import os
 import random
+from collections import namedtuple
+from multiprocessing import Pool
 
 import en_core_web_sm
+import numpy as np
 import stringx
 import tensorflow as tf
 import tensorflow.logging as log
 from tensorflow.python.lib.io import file_io
+import trainer.batcher as batcher
+import trainer.data as data
 
-nlp = en_core_web_sm.load()
+# Only the tokenizer is used, so skip the pipeline components that tag, parse and recognize entities
+nlp = en_core_web_sm.load(disable=['tagger', 'parser', 'ner'])
+
+# Process pools used by dataset to preprocess text, keyed by number of processes
+__pools = {}
+
+# name of the file that lists the shards of a directory written by ShardWriter
+MANIFEST = 'manifest.json'
+
+# How dataset, model_input_dataset and encoded_dataset read their input:
+# parallel_reads: number of files whose records are interleaved
+# parallel_calls: number of elements parsed and mapped in parallel
+# shuffle_buffer_size: number of records from which each record is drawn when shuffling
+# prefetch_batches: number of batches made ahead of the model step (0 for none)
+InputOptions = namedtuple('InputOptions', ['parallel_reads', 'parallel_calls', 'shuffle_buffer_size', 'prefetch_batches'])
+DEFAULT_INPUT_OPTIONS = InputOptions(parallel_reads=1, parallel_calls=1, shuffle_buffer_size=100, prefetch_batches=0)
 
 # acceptable ways to end a sentence
 END_TOKENS = ['.', '!', '?', '...', "'", "`", '"', ")"]
@@ -52,9 +73,8 @@ def __fix_missing_period(line):
     return line + ' .'
 
 
-def tokenize(s):
+def __doc_tokens(doc):
     res = []
-    doc = nlp(s)
     for token in doc:
         t = token.text.strip().lower()
         if t == '' or __is_stopword(t):
@@ -63,7 +83,11 @@ def tokenize(s):
     return res
 
 
-def preprocess(s):
+def tokenize(s):
+    return __doc_tokens(nlp(s))
+
+
+def __clean(s):
     s = stringx.to_str(s)
     sep = '\n'
     lines = s.split(sep)
@@ -75,7 +99,29 @@ def preprocess(s):
         # because some punctuation falls outside ascii e.g. latex
         line = __fix_missing_period(line)
         ls.append(line)
-    return tokenize(sep.join(ls))
+    return sep.join(ls)
+
+
+def preprocess(s):
+    return tokenize(__clean(s))
+
+
+def preprocess_many(strings, batch_size=64):
+    """Preprocess a list of strings, tokenizing them in batches with nlp.pipe.
+    Returns a list of lists of tokens, one for each string."""
+    docs = nlp.pipe([__clean(s) for s in strings], batch_size=batch_size)
+    return [__doc_tokens(doc) for doc in docs]
+
+
+def _preprocess_chunk(strings):
+    sep = ' '
+    return [stringx.to_bytes(sep.join(tokens)) for tokens in preprocess_many(strings)]
+
+
+def __pool(processes):
+    if processes not in __pools:
+        __pools[processes] = Pool(processes=processes)
+    return __pools[processes]
 
 
 def split_train_val_test(paths, train_size=0.7, test_size=0.1, shuffle=True):
@@ -106,6 +152,142 @@ def article_example(article, abstract):
     }))
 
 
+def encoded_example(article_tokens, abstract_tokens, vocab):
+    """Example of the ids of a preprocessed article and abstract, as read by encoded_dataset.
+
+    Args:
+      article_tokens: list of article tokens (strings), as returned by preprocess
+      abstract_tokens: list of abstract tokens (strings), as returned by preprocess
+      vocab: Vocabulary object. Its version is stored in the example.
+    """
+    sep = ' '
+    abstract_words = sep.join(batcher.split_abstract(sep.join(abstract_tokens))).split()
+    article_ids, article_oovs = data.article2ids(article_tokens, vocab)
+    abstract_ids = data.abstract2ids(abstract_words, vocab, article_oovs)
+    return tf.train.Example(features=tf.train.Features(feature={
+        'article_ids': __int64_feature(article_ids),
+        'abstract_ids': __int64_feature(abstract_ids),
+        'article_oovs': __bytes_feature([stringx.to_bytes(w) for w in article_oovs]),
+        'article_len': __int64_feature(len(article_ids)),
+        'abstract_len': __int64_feature(len(abstract_ids)),
+        'vocab_version': __bytes_feature(stringx.to_bytes(vocab.version()))
+    }))
+
+
+def __parse_encoded_proto(example_proto, vocab_version):
+    features = {
+        'article_ids': tf.VarLenFeature(tf.int64),
+        'abstract_ids': tf.VarLenFeature(tf.int64),
+        'article_oovs': tf.VarLenFeature(tf.string),
+        'article_len': tf.FixedLenFeature((), tf.int64),
+        'abstract_len': tf.FixedLenFeature((), tf.int64),
+        'vocab_version': tf.FixedLenFeature((), tf.string)
+    }
+    parsed = tf.parse_single_example(example_proto, features)
+    check_version = tf.assert_equal(
+        parsed['vocab_version'], vocab_version,
+        message='Data was encoded with a different vocab; run vocab.py again to encode it with this vocab.')
+    with tf.control_dependencies([check_version]):
+        article_oovs = tf.sparse_tensor_to_dense(parsed['article_oovs'], default_value='')
+        return {
+            'article_ids': tf.sparse_tensor_to_dense(parsed['article_ids']),
+            'article_lens': tf.identity(parsed['article_len']),
+            'abstract_ids': tf.sparse_tensor_to_dense(parsed['abstract_ids']),
+            'abstract_lens': tf.identity(parsed['abstract_len']),
+            'article_oovs': article_oovs,
+            'num_article_oovs': tf.size(article_oovs, out_type=tf.int64)
+        }
+
+
+class ShardWriter(object):
+    """Writes records into a directory of shards named <prefix>-00000.tfrecord, <prefix>-00001.tfrecord, ...
+    and on close, a manifest that lists the shards with their number of records and bytes.
+
+    A new shard is started once the current shard has records_per_shard records or bytes_per_shard bytes
+    (0 means no limit). If several writers share a directory, give each a different prefix and
+    write_manifest=False, then write the manifest of all their shards with write_manifest.
+    """
+
+    RECORD_OVERHEAD_BYTES = 16  # length, and checksums of length and data, of each record in a TFRecord file
+
+    def __init__(self, out_dir, prefix, records_per_shard=0, bytes_per_shard=0, write_manifest=True):
+        self._out_dir = out_dir
+        self._write_manifest = write_manifest
+        self._prefix = prefix
+        self._records_per_shard = records_per_shard
+        self._bytes_per_shard = bytes_per_shard
+        self._writer = None
+        self._shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, record):
+        """Write a serialized record (bytes). Returns the name of its shard and its index in the shard."""
+        if self._writer is None or self._is_full():
+            self._next_shard()
+        self._writer.write(record)
+        shard = self._shards[-1]
+        shard['records'] += 1
+        shard['bytes'] += len(record) + self.RECORD_OVERHEAD_BYTES
+        return shard['name'], shard['records'] - 1
+
+    def close(self):
+        """Close the last shard and write the manifest. Returns the list of shards written."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._write_manifest:
+            write_manifest(self._out_dir, self._shards)
+        return self._shards
+
+    def _is_full(self):
+        shard = self._shards[-1]
+        if self._records_per_shard > 0 and shard['records'] >= self._records_per_shard:
+            return True
+        return self._bytes_per_shard > 0 and shard['bytes'] >= self._bytes_per_shard
+
+    def _next_shard(self):
+        if self._writer is not None:
+            self._writer.close()
+        name = '%s-%05d.tfrecord' % (self._prefix, len(self._shards))
+        self._writer = tf.python_io.TFRecordWriter(os.path.join(self._out_dir, name))
+        self._shards.append({'name': name, 'records': 0, 'bytes': 0})
+
+
+def write_manifest(out_dir, shards):
+    """Write the manifest of the shards (dicts of name, records and bytes, as written by ShardWriter) in out_dir"""
+    manifest = {
+        'shards': shards,
+        'records': sum(shard['records'] for shard in shards)
+    }
+    _path = os.path.join(out_dir, MANIFEST)
+    with file_io.FileIO(_path, 'w') as f:
+        f.write(json.dumps(manifest, indent=2, sort_keys=True))
+    log.info('Wrote %i records in %i shards to [%s]', manifest['records'], len(shards), repr(out_dir))
+
+
+def read_manifest(data_path):
+    """The shards listed in the manifest of the data_path directory, or None if it has no manifest"""
+    manifest_path = os.path.join(data_path, MANIFEST)
+    if not file_io.file_exists(manifest_path):
+        return None
+    return json.loads(file_io.read_file_to_string(manifest_path))['shards']
+
+
+def data_files(data_path):
+    """Paths of the tfrecord files in the data_path directory: the shards in its manifest if it has one,
+    otherwise all its .tfrecord files, sorted by name."""
+    shards = read_manifest(data_path)
+    if shards is not None:
+        return [os.path.join(data_path, shard['name']) for shard in shards]
+    names = sorted(name for name in file_io.list_directory(data_path) if name.endswith('.tfrecord'))
+    return [os.path.join(data_path, name) for name in names]
+
+
 def __parse_proto(example_proto):
     features = {
         'article': tf.FixedLenFeature((), tf.string, default_value=''),
@@ -115,28 +297,301 @@ def __parse_proto(example_proto):
     return parsed['article'], parsed['abstract']
 
 
-def __preprocess_article_and_abstract(article, abstract):
-    sep = ' '
-    return sep.join(preprocess(article)), sep.join(preprocess(abstract))
+def __preprocess_articles_and_abstracts(articles, abstracts, processes):
+    """Preprocess a batch of articles and abstracts, split into one chunk per process of the pool.
+    If processes is 0, preprocess in the calling process."""
+    strings = list(articles) + list(abstracts)
+    if processes == 0:
+        res = _preprocess_chunk(strings)
+    else:
+        size = -(-len(strings) // processes)  # ceiling division
+        chunks = [strings[i:i + size] for i in range(0, len(strings), size)]
+        res = [s for chunk in __pool(processes).map(_preprocess_chunk, chunks) for s in chunk]
+    return np.array(res[:len(articles)], dtype=object), np.array(res[len(articles):], dtype=object)
 
 
-def dataset(data_path, batch_size=1, shuffle=False, repeat=False):
-    names = file_io.list_directory(data_path)
-    _paths = []
-    for name in names:
-        _paths.append(os.path.join(data_path, name))
-    ds = tf.data.TFRecordDataset(_paths)
-    ds = ds.map(__parse_proto)
-    ds = ds.map(
-        lambda article, abstract: tuple(tf.py_func(
-            __preprocess_article_and_abstract,
-            [article, abstract],
-            [tf.string, tf.string],
-            name='preprocess_article_and_abstract'
-        )))
+def __set_batch_shape(articles, abstracts):
+    articles.set_shape([None])
+    abstracts.set_shape([None])
+    return articles, abstracts
+
+
+def __records(data_path, shuffle, options):
+    """Dataset of the serialized records of the files of data_path (see data_files),
+    interleaved from options.parallel_reads files at a time. If shuffle, the files are read in random order."""
+    files = data_files(data_path)
+    ds = tf.data.Dataset.from_tensor_slices(tf.constant(files, dtype=tf.string))
+    if shuffle:
+        ds = ds.shuffle(buffer_size=max(len(files), 1))
+    # without shuffling, keep the order of the records deterministic
+    return ds.apply(tf.contrib.data.parallel_interleave(
+        tf.data.TFRecordDataset, cycle_length=options.parallel_reads, sloppy=shuffle))
+
+
+def __shuffle_and_prefetch(ds, shuffle, repeat, options, make_batches):
+    """Shuffle the records of ds, batch them with make_batches, and repeat and prefetch the batches"""
     if shuffle:
-        ds = ds.shuffle(buffer_size=100)
-    ds = ds.batch(batch_size, drop_remainder=True)
+        ds = ds.shuffle(buffer_size=options.shuffle_buffer_size)
+    ds = make_batches(ds)
     if repeat:
         ds = ds.repeat()
+    if options.prefetch_batches > 0:
+        ds = ds.prefetch(options.prefetch_batches)
     return ds
+
+
+def __text_dataset(data_path, shuffle, preprocess_processes, preprocess_batch_size, options):
+    """Dataset of (article, abstract) strings, tokenized and lowercased.
+
+    Records are preprocessed in batches of preprocess_batch_size, spread over a pool of preprocess_processes processes
+    (or in this process, if preprocess_processes is 0).
+    """
+    if preprocess_processes > 0:
+        __pool(preprocess_processes)  # start the pool before the session starts its threads
+    ds = __records(data_path, shuffle, options)
+    ds = ds.map(__parse_proto, num_parallel_calls=options.parallel_calls)
+    ds = ds.batch(preprocess_batch_size)
+    # two calls in flight, so that the pool works on one batch while the results of the other are collected
+    ds = ds.map(
+        lambda articles, abstracts: __set_batch_shape(*tf.py_func(
+            lambda a, b: __preprocess_articles_and_abstracts(a, b, preprocess_processes),
+            [articles, abstracts],
+            [tf.string, tf.string],
+            stateful=False,
+            name='preprocess_articles_and_abstracts'
+        )),
+        num_parallel_calls=2)
+    return ds.apply(tf.contrib.data.unbatch())
+
+
+def __batch(ds, batch_size, length_fn, bucket_boundaries, bucket_batch_sizes, padded_shapes, padding_values=None,
+            drop_remainder=True):
+    """Pad and batch the elements of ds, dropping partial batches if drop_remainder.
+
+    If bucket_boundaries (a list of lengths) is given, batch elements of similar length (as given by length_fn) together:
+    bucket i holds the elements with bucket_boundaries[i-1] <= length < bucket_boundaries[i],
+    and its batches have bucket_batch_sizes[i] elements (batch_size if bucket_batch_sizes is not given).
+    """
+    if not bucket_boundaries:
+        return ds.padded_batch(batch_size, padded_shapes, padding_values, drop_remainder=drop_remainder)
+    batch_sizes = bucket_batch_sizes or [batch_size] * (len(bucket_boundaries) + 1)
+    if len(batch_sizes) != len(bucket_boundaries) + 1:
+        raise ValueError('There must be one more bucket batch size than bucket boundaries')
+    boundaries = tf.constant(bucket_boundaries, dtype=tf.int64)
+    sizes = tf.constant(batch_sizes, dtype=tf.int64)
+
+    def bucket_id(*element):
+        length = tf.cast(length_fn(*element), tf.int64)
+        return tf.reduce_sum(tf.cast(tf.greater_equal(length, boundaries), tf.int64))
+
+    ds = ds.apply(tf.contrib.data.group_by_window(
+        key_func=bucket_id,
+        reduce_func=lambda key, window: window.padded_batch(
+            sizes[key], padded_shapes, padding_values, drop_remainder=drop_remainder),
+        window_size_func=lambda key: sizes[key]))
+    if drop_remainder and len(set(batch_sizes)) == 1:
+        # all batches have the same size, so the batch dimension can be static
+        ds = ds.map(lambda *batch: __set_batch_size(batch, batch_sizes[0]))
+    return ds
+
+
+def token_budget_buckets(batch_tokens, max_length, bucket_boundaries=None, min_length=8, length_step=1.1,
+                         decoder_length=0):
+    """Bucket boundaries and batch sizes such that each batch has at most batch_tokens tokens, padding included.
+    Buckets of short sequences then have large batches, and buckets of long sequences small ones.
+
+    Args:
+      batch_tokens: maximum number of tokens of a batch; at least max_length + decoder_length
+      max_length: length to which the model truncates the sequences
+      bucket_boundaries: Optional. Increasing lengths. If not given, the boundaries grow geometrically
+        by length_step from min_length up to max_length.
+      decoder_length: number of tokens charged to each sequence on top of its length, whatever the bucket,
+        e.g. the decoder steps of the model, whose cost does not depend on the article length
+
+    Returns:
+      bucket_boundaries, bucket_batch_sizes: as taken by dataset
+    """
+    if batch_tokens < max_length + decoder_length:
+        raise ValueError('A batch of {} tokens cannot hold a sequence of {}'.format(batch_tokens,
+                                                                                 max_length + decoder_length))
+    if not bucket_boundaries:
+        bucket_boundaries = []
+        length = min_length
+        while length < max_length:
+            bucket_boundaries.append(length)
+            length = max(length + 1, int(length * length_step))
+    bucket_boundaries = [b for b in bucket_boundaries if b < max_length]
+    # the sequences of a bucket are shorter than its upper boundary; those of the last bucket are truncated to max_length
+    longest = [b - 1 for b in bucket_boundaries] + [max_length]
+    return bucket_boundaries, [batch_tokens // (n + decoder_length) for n in longest]
+
+
+def __set_batch_size(batch, batch_size):
+    """Set the static batch dimension of each tensor in the (possibly single-element) tuple batch."""
+    def set_shape(t):
+        t.set_shape(tf.TensorShape([batch_size]).concatenate(t.shape[1:]))
+        return t
+    batch = tf.contrib.framework.nest.map_structure(set_shape, batch)
+    return batch[0] if len(batch) == 1 else batch
+
+
+def __article_length(article, abstract):
+    return tf.size(tf.string_split([article]).values)
+
+
+def dataset(data_path, batch_size=1, shuffle=False, repeat=False, preprocess_processes=0, preprocess_batch_size=64,
+            bucket_boundaries=None, bucket_batch_sizes=None, input_options=DEFAULT_INPUT_OPTIONS, drop_remainder=True):
+    """Dataset of batches of (article, abstract) strings, tokenized and lowercased.
+
+    Records are preprocessed in batches of preprocess_batch_size, spread over a pool of preprocess_processes processes
+    (or in this process, if preprocess_processes is 0).
+    If bucket_boundaries is given, batches hold articles of similar numbers of words (see __batch).
+    input_options is an InputOptions of how the files are read, shuffled and prefetched.
+    Partial batches are dropped if drop_remainder, and kept otherwise.
+    """
+    ds = __text_dataset(data_path, shuffle, preprocess_processes, preprocess_batch_size, input_options)
+    return __shuffle_and_prefetch(
+        ds, shuffle, repeat, input_options,
+        lambda d: __batch(d, batch_size, __article_length, bucket_boundaries, bucket_batch_sizes,
+                          padded_shapes=([], []), drop_remainder=drop_remainder))
+
+
+def __example_inputs(article, abstract, table, vocab, max_enc_steps, max_dec_steps, pointer_gen):
+    """The model inputs of one example, computed in the graph as batcher.Example does in python"""
+    vsize = vocab.size()
+    unk_id = vocab.word2id(data.UNKNOWN_TOKEN)
+    start_decoding = vocab.word2id(data.START_DECODING)
+    stop_decoding = vocab.word2id(data.STOP_DECODING)
+
+    article_words = tf.string_split([article]).values[:max_enc_steps]
+    enc_input = tf.cast(table.lookup(article_words), tf.int32)
+    # As batcher.split_abstract does, every period becomes a token, and the last sentence gets one more period
+    abstract = tf.string_join([tf.regex_replace(abstract, r'\.', ' . '), ' .'])
+    abstract_words = tf.string_split([abstract]).values
+    abs_ids = tf.cast(table.lookup(abstract_words), tf.int32)
+
+    # The decoder input starts with the start token; the target ends with the stop token, unless it is truncated
+    res = {
+        'enc_batch': enc_input,
+        'enc_lens': tf.size(enc_input),
+        'dec_batch': tf.concat([[start_decoding], abs_ids], axis=0)[:max_dec_steps],
+        'target_batch': tf.concat([abs_ids, [stop_decoding]], axis=0)[:max_dec_steps],
+        'dec_lens': tf.minimum(tf.size(abs_ids) + 1, max_dec_steps)
+    }
+    if pointer_gen:
+        # In-article OOVs are numbered in order of first appearance, as in data.article2ids
+        words, word_idx = tf.unique(article_words)
+        is_oov = tf.equal(tf.cast(table.lookup(words), tf.int32), unk_id)
+        oov_num = tf.cumsum(tf.cast(is_oov, tf.int32)) - 1
+        article_oovs = tf.boolean_mask(words, is_oov)
+        res['enc_batch_extend_vocab'] = tf.where(
+            tf.equal(enc_input, unk_id), vsize + tf.gather(oov_num, word_idx), enc_input)
+        # abstract words that are in-article OOVs get their temporary ids, as in data.abstract2ids
+        # (a column of False is added so that argmax works for articles without OOVs)
+        in_article = tf.concat([
+            tf.equal(tf.expand_dims(abstract_words, 1), tf.expand_dims(article_oovs, 0)),
+            tf.zeros([tf.size(abstract_words), 1], dtype=tf.bool)
+        ], axis=1)
+        abs_ids_extend_vocab = tf.where(
+            tf.logical_and(tf.equal(abs_ids, unk_id), tf.reduce_any(in_article, axis=1)),
+            vsize + tf.cast(tf.argmax(tf.cast(in_article, tf.int32), axis=1), tf.int32),
+            abs_ids)
+        res['target_batch'] = tf.concat([abs_ids_extend_vocab, [stop_decoding]], axis=0)[:max_dec_steps]
+        res['num_art_oovs'] = tf.size(article_oovs)
+    return res
+
+
+def __batch_inputs(batch, max_dec_steps, pointer_gen):
+    """Adds the padding masks (and max_art_oovs) to a padded batch of example inputs, as batcher.Batch does"""
+    res = {
+        'enc_batch': batch['enc_batch'],
+        'enc_lens': batch['enc_lens'],
+        'enc_padding_mask': tf.sequence_mask(batch['enc_lens'], tf.shape(batch['enc_batch'])[1], dtype=tf.float32),
+        'dec_batch': batch['dec_batch'],
+        'target_batch': batch['target_batch'],
+        'dec_padding_mask': tf.sequence_mask(batch['dec_lens'], max_dec_steps, dtype=tf.float32)
+    }
+    if pointer_gen:
+        res['enc_batch_extend_vocab'] = batch['enc_batch_extend_vocab']
+        res['max_art_oovs'] = tf.reduce_max(batch['num_art_oovs'])
+    return res
+
+
+def model_input_dataset(data_path, vocab, batch_size, max_enc_steps, max_dec_steps, pointer_gen, shuffle=False,
+                        repeat=False, preprocess_processes=0, preprocess_batch_size=64, bucket_boundaries=None,
+                        bucket_batch_sizes=None, input_options=DEFAULT_INPUT_OPTIONS, drop_remainder=True):
+    """Dataset of batches of model inputs, made in the graph from the preprocessed text (see dataset).
+
+    Each element is a dict of the tensors that SummarizationModel otherwise feeds from a batcher.Batch:
+    enc_batch, enc_lens, enc_padding_mask, dec_batch, target_batch, dec_padding_mask,
+    and in pointer-generator mode, enc_batch_extend_vocab and max_art_oovs.
+    Words are mapped to ids with a lookup table, which is initialized by tf.tables_initializer().
+    If bucket_boundaries is given, batches hold articles of similar numbers of words (see __batch).
+    input_options is an InputOptions of how the files are read, shuffled and prefetched.
+    Partial batches are dropped if drop_remainder, and kept otherwise.
+    """
+    table = tf.contrib.lookup.index_table_from_tensor(
+        mapping=tf.constant([vocab.id2word(i) for i in range(vocab.size())]),
+        default_value=vocab.word2id(data.UNKNOWN_TOKEN))
+    pad_id = vocab.word2id(data.PAD_TOKEN)
+    ds = __text_dataset(data_path, shuffle, preprocess_processes, preprocess_batch_size, input_options)
+    padded_shapes = {
+        'enc_batch': [None],
+        'enc_lens': [],
+        'dec_batch': [max_dec_steps],
+        'target_batch': [max_dec_steps],
+        'dec_lens': []
+    }
+    padding_values = {
+        'enc_batch': pad_id,
+        'enc_lens': 0,
+        'dec_batch': pad_id,
+        'target_batch': pad_id,
+        'dec_lens': 0
+    }
+    if pointer_gen:
+        padded_shapes['enc_batch_extend_vocab'] = [None]
+        padded_shapes['num_art_oovs'] = []
+        padding_values['enc_batch_extend_vocab'] = pad_id
+        padding_values['num_art_oovs'] = 0
+
+    def make_batches(d):
+        d = d.map(
+            lambda article, abstract: __example_inputs(
+                article, abstract, table, vocab, max_enc_steps, max_dec_steps, pointer_gen),
+            num_parallel_calls=input_options.parallel_calls)
+        d = __batch(d, batch_size, lambda inputs: inputs['enc_lens'], bucket_boundaries, bucket_batch_sizes,
+                    padded_shapes=padded_shapes,
+                    padding_values={k: tf.constant(v, dtype=tf.int32) for k, v in padding_values.items()},
+                    drop_remainder=drop_remainder)
+        return d.map(lambda batch: __batch_inputs(batch, max_dec_steps, pointer_gen),
+                     num_parallel_calls=input_options.parallel_calls)
+
+    return __shuffle_and_prefetch(ds, shuffle, repeat, input_options, make_batches)
+
+
+def encoded_dataset(data_path, vocab_version, batch_size=1, shuffle=False, repeat=False, bucket_boundaries=None,
+                    bucket_batch_sizes=None, input_options=DEFAULT_INPUT_OPTIONS, drop_remainder=True):
+    """Dataset of batches of examples written by encoded_example, as dicts of arrays padded to the longest sequence.
+
+    Fails if the examples were encoded with a vocab of another version than vocab_version.
+    If bucket_boundaries is given, batches hold articles of similar lengths (see __batch).
+    input_options is an InputOptions of how the files are read, shuffled and prefetched.
+    Partial batches are dropped if drop_remainder, and kept otherwise.
+    """
+    ds = __records(data_path, shuffle, input_options)
+    ds = ds.map(lambda example_proto: __parse_encoded_proto(example_proto, vocab_version),
+                num_parallel_calls=input_options.parallel_calls)
+    return __shuffle_and_prefetch(
+        ds, shuffle, repeat, input_options,
+        lambda d: __batch(d, batch_size, lambda example: example['article_lens'], bucket_boundaries,
+                          bucket_batch_sizes,
+                          padded_shapes={
+                              'article_ids': [None],
+                              'article_lens': [],
+                              'abstract_ids': [None],
+                              'abstract_lens': [],
+                              'article_oovs': [None],
+                              'num_article_oovs': []
+                          },
+                          drop_remainder=drop_remainder))
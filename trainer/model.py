@@ -21,10 +21,11 @@ import time
 import numpy as np
 import tensorflow as tf
 from tensorflow import logging as log
-from trainer.attention_decoder import attention_decoder
+from trainer.attention_decoder import attention_decoder, dynamic_attention_decoder, encoder_attention_features
 from tensorflow.contrib.tensorboard.plugins import projector
 from tensorflow.python.estimator.model_fn import ModeKeys as Modes
 import trainer.batcher as batcher
+import trainer.data as data
 
 
 class SummarizationModel(object):
@@ -32,12 +33,13 @@ class SummarizationModel(object):
     Supports both baseline mode, pointer-generator mode, and coverage
     """
 
-    def __init__(self, hps, vocab, mode, pointer_gen, coverage, conf):
+    def __init__(self, hps, vocab, mode, pointer_gen, coverage, beam_size, conf):
         self._hps = hps
         self._vocab = vocab
         self._mode = mode
         self._pointer_gen = pointer_gen
         self._coverage = coverage
+        self._beam_size = beam_size
         # The model is configured with max_dec_steps=1
         # because we only ever run one step of the decoder at a time (to do beam search).
         # Note that the batcher is initialized with max_dec_steps equal to e.g. 100
@@ -46,24 +48,46 @@ class SummarizationModel(object):
         self._conf = conf
         self._summaries = None
         self._graph = None
+        self._iterator = None
 
-    def _add_placeholders(self):
-        """Add placeholders to the graph. These are entry points for any input data."""
+    def _add_placeholders(self, inputs=None):
+        """Add placeholders to the graph. These are entry points for any input data.
+
+        Args:
+          inputs: Optional. A dict of input tensors (see etl.model_input_dataset) to use instead of placeholders,
+            in train and eval mode.
+        """
         hps = self._hps
+        if inputs is not None:
+            self._enc_batch = inputs['enc_batch']
+            self._enc_lens = inputs['enc_lens']
+            self._enc_padding_mask = inputs['enc_padding_mask']
+            if self._pointer_gen:
+                self._enc_batch_extend_vocab = inputs['enc_batch_extend_vocab']
+                self._max_art_oovs = inputs['max_art_oovs']
+            self._dec_batch = inputs['dec_batch']
+            self._target_batch = inputs['target_batch']
+            self._dec_padding_mask = inputs['dec_padding_mask']
+            return
+
+        # In train and eval mode, the batch size may vary between batches (see etl.token_budget_buckets).
+        # In decode mode it is fixed, and the encoder runs once per article, rather than once per hypothesis in the beam
+        batch_size = hps.batch_size if self._mode == Modes.PREDICT else None
+        enc_batch_size = hps.batch_size // self._beam_size if self._mode == Modes.PREDICT else None
 
         # encoder part
-        self._enc_batch = tf.placeholder(tf.int32, [hps.batch_size, None], name='enc_batch')
-        self._enc_lens = tf.placeholder(tf.int32, [hps.batch_size], name='enc_lens')
-        self._enc_padding_mask = tf.placeholder(tf.float32, [hps.batch_size, None], name='enc_padding_mask')
+        self._enc_batch = tf.placeholder(tf.int32, [enc_batch_size, None], name='enc_batch')
+        self._enc_lens = tf.placeholder(tf.int32, [enc_batch_size], name='enc_lens')
+        self._enc_padding_mask = tf.placeholder(tf.float32, [batch_size, None], name='enc_padding_mask')
         if self._pointer_gen:
-            self._enc_batch_extend_vocab = tf.placeholder(tf.int32, [hps.batch_size, None],
+            self._enc_batch_extend_vocab = tf.placeholder(tf.int32, [batch_size, None],
                                                           name='enc_batch_extend_vocab')
             self._max_art_oovs = tf.placeholder(tf.int32, [], name='max_art_oovs')
 
         # decoder part
-        self._dec_batch = tf.placeholder(tf.int32, [hps.batch_size, self._max_dec_steps], name='dec_batch')
-        self._target_batch = tf.placeholder(tf.int32, [hps.batch_size, self._max_dec_steps], name='target_batch')
-        self._dec_padding_mask = tf.placeholder(tf.float32, [hps.batch_size, self._max_dec_steps],
+        self._dec_batch = tf.placeholder(tf.int32, [batch_size, self._max_dec_steps], name='dec_batch')
+        self._target_batch = tf.placeholder(tf.int32, [batch_size, self._max_dec_steps], name='target_batch')
+        self._dec_padding_mask = tf.placeholder(tf.float32, [batch_size, self._max_dec_steps],
                                                 name='dec_padding_mask')
 
         if self._mode == Modes.PREDICT and self._coverage:
@@ -77,8 +101,13 @@ class SummarizationModel(object):
           just_enc: Boolean. If True, only feed the parts needed for the encoder.
         """
         feed_dict = dict()
-        feed_dict[self._enc_batch] = batch.enc_batch
-        feed_dict[self._enc_lens] = batch.enc_lens
+        if self._mode == Modes.PREDICT:
+            # Each article is repeated beam_size times in the batch; the encoder only needs the first row of each
+            feed_dict[self._enc_batch] = batch.enc_batch[::self._beam_size]
+            feed_dict[self._enc_lens] = batch.enc_lens[::self._beam_size]
+        else:
+            feed_dict[self._enc_batch] = batch.enc_batch
+            feed_dict[self._enc_lens] = batch.enc_lens
         feed_dict[self._enc_padding_mask] = batch.enc_padding_mask
         if self._pointer_gen:
             feed_dict[self._enc_batch_extend_vocab] = batch.enc_batch_extend_vocab
@@ -143,80 +172,296 @@ class SummarizationModel(object):
             new_h = tf.nn.relu(tf.matmul(old_h, w_reduce_h) + bias_reduce_h)  # Get new state from old state
             return tf.contrib.rnn.LSTMStateTuple(new_c, new_h)  # Return new cell and state
 
-    def _add_decoder(self, inputs):
+    def _add_decoder(self, inputs, enc_padding_mask, enc_features=None, prev_coverage=None, num_steps=None):
         """Add attention decoder to the graph. In train or eval mode, you call this once to get output on ALL steps. In decode (beam search) mode, you call this once for EACH decoder step.
 
         Args:
-          inputs: inputs to the decoder (word embeddings). A list of tensors shape (batch_size, emb_dim)
+          inputs: inputs to the decoder (word embeddings). In train or eval mode, a tensor shape (batch_size, max_dec_steps, emb_dim). In decode mode, a list of tensors shape (batch_size, emb_dim)
+          enc_padding_mask: padding mask of the encoder states that the decoder attends over. shape (batch_size, attn_len)
+          enc_features: Optional. Precomputed attention features of the encoder states, in decode mode.
+          prev_coverage: Optional. The previous step's coverage vector, in decode mode when using coverage.
+          num_steps: In train or eval mode, the number of decoder steps to run; a scalar tensor.
 
         Returns:
-          outputs: List of tensors; the outputs of the decoder
+          outputs: The outputs of the decoder
           out_state: The final state of the decoder
-          attn_dists: A list of tensors; the attention distributions
-          p_gens: A list of scalar tensors; the generation probabilities
+          attn_dists: The attention distributions
+          p_gens: The generation probabilities
           coverage: A tensor, the current coverage vector
+
+          In train or eval mode, outputs, attn_dists and p_gens are tensors shape (batch_size, num_steps, ...) (see dynamic_attention_decoder).
+          In decode mode, they are lists of tensors, one per step (see attention_decoder).
         """
         hps = self._hps
-        cell = tf.contrib.rnn.LSTMCell(hps.hidden_dim, state_is_tuple=True, initializer=self.rand_unif_init)
-        # In decode mode, we run attention_decoder one step at a time and
-        # so need to pass in the previous step's coverage vector each time
-        prev_coverage = self.prev_coverage if self._mode == Modes.PREDICT and self._coverage else None
+        self._dec_cell = tf.contrib.rnn.LSTMCell(hps.hidden_dim, state_is_tuple=True, initializer=self.rand_unif_init)
+
+        if self._mode != Modes.PREDICT:
+            # loop over the steps in the graph, rather than unrolling max_dec_steps steps
+            return dynamic_attention_decoder(
+                inputs,
+                num_steps,
+                self._dec_in_state,
+                self._enc_states,
+                enc_padding_mask,
+                self._dec_cell,
+                pointer_gen=self._pointer_gen,
+                use_coverage=self._coverage
+            )
 
         outputs, out_state, attn_dists, p_gens, coverage = attention_decoder(
             inputs,
             self._dec_in_state,
             self._enc_states,
-            self._enc_padding_mask,
-            cell,
+            enc_padding_mask,
+            self._dec_cell,
             initial_state_attention=(self._mode == Modes.PREDICT),
             pointer_gen=self._pointer_gen,
             use_coverage=self._coverage,
-            prev_coverage=prev_coverage
+            prev_coverage=prev_coverage,
+            encoder_features=enc_features
         )
 
         return outputs, out_state, attn_dists, p_gens, coverage
 
-    def _calc_final_dist(self, vocab_dists, attn_dists):
+    def _add_decode_state(self, enc_states, enc_features, dec_in_state, article_ids):
+        """For stateful beam search decoding. Keep the encoder outputs and the decoder state of every hypothesis in local variables, so that they stay on the device between decoder steps.
+
+        self._init_decode_state writes the encoder outputs of a batch into the variables, and self._update_decode_state writes back the decoder state after each step.
+        On each step, every hypothesis reads the state of its parent, i.e. the row in self._beam_parents.
+
+        Args:
+          enc_states: The encoder states repeated for each hypothesis. shape (batch_size, attn_len, 2*hidden_dim)
+          enc_features: The attention features of enc_states. shape (batch_size, attn_len, 1, 2*hidden_dim)
+          dec_in_state: The decoder initial state repeated for each hypothesis. LSTMStateTuple of shape (batch_size, hidden_dim)
+          article_ids: The article ids repeated for each hypothesis, for the vocabulary shortlist. shape (batch_size, attn_len). None if not using a shortlist.
+
+        Returns:
+          enc_states, enc_features, enc_padding_mask, enc_batch_extend_vocab (None in baseline mode), dec_in_state, prev_coverage (None if not using coverage),
+          article_ids (None if not using a shortlist), read from the variables for the current decoder step.
+        """
+        hps = self._hps
+
+        def state_var(name, value, shape):
+            var = tf.Variable(tf.zeros([0] * len(shape), dtype=value.dtype), name=name, trainable=False,
+                              collections=[tf.GraphKeys.LOCAL_VARIABLES], validate_shape=False)
+            init_op = tf.assign(var, value, validate_shape=False)
+            read = tf.identity(var)
+            read.set_shape(shape)
+            return var, init_op, read
+
+        with tf.variable_scope('decode_state'):
+            self._beam_parents = tf.placeholder(tf.int32, [hps.batch_size], name='beam_parents')
+            enc_shape = [hps.batch_size, None]
+            init_ops = []
+            _, init_op, enc_states = state_var('enc_states', enc_states, enc_states.get_shape().as_list())
+            init_ops.append(init_op)
+            _, init_op, enc_features = state_var('enc_features', enc_features, enc_features.get_shape().as_list())
+            init_ops.append(init_op)
+            _, init_op, enc_padding_mask = state_var('enc_padding_mask', self._enc_padding_mask, enc_shape)
+            init_ops.append(init_op)
+            enc_batch_extend_vocab = None
+            if self._pointer_gen:
+                _, init_op, enc_batch_extend_vocab = state_var('enc_batch_extend_vocab',
+                                                               self._enc_batch_extend_vocab, enc_shape)
+                init_ops.append(init_op)
+            if article_ids is not None:
+                _, init_op, article_ids = state_var('article_ids', article_ids, enc_shape)
+                init_ops.append(init_op)
+
+            # The per-hypothesis state is reordered by beam_parents on every step
+            state_shape = [hps.batch_size, hps.hidden_dim]
+            c_var, init_op, c = state_var('c', dec_in_state.c, state_shape)
+            init_ops.append(init_op)
+            h_var, init_op, h = state_var('h', dec_in_state.h, state_shape)
+            init_ops.append(init_op)
+            self._decode_state_vars = [c_var, h_var]
+            dec_in_state = tf.contrib.rnn.LSTMStateTuple(tf.gather(c, self._beam_parents),
+                                                         tf.gather(h, self._beam_parents))
+            prev_coverage = None
+            if self._coverage:
+                coverage_var, init_op, coverage = state_var('coverage', tf.zeros_like(self._enc_padding_mask),
+                                                            enc_shape)
+                init_ops.append(init_op)
+                self._decode_state_vars.append(coverage_var)
+                prev_coverage = tf.gather(coverage, self._beam_parents)
+            self._init_decode_state = tf.group(*init_ops)
+
+        return enc_states, enc_features, enc_padding_mask, enc_batch_extend_vocab, dec_in_state, prev_coverage, article_ids
+
+    def _calc_final_dist(self, vocab_dists, attn_dists, p_gens, enc_batch_extend_vocab):
         """Calculate the final distribution, for the pointer-generator model
 
         Args:
-          vocab_dists: The vocabulary distributions. List length max_dec_steps of (batch_size, vsize) arrays. The words are in the order they appear in the vocabulary file.
-          attn_dists: The attention distributions. List length max_dec_steps of (batch_size, attn_len) arrays
+          vocab_dists: The vocabulary distributions. shape (batch_size, dec_steps, vsize). The words are in the order they appear in the vocabulary file.
+          attn_dists: The attention distributions. shape (batch_size, dec_steps, attn_len)
+          p_gens: The generation probabilities. shape (batch_size, dec_steps, 1)
+          enc_batch_extend_vocab: The encoder ids, where in-article OOVs are represented by their temporary OOV ids. shape (batch_size, attn_len)
 
         Returns:
-          final_dists: The final distributions. List length max_dec_steps of (batch_size, extended_vsize) arrays.
+          final_dists: The final distributions. shape (batch_size, dec_steps, extended_vsize)
         """
         with tf.variable_scope('final_distribution'):
             # Multiply vocab dists by p_gen and attention dists by (1-p_gen)
-            vocab_dists = [p_gen * dist for (p_gen, dist) in zip(self.p_gens, vocab_dists)]
-            attn_dists = [(1 - p_gen) * dist for (p_gen, dist) in zip(self.p_gens, attn_dists)]
+            vocab_dists = p_gens * vocab_dists
+            attn_dists = (1 - p_gens) * attn_dists
 
             # Concatenate some zeros to each vocabulary dist, to hold the probabilities for in-article OOV words
             extended_vsize = self._vocab.size() + self._max_art_oovs  # the maximum (over the batch) size of the extended vocabulary
-            extra_zeros = tf.zeros((self._hps.batch_size, self._max_art_oovs))
-            vocab_dists_extended = [tf.concat(axis=1, values=[dist, extra_zeros]) for dist in
-                                    vocab_dists]  # list length max_dec_steps of shape (batch_size, extended_vsize)
+            batch_size = tf.shape(vocab_dists)[0]
+            dec_steps = tf.shape(vocab_dists)[1]
+            extra_zeros = tf.zeros(tf.stack([batch_size, dec_steps, self._max_art_oovs]))
+            vocab_dists_extended = tf.concat(axis=2, values=[vocab_dists, extra_zeros])  # shape (batch_size, dec_steps, extended_vsize)
 
             # Project the values in the attention distributions onto the appropriate entries in the final distributions
             # This means that if a_i = 0.1 and the ith encoder word is w, and w has index 500 in the vocabulary, then we add 0.1 onto the 500th entry of the final distribution
             # This is done for each decoder timestep.
             # This is fiddly; we use tf.scatter_nd to do the projection
-            batch_nums = tf.range(0, limit=self._hps.batch_size)  # shape (batch_size)
-            batch_nums = tf.expand_dims(batch_nums, 1)  # shape (batch_size, 1)
-            attn_len = tf.shape(self._enc_batch_extend_vocab)[1]  # number of states we attend over
-            batch_nums = tf.tile(batch_nums, [1, attn_len])  # shape (batch_size, attn_len)
-            indices = tf.stack((batch_nums, self._enc_batch_extend_vocab), axis=2)  # shape (batch_size, enc_t, 2)
-            shape = [self._hps.batch_size, extended_vsize]
-            attn_dists_projected = [tf.scatter_nd(indices, copy_dist, shape) for copy_dist in
-                                    attn_dists]  # list length max_dec_steps (batch_size, extended_vsize)
+            attn_len = tf.shape(enc_batch_extend_vocab)[1]  # number of states we attend over
+            batch_nums = tf.tile(tf.reshape(tf.range(batch_size), [-1, 1, 1]), tf.stack([1, dec_steps, attn_len]))
+            step_nums = tf.tile(tf.reshape(tf.range(dec_steps), [1, -1, 1]), tf.stack([batch_size, 1, attn_len]))
+            ids = tf.tile(tf.expand_dims(enc_batch_extend_vocab, 1), tf.stack([1, dec_steps, 1]))
+            indices = tf.stack((batch_nums, step_nums, ids), axis=3)  # shape (batch_size, dec_steps, attn_len, 3)
+            shape = tf.stack([batch_size, dec_steps, extended_vsize])
+            attn_dists_projected = tf.scatter_nd(indices, attn_dists, shape)  # shape (batch_size, dec_steps, extended_vsize)
 
             # Add the vocab distributions and the copy distributions together to get the final distributions
-            # final_dists is a list length max_dec_steps; each entry is a tensor shape (batch_size, extended_vsize) giving the final distribution for that decoder timestep
+            # final_dists has shape (batch_size, dec_steps, extended_vsize), giving the final distribution for each decoder timestep
             # Note that for decoder timesteps and examples corresponding to a [PAD] token, this is junk - ignore.
-            final_dists = [vocab_dist + copy_dist for (vocab_dist, copy_dist) in
-                           zip(vocab_dists_extended, attn_dists_projected)]
+            return vocab_dists_extended + attn_dists_projected
+
+    def _final_dist_top_k(self, vocab_dist, attn_dist, p_gen, enc_batch_extend_vocab, k):
+        """Find the k most likely words of the final distribution of one decoder step, for the pointer-generator model,
+        without building the final distribution over the whole extended vocabulary.
+
+        A word that is not in the article has final probability p_gen times its vocabulary probability, so the top k are among
+        the article words and the k + attn_len most likely words of the vocabulary distribution: at most attn_len of those are
+        article words, which leaves at least k others that are as likely as any word outside both sets.
+        The final probabilities of these candidates are exact, as the attention on all the article positions of each word is summed.
+
+        Args:
+          vocab_dist: The vocabulary distribution. shape (batch_size, vsize)
+          attn_dist: The attention distribution. shape (batch_size, attn_len)
+          p_gen: The generation probability. shape (batch_size, 1)
+          enc_batch_extend_vocab: The encoder ids, where in-article OOVs are represented by their temporary OOV ids. shape (batch_size, attn_len)
+          k: The number of words to return
+
+        Returns:
+          topk_probs: The k largest final probabilities. shape (batch_size, k)
+          topk_ids: The ids of their words in the extended vocabulary. shape (batch_size, k)
+        """
+        with tf.variable_scope('final_distribution'):
+            vsize = self._vocab.size()
+            attn_len = tf.shape(enc_batch_extend_vocab)[1]
+
+            # The candidates of each row: the most likely words of the vocabulary distribution, then the article words
+            _, vocab_top_ids = tf.nn.top_k(vocab_dist, tf.minimum(k + attn_len, vsize))
+            cand_ids = tf.concat([vocab_top_ids, enc_batch_extend_vocab], axis=1)  # shape (batch_size, num_cands)
+            copy_probs = tf.concat([tf.zeros(tf.shape(vocab_top_ids)), (1 - p_gen) * attn_dist], axis=1)
+
+            # Give each distinct word of each row a segment, and sum the copy probabilities of its candidates
+            segments, num_segments, is_first = _unique_per_row(cand_ids, vsize + self._max_art_oovs)
+            copy_sums = tf.gather(tf.unsorted_segment_sum(copy_probs, segments, num_segments), segments)
+
+            in_vocab = tf.less(cand_ids, vsize)
+            vocab_probs = _batch_gather(vocab_dist, tf.where(in_vocab, cand_ids, tf.zeros_like(cand_ids)))  # in-article OOVs have no vocabulary probability
+            final_probs = p_gen * tf.to_float(in_vocab) * vocab_probs + copy_sums
+            # Only the first candidate of each word is kept, so that no word is returned twice
+            final_probs = tf.where(is_first, final_probs, tf.fill(tf.shape(final_probs), -1.))
+
+            topk_probs, topk_idx = tf.nn.top_k(final_probs, k)
+            return topk_probs, _batch_gather(cand_ids, topk_idx)
+
+    def _shortlist_vocab_dist(self, outputs, w, v, article_ids):
+        """Calculate the vocabulary distribution of one decoder step over a shortlist of the vocabulary only:
+        the hps.shortlist_size most frequent words, which include the special tokens, and the words of the article.
+        Only the columns of the output projection for these words are used, and the distribution is renormalized over them.
+
+        Args:
+          outputs: The decoder outputs. shape (batch_size, hidden_dim)
+          w: The output projection weights. shape (hidden_dim, vsize)
+          v: The output projection biases. shape (vsize)
+          article_ids: The article ids, where in-article OOVs are [UNK]. shape (batch_size, attn_len)
 
-            return final_dists
+        Returns:
+          vocab_dist: The vocabulary distribution, which is zero outside the shortlist. shape (batch_size, vsize)
+        """
+        vsize = self._vocab.size()
+        num_frequent = min(self._hps.shortlist_size, vsize)  # the vocabulary file is sorted by frequency
+        with tf.variable_scope('shortlist'):
+            batch_size = tf.shape(article_ids)[0]
+            attn_len = tf.shape(article_ids)[1]
+            frequent_scores = tf.nn.xw_plus_b(outputs, w[:, :num_frequent], v[:num_frequent])  # shape (batch_size, num_frequent)
+            # The columns of the article words. shape (batch_size, attn_len, hidden_dim)
+            article_w = tf.transpose(tf.reshape(tf.gather(w, tf.reshape(article_ids, [-1]), axis=1),
+                                                tf.stack([self._hps.hidden_dim, batch_size, attn_len])), [1, 2, 0])
+            article_scores = tf.reduce_sum(tf.expand_dims(outputs, 1) * article_w, axis=2) + tf.gather(v, article_ids)
+            # An article word is only scored once, and not again if it is one of the most frequent words
+            _, _, is_first = _unique_per_row(article_ids, vsize)
+            is_new = tf.logical_and(is_first, tf.greater_equal(article_ids, num_frequent))
+            article_scores = tf.where(is_new, article_scores, tf.fill(tf.shape(article_scores), -np.inf))
+
+            probs = tf.nn.softmax(tf.concat([frequent_scores, article_scores], axis=1))
+            # Put the probabilities back in vocabulary order; the repeated article words add zeros
+            frequent_dist = tf.pad(probs[:, :num_frequent], [[0, 0], [0, vsize - num_frequent]])
+            batch_nums = tf.tile(tf.expand_dims(tf.range(batch_size), 1), tf.stack([1, attn_len]))
+            article_dist = tf.scatter_nd(tf.stack((batch_nums, article_ids), axis=2), probs[:, num_frequent:],
+                                         tf.stack([batch_size, vsize]))
+            return frequent_dist + article_dist
+
+    def _sampled_softmax_loss(self, decoder_outputs, w_t, v, attn_dists, p_gens, enc_batch_extend_vocab, target_batch,
+                              dec_padding_mask):
+        """Calculate the training loss with a sampled softmax, which approximates the vocabulary distribution of each target word
+        by a softmax over the target word and hps.sampled_softmax words sampled from the vocabulary (as tf.nn.sampled_softmax_loss does).
+        The vocabulary is sorted by frequency, so words are sampled from a log-uniform distribution.
+
+        Args:
+          decoder_outputs: The outputs of the decoder. shape (batch_size, dec_steps, hidden_dim)
+          w_t: The transposed weights of the output projection. shape (vsize, hidden_dim)
+          v: The biases of the output projection. shape (vsize)
+          attn_dists: The attention distributions. shape (batch_size, dec_steps, attn_len)
+          p_gens: The generation probabilities. shape (batch_size, dec_steps, 1). None in baseline mode.
+          enc_batch_extend_vocab: The encoder ids, where in-article OOVs are represented by their temporary OOV ids. shape (batch_size, attn_len). None in baseline mode.
+          target_batch: The target ids. shape (batch_size, dec_steps)
+          dec_padding_mask: shape (batch_size, dec_steps)
+
+        Returns:
+          loss: scalar
+        """
+        hps = self._hps
+        vsize = self._vocab.size()
+        unk_id = self._vocab.word2id(data.UNKNOWN_TOKEN)
+        with tf.variable_scope('sampled_softmax'):
+            outputs = tf.reshape(decoder_outputs, [-1, hps.hidden_dim])  # one row per batch member and step
+            targets = tf.reshape(target_batch, [-1])
+            # in-article OOVs have no vocabulary probability; sample as if they were [UNK]
+            in_vocab = tf.less(targets, vsize)
+            labels = tf.to_int64(tf.expand_dims(tf.where(in_vocab, targets, tf.fill(tf.shape(targets), unk_id)), 1))
+            sampled_ids, true_expected, sampled_expected = tf.nn.log_uniform_candidate_sampler(
+                labels, num_true=1, num_sampled=hps.sampled_softmax, unique=True, range_max=vsize)
+
+            # Scores of the target words, and of the sampled words corrected by the log of their expected counts
+            true_scores = tf.reduce_sum(outputs * tf.nn.embedding_lookup(w_t, labels[:, 0]), axis=1)
+            true_scores += tf.gather(v, labels[:, 0])
+            sampled_logits = tf.matmul(outputs, tf.nn.embedding_lookup(w_t, sampled_ids), transpose_b=True)
+            sampled_logits += tf.gather(v, sampled_ids) - tf.log(sampled_expected)
+            # A sampled word that is the target word of a row does not compete with it
+            hit_rows, hit_ids, hit_weights = tf.nn.compute_accidental_hits(labels, sampled_ids, num_true=1)
+            sampled_logits += tf.scatter_nd(tf.stack([hit_rows, tf.to_int32(hit_ids)], axis=1), hit_weights,
+                                            tf.shape(sampled_logits))
+
+            if self._pointer_gen:
+                # The mixture with the copy probabilities needs an estimate of the vocabulary probability exp(t) / Z itself.
+                # The sampled words estimate the rest of Z, so only their scores are corrected.
+                log_vocab_probs = tf.reshape(true_scores - tf.reduce_logsumexp(
+                    tf.concat([tf.expand_dims(true_scores, 1), sampled_logits], axis=1), axis=1), tf.shape(target_batch))
+                losses = -tf.log(_gold_probs(log_vocab_probs, tf.reshape(in_vocab, tf.shape(target_batch)), p_gens,
+                                             attn_dists, enc_batch_extend_vocab, target_batch))
+            else:
+                # The classification loss of the target word among the sampled words, as tf.nn.sampled_softmax_loss computes it
+                true_logits = true_scores - tf.log(true_expected[:, 0])
+                losses = -tf.reshape(true_logits - tf.reduce_logsumexp(
+                    tf.concat([tf.expand_dims(true_logits, 1), sampled_logits], axis=1), axis=1), tf.shape(target_batch))
+            return _mask_and_avg(losses, dec_padding_mask)
 
     def _add_emb_vis(self, embedding_var, log_root):
         """Do setup so that we can view word embedding visualization in Tensorboard, as described here:
@@ -250,84 +495,373 @@ class SummarizationModel(object):
                     self._add_emb_vis(embedding, log_root=self._conf.model_dir)  # add to tensorboard
                 emb_enc_inputs = tf.nn.embedding_lookup(embedding,
                                                         self._enc_batch)  # tensor with shape (batch_size, max_enc_steps, emb_size)
-                emb_dec_inputs = [tf.nn.embedding_lookup(embedding, x) for x in tf.unstack(self._dec_batch,
-                                                                                           axis=1)]  # list length max_dec_steps containing shape (batch_size, emb_size)
+                if self._mode == Modes.PREDICT:
+                    emb_dec_inputs = [tf.nn.embedding_lookup(embedding, x) for x in tf.unstack(self._dec_batch,
+                                                                                               axis=1)]  # list length max_dec_steps containing shape (batch_size, emb_size)
+                else:
+                    emb_dec_inputs = tf.nn.embedding_lookup(embedding,
+                                                            self._dec_batch)  # tensor with shape (batch_size, max_dec_steps, emb_size)
 
             # Add the encoder.
             enc_outputs, fw_st, bw_st = self._add_encoder(emb_enc_inputs, self._enc_lens)
-            self._enc_states = enc_outputs
 
             # Our encoder is bidirectional and our decoder is unidirectional so we need to reduce the final encoder hidden state to the right size to be the initial decoder hidden state
-            self._dec_in_state = self._reduce_states(fw_st, bw_st)
+            dec_in_state = self._reduce_states(fw_st, bw_st)
+
+            enc_padding_mask = self._enc_padding_mask
+            enc_batch_extend_vocab = self._enc_batch_extend_vocab if self._pointer_gen else None
+            enc_features = None
+            # In decode mode, we run attention_decoder one step at a time and
+            # so need to pass in the previous step's coverage vector each time
+            prev_coverage = self.prev_coverage if self._mode == Modes.PREDICT and self._coverage else None
+            if self._mode == Modes.PREDICT:
+                # The encoder ran once per article. Compute the attention features of the encoder states once per article too.
+                # run_encoder returns them and decode_onestep feeds them back in, so they are not recomputed on every step.
+                self._article_enc_states = enc_outputs
+                self._article_dec_in_state = dec_in_state
+                with tf.variable_scope('decoder'):
+                    self._article_enc_features = encoder_attention_features(enc_outputs)
+                # Repeat them beam_size times in the graph,
+                # so that the decoder gets one row per hypothesis in the same order as the rows of the batch.
+                enc_outputs = tf.contrib.seq2seq.tile_batch(enc_outputs, self._beam_size)
+                enc_features = tf.contrib.seq2seq.tile_batch(self._article_enc_features, self._beam_size)
+                dec_in_state = tf.contrib.seq2seq.tile_batch(dec_in_state, self._beam_size)
+                beam_search_inputs = (enc_outputs, enc_features, dec_in_state)
+                # The vocabulary shortlist of each hypothesis includes the words of its article
+                article_ids = tf.contrib.seq2seq.tile_batch(self._enc_batch, self._beam_size) if hps.shortlist_size > 0 else None
+                if hps.stateful_decode:
+                    (enc_outputs, enc_features, enc_padding_mask, enc_batch_extend_vocab, dec_in_state,
+                     prev_coverage, article_ids) = self._add_decode_state(enc_outputs, enc_features, dec_in_state,
+                                                                          article_ids)
+            else:
+                # The decoder only runs up to the longest abstract of the batch; the later steps are all padding
+                dec_steps = tf.to_int32(tf.reduce_max(tf.reduce_sum(self._dec_padding_mask, axis=1)))
+                target_batch = self._target_batch[:, :dec_steps]
+                dec_padding_mask = self._dec_padding_mask[:, :dec_steps]
+            self._enc_states = enc_outputs
+            self._dec_in_state = dec_in_state
 
             # Add the decoder.
             with tf.variable_scope('decoder'):
                 decoder_outputs, self._dec_out_state, self.attn_dists, self.p_gens, self.coverage = self._add_decoder(
-                    emb_dec_inputs)
+                    emb_dec_inputs,
+                    enc_padding_mask,
+                    enc_features=enc_features,
+                    prev_coverage=prev_coverage,
+                    num_steps=None if self._mode == Modes.PREDICT else dec_steps
+                )
+            if self._mode == Modes.PREDICT:
+                # one step: stack the lists of the decoder into tensors shape (batch_size, 1, ...)
+                decoder_outputs = tf.stack(decoder_outputs, axis=1)
+                attn_dists = tf.stack(self.attn_dists, axis=1)
+                p_gens = tf.stack(self.p_gens, axis=1) if self._pointer_gen else None
+            else:
+                attn_dists = self.attn_dists
+                p_gens = self.p_gens
+
+            # In train mode with a sampled softmax, the loss does not need the distributions over the whole vocabulary
+            sampled_softmax = self._mode == Modes.TRAIN and hps.sampled_softmax > 0
+            # In decode mode with a shortlist, the output projection only computes the scores of the shortlisted words
+            shortlist = self._mode == Modes.PREDICT and hps.shortlist_size > 0
 
             # Add the output projection to obtain the vocabulary distribution
             with tf.variable_scope('output_projection'):
                 w = tf.get_variable('w', [hps.hidden_dim, vsize], dtype=tf.float32, initializer=self.trunc_norm_init)
                 w_t = tf.transpose(w)
                 v = tf.get_variable('v', [vsize], dtype=tf.float32, initializer=self.trunc_norm_init)
-                vocab_scores = []  # vocab_scores is the vocabulary distribution before applying softmax. Each entry on the list corresponds to one decoder step
-                for i, output in enumerate(decoder_outputs):
-                    if i > 0:
-                        tf.get_variable_scope().reuse_variables()
-                    vocab_scores.append(tf.nn.xw_plus_b(output, w, v))  # apply the linear layer
-
-                vocab_dists = [tf.nn.softmax(s) for s in
-                               vocab_scores]  # The vocabulary distributions. List length max_dec_steps of (batch_size, vsize) arrays. The words are in the order they appear in the vocabulary file.
-
-            # For pointer-generator model, calc final distribution from copy distribution and vocabulary distribution
-            if self._pointer_gen:
-                final_dists = self._calc_final_dist(vocab_dists, self.attn_dists)
-            else:  # final distribution is just vocabulary distribution
-                final_dists = vocab_dists
+                if not sampled_softmax and not shortlist:
+                    # apply the linear layer to the outputs of all the steps at once
+                    # vocab_scores is the vocabulary distribution before applying softmax. shape (batch_size, dec_steps, vsize)
+                    output_shape = tf.shape(decoder_outputs)
+                    vocab_scores = tf.reshape(tf.nn.xw_plus_b(tf.reshape(decoder_outputs, [-1, hps.hidden_dim]), w, v),
+                                              tf.stack([output_shape[0], output_shape[1], vsize]))
+
+            if self._mode == Modes.PREDICT:
+                # The train and eval losses only need the probabilities of the target words, not the whole distributions
+                if shortlist:
+                    vocab_dists = tf.expand_dims(self._shortlist_vocab_dist(decoder_outputs[:, 0], w, v, article_ids), 1)
+                else:
+                    vocab_dists = tf.nn.softmax(vocab_scores)  # The vocabulary distributions. shape (batch_size, dec_steps, vsize). The words are in the order they appear in the vocabulary file.
+
+                # For pointer-generator model, calc final distribution from copy distribution and vocabulary distribution
+                if self._pointer_gen and hps.sparse_final_dist:
+                    final_dists = None  # the top k are taken from the candidates of _final_dist_top_k instead
+                elif self._pointer_gen:
+                    final_dists = self._calc_final_dist(vocab_dists, attn_dists, p_gens, enc_batch_extend_vocab)
+                else:  # final distribution is just vocabulary distribution
+                    final_dists = vocab_dists
+
+            if self._mode == Modes.PREDICT and hps.graph_beam_search:
+                # The beam search loop runs the decoder built above again, so it reuses all its variables
+                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                    self._add_graph_beam_search(embedding, w, v, *beam_search_inputs)
 
             if self._mode in ['train', 'eval']:
                 # Calculate the loss
                 with tf.variable_scope('loss'):
-                    if self._pointer_gen:
-                        # Calculate the loss per step
-                        # This is fiddly; we use tf.gather_nd to pick out the probabilities of the gold target words
-                        loss_per_step = []  # will be list length max_dec_steps containing shape (batch_size)
-                        batch_nums = tf.range(0, limit=hps.batch_size)  # shape (batch_size)
-                        for dec_step, dist in enumerate(final_dists):
-                            targets = self._target_batch[:,
-                                      dec_step]  # The indices of the target words. shape (batch_size)
-                            indices = tf.stack((batch_nums, targets), axis=1)  # shape (batch_size, 2)
-                            gold_probs = tf.gather_nd(dist,
-                                                      indices)  # shape (batch_size). prob of correct words on this step
-                            losses = -tf.log(gold_probs)
-                            loss_per_step.append(losses)
+                    if sampled_softmax:
+                        self._loss = self._sampled_softmax_loss(decoder_outputs, w_t, v, attn_dists, p_gens,
+                                                                enc_batch_extend_vocab, target_batch, dec_padding_mask)
+
+                    elif self._pointer_gen:
+                        # Calculate the loss per step, from the final probability of each target word only:
+                        # its vocabulary probability and the attention on the article positions that hold it (see _gold_probs),
+                        # which is its entry in the final distribution of _calc_final_dist
+                        in_vocab = tf.less(target_batch, vsize)
+                        vocab_ids = tf.where(in_vocab, target_batch, tf.zeros_like(target_batch))  # in-article OOVs have no vocabulary score
+                        # We use _batch_gather to pick out the scores of the target words, one row per batch member and step
+                        target_scores = tf.reshape(
+                            _batch_gather(tf.reshape(vocab_scores, [-1, vsize]), tf.reshape(vocab_ids, [-1, 1])),
+                            tf.shape(target_batch))  # shape (batch_size, dec_steps)
+                        log_vocab_probs = target_scores - tf.reduce_logsumexp(vocab_scores, axis=2)
+                        gold_probs = _gold_probs(log_vocab_probs, in_vocab, p_gens, attn_dists, enc_batch_extend_vocab,
+                                                 target_batch)  # shape (batch_size, dec_steps). prob of correct words on each step
+                        losses = -tf.log(gold_probs)
 
                         # Apply dec_padding_mask and get loss
-                        self._loss = _mask_and_avg(loss_per_step, self._dec_padding_mask)
+                        self._loss = _mask_and_avg(losses, dec_padding_mask)
 
                     else:  # baseline model
-                        self._loss = tf.contrib.seq2seq.sequence_loss(tf.stack(vocab_scores, axis=1),
-                                                                      self._target_batch,
-                                                                      self._dec_padding_mask)  # this applies softmax internally
+                        self._loss = tf.contrib.seq2seq.sequence_loss(vocab_scores,
+                                                                      target_batch,
+                                                                      dec_padding_mask)  # this applies softmax internally
 
                     tf.summary.scalar('loss', self._loss)
 
                     # Calculate coverage loss from the attention distributions
                     if self._coverage:
                         with tf.variable_scope('coverage_loss'):
-                            self._coverage_loss = _coverage_loss(self.attn_dists, self._dec_padding_mask)
+                            self._coverage_loss = _coverage_loss(attn_dists, dec_padding_mask)
                             tf.summary.scalar('coverage_loss', self._coverage_loss)
                         self._total_loss = self._loss + hps.cov_loss_wt * self._coverage_loss
                         tf.summary.scalar('total_loss', self._total_loss)
 
         if self._mode == Modes.PREDICT:
             # We run decode beam search mode one decoder step at a time
-            assert len(
-                final_dists) == 1  # final_dists is a singleton list containing shape (batch_size, extended_vsize)
-            final_dists = final_dists[0]
-            topk_probs, self._topk_ids = tf.nn.top_k(final_dists,
-                                                     hps.batch_size * 2)  # take the k largest probs. note batch_size=beam_size in decode mode
+            if final_dists is None:
+                topk_probs, self._topk_ids = self._final_dist_top_k(vocab_dists[:, 0], attn_dists[:, 0], p_gens[:, 0],
+                                                                    enc_batch_extend_vocab, self._beam_size * 2)
+            else:
+                final_dists = final_dists[:, 0]  # shape (batch_size, extended_vsize)
+                topk_probs, self._topk_ids = tf.nn.top_k(final_dists,
+                                                         self._beam_size * 2)  # take the k largest probs
             self._topk_log_probs = tf.log(topk_probs)
+            if hps.stateful_decode:
+                # Write back the new decoder state of each hypothesis, once the top k have been computed from it
+                with tf.control_dependencies([self._topk_ids, self._topk_log_probs]):
+                    new_states = [self._dec_out_state.c, self._dec_out_state.h]
+                    if self._coverage:
+                        new_states.append(self.coverage)
+                    self._update_decode_state = tf.group(
+                        *[tf.assign(var, value, validate_shape=False) for var, value in
+                          zip(self._decode_state_vars, new_states)])
+
+    def _add_graph_beam_search(self, embedding, w, v, enc_states, enc_features, dec_in_state):
+        """Add beam search decoding to the graph as a single tf.while_loop, so that a batch of articles is decoded in one session run.
+
+        This is the same search as beam_search.run_beam_search. Each article keeps beam_size hypotheses, which are extended with their top 2*beam_size ids on every step.
+        Hypotheses that emit [STOP] after min_dec_steps are finished, and the search stops once every article has beam_size finished hypotheses, or after max_dec_steps.
+        The result for each article is the finished hypothesis (or, if there is none, the unfinished one) with the highest average log probability.
+
+        Args:
+          embedding: The embedding matrix.
+          w: The weights of the output projection.
+          v: The biases of the output projection.
+          enc_states: The encoder states repeated for each hypothesis. shape (batch_size, attn_len, 2*hidden_dim)
+          enc_features: The attention features of enc_states. shape (batch_size, attn_len, 1, 2*hidden_dim)
+          dec_in_state: The decoder initial state repeated for each hypothesis. LSTMStateTuple of shape (batch_size, hidden_dim)
+        """
+        hps = self._hps
+        vsize = self._vocab.size()
+        beam_size = self._beam_size
+        num_rows = hps.batch_size  # one row per hypothesis
+        num_articles = num_rows // beam_size
+        num_cands = beam_size * 2  # number of candidates for extending each hypothesis
+        max_dec_steps = hps.max_dec_steps
+        start_id = self._vocab.word2id(data.START_DECODING)
+        stop_id = self._vocab.word2id(data.STOP_DECODING)
+        unk_id = self._vocab.word2id(data.UNKNOWN_TOKEN)
+        attn_len = tf.shape(self._enc_padding_mask)[1]
+        # The article words of each hypothesis, for the vocabulary shortlist
+        article_ids = tf.contrib.seq2seq.tile_batch(self._enc_batch, beam_size) if hps.shortlist_size > 0 else None
+        first_rows = tf.range(num_articles) * beam_size  # the first row of each article. shape (num_articles)
+        # On the first step all the hypotheses of an article are the same, so only its first row is extended
+        first_step_penalty = tf.where(tf.equal(tf.range(num_rows) % beam_size, 0), tf.zeros([num_rows]),
+                                      tf.fill([num_rows], -np.inf))
+
+        def extend(rows, history, step_values):
+            """Append the step values of the given rows to their history"""
+            return tf.concat([tf.gather(history, rows), tf.expand_dims(tf.gather(step_values, rows), 1)], axis=1)
+
+        def pad(history):
+            """Pad the history of finished hypotheses up to max_dec_steps"""
+            paddings = [[0, 0], [0, max_dec_steps - tf.shape(history)[1]]] + [[0, 0]] * (history.get_shape().ndims - 2)
+            return tf.pad(history, paddings)
+
+        def cond(step, latest_tokens, state, coverage, scores, histories, num_finished, best):
+            return tf.logical_and(tf.less(step, max_dec_steps), tf.reduce_any(tf.less(num_finished, beam_size)))
+
+        def body(step, latest_tokens, state, coverage, scores, histories, num_finished, best):
+            # Run one step of the decoder
+            with tf.variable_scope('decoder'):
+                outputs, new_state, attn_dists, p_gens, new_coverage = attention_decoder(
+                    [tf.nn.embedding_lookup(embedding, latest_tokens)],
+                    state,
+                    enc_states,
+                    self._enc_padding_mask,
+                    self._dec_cell,
+                    initial_state_attention=True,
+                    pointer_gen=self._pointer_gen,
+                    use_coverage=self._coverage,
+                    prev_coverage=coverage if self._coverage else None,
+                    encoder_features=enc_features
+                )
+            attn_dist = attn_dists[0]
+            if hps.shortlist_size > 0:
+                vocab_dist = self._shortlist_vocab_dist(outputs[0], w, v, article_ids)
+            else:
+                vocab_dist = tf.nn.softmax(tf.nn.xw_plus_b(outputs[0], w, v))
+            if self._pointer_gen and hps.sparse_final_dist:
+                p_gen = p_gens[0]
+                topk_probs, topk_ids = self._final_dist_top_k(vocab_dist, attn_dist, p_gen, self._enc_batch_extend_vocab,
+                                                              num_cands)  # shape (num_rows, num_cands)
+            else:
+                if self._pointer_gen:
+                    p_gen = p_gens[0]
+                    final_dist = self._calc_final_dist(tf.expand_dims(vocab_dist, 1), tf.expand_dims(attn_dist, 1),
+                                                       tf.expand_dims(p_gen, 1), self._enc_batch_extend_vocab)[:, 0]
+                else:
+                    p_gen = tf.ones([num_rows, 1])
+                    final_dist = vocab_dist
+                topk_probs, topk_ids = tf.nn.top_k(final_dist, num_cands)  # shape (num_rows, num_cands)
+            topk_log_probs = tf.log(topk_probs)
+            cand_scores = tf.expand_dims(scores + tf.cond(tf.equal(step, 0), lambda: first_step_penalty,
+                                                          lambda: tf.zeros([num_rows])), 1) + topk_log_probs
+
+            # Group the candidates by article. shape (num_articles, beam_size * num_cands)
+            cand_scores = tf.reshape(cand_scores, [num_articles, -1])
+            cand_ids = tf.reshape(topk_ids, [num_articles, -1])
+            cand_log_probs = tf.reshape(topk_log_probs, [num_articles, -1])
+            neg_inf = tf.fill(tf.shape(cand_scores), -np.inf)
+            is_stop = tf.equal(cand_ids, stop_id)
+
+            # The next beam of each article holds its beam_size best candidates that have not emitted [STOP]
+            live_scores, live_idx = tf.nn.top_k(tf.where(is_stop, neg_inf, cand_scores), beam_size)
+            parents = tf.reshape(live_idx // num_cands + tf.expand_dims(first_rows, 1), [-1])  # shape (num_rows)
+            live_ids = tf.reshape(_batch_gather(cand_ids, live_idx), [-1])
+            live_log_probs = tf.reshape(_batch_gather(cand_log_probs, live_idx), [-1])
+
+            # As in run_beam_search, take the candidates of each article in order of score until the next beam is full,
+            # or until the article has beam_size finished hypotheses. The [STOP] candidates taken are finished,
+            # once min_dec_steps have been decoded. Articles that already have beam_size finished hypotheses are done.
+            sorted_scores, order = tf.nn.top_k(cand_scores, beam_size * num_cands)  # ties keep the candidate order
+            sorted_stop = _batch_gather(is_stop, order)
+            is_result = tf.logical_and(tf.logical_and(sorted_stop, tf.is_finite(sorted_scores)),
+                                       tf.greater_equal(step, hps.min_dec_steps))
+            num_live = tf.cumsum(tf.to_int32(tf.logical_not(sorted_stop)), axis=1)
+            num_results = tf.cumsum(tf.to_int32(is_result), axis=1) + tf.expand_dims(num_finished, 1)
+            cutoff = tf.argmax(tf.to_int32(tf.logical_or(tf.greater_equal(num_live, beam_size),
+                                                         tf.greater_equal(num_results, beam_size))),
+                               axis=1, output_type=tf.int32)
+            taken = tf.less_equal(tf.expand_dims(tf.range(beam_size * num_cands), 0), tf.expand_dims(cutoff, 1))
+            done = tf.greater_equal(num_finished, beam_size)
+            finished = tf.logical_and(tf.logical_and(is_result, taken), tf.expand_dims(tf.logical_not(done), 1))
+            num_finished += tf.reduce_sum(tf.to_int32(finished), axis=1)
+
+            # Average log probability over the [START] token and the step+1 decoded tokens, as in Hypothesis.avg_log_prob
+            finished_scores = tf.where(finished, sorted_scores, neg_inf) / tf.to_float(step + 2)
+            stop_idx = _batch_gather(order, tf.expand_dims(tf.argmax(finished_scores, axis=1, output_type=tf.int32), 1))[:, 0]
+            stop_score = tf.reduce_max(finished_scores, axis=1)
+            stop_rows = stop_idx // num_cands + first_rows
+            stop_log_probs = _batch_gather(cand_log_probs, tf.expand_dims(stop_idx, 1))[:, 0]
+            tokens, log_probs, attn_hist, p_gen_hist = histories
+            candidate = (
+                stop_score,
+                tf.fill([num_articles], step + 1),
+                pad(tf.concat([tf.gather(tokens, stop_rows), tf.fill([num_articles, 1], stop_id)], axis=1)),
+                pad(tf.concat([tf.gather(log_probs, stop_rows), tf.expand_dims(stop_log_probs, 1)], axis=1)),
+                pad(extend(stop_rows, attn_hist, attn_dist)),
+                pad(extend(stop_rows, p_gen_hist, p_gen[:, 0]))
+            )
+            improved = tf.greater(stop_score, best[0])
+            best = tuple(tf.where(improved, new, old) for new, old in zip(candidate, best))
+
+            # Reorder the beam by parent and append the latest step
+            histories = (
+                tf.concat([tf.gather(tokens, parents), tf.expand_dims(live_ids, 1)], axis=1),
+                tf.concat([tf.gather(log_probs, parents), tf.expand_dims(live_log_probs, 1)], axis=1),
+                extend(parents, attn_hist, attn_dist),
+                extend(parents, p_gen_hist, p_gen[:, 0])
+            )
+            state = tf.contrib.rnn.LSTMStateTuple(tf.gather(new_state.c, parents), tf.gather(new_state.h, parents))
+            if self._coverage:
+                coverage = tf.gather(new_coverage, parents)
+            # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
+            latest_tokens = tf.where(tf.less(live_ids, vsize), live_ids, tf.fill([num_rows], unk_id))
+            return step + 1, latest_tokens, state, coverage, tf.reshape(live_scores, [-1]), histories, num_finished, best
+
+        loop_vars = (
+            tf.constant(0),
+            tf.fill([num_rows], start_id),
+            dec_in_state,
+            tf.zeros_like(self._enc_padding_mask),  # coverage
+            tf.zeros([num_rows]),  # sum of the log probabilities of each hypothesis
+            (
+                tf.zeros([num_rows, 0], dtype=tf.int32),
+                tf.zeros([num_rows, 0]),
+                tf.zeros(tf.stack([num_rows, 0, attn_len])),
+                tf.zeros([num_rows, 0])
+            ),
+            tf.zeros([num_articles], dtype=tf.int32),  # number of finished hypotheses of each article
+            (  # the best finished hypothesis of each article
+                tf.fill([num_articles], -np.inf),
+                tf.zeros([num_articles], dtype=tf.int32),
+                tf.zeros([num_articles, max_dec_steps], dtype=tf.int32),
+                tf.zeros([num_articles, max_dec_steps]),
+                tf.zeros(tf.stack([num_articles, max_dec_steps, attn_len])),
+                tf.zeros([num_articles, max_dec_steps])
+            )
+        )
+        shape_invariants = (
+            tf.TensorShape([]),
+            tf.TensorShape([num_rows]),
+            tf.contrib.rnn.LSTMStateTuple(tf.TensorShape([num_rows, hps.hidden_dim]),
+                                          tf.TensorShape([num_rows, hps.hidden_dim])),
+            tf.TensorShape([num_rows, None]),
+            tf.TensorShape([num_rows]),
+            (
+                tf.TensorShape([num_rows, None]),
+                tf.TensorShape([num_rows, None]),
+                tf.TensorShape([num_rows, None, None]),
+                tf.TensorShape([num_rows, None])
+            ),
+            tf.TensorShape([num_articles]),
+            (
+                tf.TensorShape([num_articles]),
+                tf.TensorShape([num_articles]),
+                tf.TensorShape([num_articles, max_dec_steps]),
+                tf.TensorShape([num_articles, max_dec_steps]),
+                tf.TensorShape([num_articles, max_dec_steps, None]),
+                tf.TensorShape([num_articles, max_dec_steps])
+            )
+        )
+        steps, _, _, _, scores, histories, _, best = tf.while_loop(
+            cond, body, loop_vars, shape_invariants=shape_invariants, back_prop=False, swap_memory=True)
+
+        # Articles without any finished hypothesis take their best unfinished one. All of these have the same length.
+        live_rows = tf.argmax(tf.reshape(scores, [num_articles, beam_size]), axis=1,
+                              output_type=tf.int32) + first_rows
+        has_finished = tf.greater(best[1], 0)
+        tokens, log_probs, attn_hist, p_gen_hist = histories
+        self._graph_beam_search = {
+            'tokens': tf.where(has_finished, best[2], pad(tf.gather(tokens, live_rows))),
+            'lengths': tf.where(has_finished, best[1], tf.fill([num_articles], steps)),
+            'log_probs': tf.where(has_finished, best[3], pad(tf.gather(log_probs, live_rows))),
+            'attn_dists': tf.where(has_finished, best[4], pad(tf.gather(attn_hist, live_rows))),
+            'steps': steps
+        }
+        if self._pointer_gen:
+            self._graph_beam_search['p_gens'] = tf.where(has_finished, best[5], pad(tf.gather(p_gen_hist, live_rows)))
 
     def _add_train_op(self):
         """Sets self._train_op, the op to run for training."""
@@ -353,15 +887,29 @@ class SummarizationModel(object):
             name='train_step'
         )
 
-    def build_graph(self):
-        """Add the placeholders, model, global step, train_op and summaries to the graph"""
+    def build_graph(self, input_fn=None):
+        """Add the placeholders, model, global step, train_op and summaries to the graph
+
+        Args:
+          input_fn: Optional. In train and eval mode, a function of the vocab and pointer_gen that returns a dataset
+            of model inputs (see etl.model_input_dataset). The model then reads its inputs from an iterator of the dataset,
+            whose initializer is returned by iterator_initializer, instead of from placeholders.
+        """
         if self._graph is None:
             log.info('Building {} graph...'.format(self._mode))
             t0 = time.time()
             g = tf.Graph()
             with g.as_default():
                 tf.train.get_or_create_global_step()
-                self._add_placeholders()
+                inputs = None
+                if input_fn is not None:
+                    self._iterator = input_fn(self._vocab, self._pointer_gen).make_initializable_iterator()
+                    inputs = self._iterator.get_next()
+                self._add_placeholders(inputs)
+                if self._mode != Modes.PREDICT:
+                    # fraction of the encoder inputs of the batch that are words rather than padding
+                    self._padding_efficiency = tf.reduce_mean(self._enc_padding_mask)
+                    tf.summary.scalar('padding_efficiency', self._padding_efficiency)
                 self._add_seq2seq()
                 if self._mode == Modes.TRAIN:
                     self._add_train_op()
@@ -371,30 +919,45 @@ class SummarizationModel(object):
             self._graph = g
         return self._graph
 
+    def iterator_initializer(self):
+        """The initializer of the input iterator, if the graph was built with an input_fn"""
+        return self._iterator.initializer
+
+    def _to_batch(self, values, mode_name):
+        """Makes a Batch from the values of a batch of the input dataset (see etl.dataset and etl.encoded_dataset)"""
+        if self._hps.encoded_data:
+            return batcher.to_encoded_batch(vocab=self._vocab, hps=self._hps, pointer_gen=self._pointer_gen, **values)
+        articles, abstracts = values
+        for i in range(len(articles)):
+            article = articles[i]
+            abstract = abstracts[i]
+            log.debug('{} i={}\n\narticle={}\n\nabstract={}'.format(mode_name, i, repr(article), repr(abstract)))
+        return batcher.to_batch(
+            articles=articles,
+            abstracts=abstracts,
+            vocab=self._vocab,
+            hps=self._hps,
+            pointer_gen=self._pointer_gen
+        )
+
     def run_train_step(self, sess, next_batch):
         """Runs one training iteration.
-        Returns a dictionary containing train op, summaries, loss, global_step and (optionally) coverage loss.
+        next_batch is the next element of the input dataset, or None if the graph reads its inputs from an iterator.
+        Returns a dictionary containing train op, summaries, loss, global_step, padding_efficiency
+        and (optionally) coverage loss.
         """
 
         def step_fn(step_context):
-            articles, abstracts = step_context.session.run(next_batch)
-            for i in range(len(articles)):
-                article = articles[i]
-                abstract = abstracts[i]
-                log.debug('train i={}\n\narticle={}\n\nabstract={}'.format(i, repr(article), repr(abstract)))
-            batch = batcher.to_batch(
-                articles=articles,
-                abstracts=abstracts,
-                vocab=self._vocab,
-                hps=self._hps,
-                pointer_gen=self._pointer_gen
-            )
-            feed_dict = self._make_feed_dict(batch)
+            feed_dict = None
+            if next_batch is not None:
+                batch = self._to_batch(step_context.session.run(next_batch), 'train')
+                feed_dict = self._make_feed_dict(batch)
             to_return = {
                 'train_op': self._train_op,
                 'summaries': self._summaries,
                 'loss': self._loss,
-                'global_step': tf.train.get_global_step()
+                'global_step': tf.train.get_global_step(),
+                'padding_efficiency': self._padding_efficiency
             }
             if self._coverage:
                 to_return['coverage_loss'] = self._coverage_loss
@@ -404,74 +967,102 @@ class SummarizationModel(object):
 
     def run_eval_step(self, sess, next_batch):
         """Runs one evaluation iteration.
-        Returns a dictionary containing summaries, loss, global_step and (optionally) coverage loss.
+        next_batch is the next element of the input dataset, or None if the graph reads its inputs from an iterator.
+        Returns a dictionary containing summaries, loss, global_step, padding_efficiency and (optionally) coverage loss.
         """
-        articles, abstracts = sess.run(next_batch)
-        for i in range(len(articles)):
-            article = articles[i]
-            abstract = abstracts[i]
-            log.debug('eval i={}\n\narticle={}\n\nabstract={}'.format(i, repr(article), repr(abstract)))
-        log.debug('eval len(articles)={}, len(abstracts)={}'.format(len(articles), len(abstracts)))
-        batch = batcher.to_batch(
-            articles=articles,
-            abstracts=abstracts,
-            vocab=self._vocab,
-            hps=self._hps,
-            pointer_gen=self._pointer_gen
-        )
-        feed_dict = self._make_feed_dict(batch)
+        feed_dict = None
+        if next_batch is not None:
+            batch = self._to_batch(sess.run(next_batch), 'eval')
+            feed_dict = self._make_feed_dict(batch)
         to_return = {
             'summaries': self._summaries,
             'loss': self._loss,
-            'global_step': tf.train.get_global_step()
+            'global_step': tf.train.get_global_step(),
+            'padding_efficiency': self._padding_efficiency
         }
         if self._coverage:
             to_return['coverage_loss'] = self._coverage_loss
         return sess.run(to_return, feed_dict)
 
     def run_encoder(self, sess, batch):
-        """For beam search decoding. Run the encoder on the batch and return the encoder states and decoder initial state.
+        """For beam search decoding. Run the encoder on the batch and return the encoder states, their attention features and decoder initial state.
 
         Args:
           sess: Tensorflow session.
-          batch: Batch object that is the same example repeated across the batch (for beam search)
+          batch: Batch object where each article is repeated beam_size times in consecutive rows (for beam search)
 
         Returns:
-          enc_states: The encoder states. A tensor of shape [batch_size, <=max_enc_steps, 2*hidden_dim].
-          dec_in_state: A LSTMStateTuple of shape ([1,hidden_dim],[1,hidden_dim])
+          enc_states: The encoder states, one row per article. A tensor of shape [num_articles, <=max_enc_steps, 2*hidden_dim].
+          enc_features: The attention features (W_h h_i) of the encoder states. A tensor of shape [num_articles, <=max_enc_steps, 1, 2*hidden_dim].
+          dec_in_states: List of LSTMStateTuples of shape ([hidden_dim,],[hidden_dim,]), one for each article in the batch
+
+          With hps.stateful_decode, enc_states and enc_features are None, and dec_in_states are the rows of the decode state variables that hold the initial state of each article.
         """
         feed_dict = self._make_feed_dict(batch, just_enc=True)  # feed the batch into the placeholders
-        (enc_states, dec_in_state, global_step) = sess.run(
-            [self._enc_states, self._dec_in_state, tf.train.get_global_step()],
+        if self._hps.stateful_decode:
+            # The encoder outputs and the initial decoder states stay in the decode state variables.
+            # Every hypothesis of an article starts from the state in the first row of the article.
+            sess.run(self._init_decode_state, feed_dict)
+            num_articles = batch.enc_batch.shape[0] // self._beam_size
+            return None, None, [i * self._beam_size for i in range(num_articles)]
+        (enc_states, enc_features, dec_in_state, global_step) = sess.run(
+            [self._article_enc_states, self._article_enc_features, self._article_dec_in_state,
+             tf.train.get_global_step()],
             feed_dict)  # run the encoder
 
-        # dec_in_state is LSTMStateTuple shape ([batch_size,hidden_dim],[batch_size,hidden_dim])
-        # Given that the batch is a single example repeated, dec_in_state is identical across the batch so we just take the top row.
-        dec_in_state = tf.contrib.rnn.LSTMStateTuple(dec_in_state.c[0], dec_in_state.h[0])
-        return enc_states, dec_in_state
+        # dec_in_state is LSTMStateTuple shape ([num_articles,hidden_dim],[num_articles,hidden_dim])
+        dec_in_states = [tf.contrib.rnn.LSTMStateTuple(dec_in_state.c[i], dec_in_state.h[i])
+                         for i in range(dec_in_state.c.shape[0])]
+        return enc_states, enc_features, dec_in_states
 
-    def decode_onestep(self, sess, batch, latest_tokens, enc_states, dec_init_states, prev_coverage):
+    def run_graph_beam_search(self, sess, batch):
+        """For in-graph beam search decoding. Run the encoder and the whole beam search on the batch in a single session run.
+
+        Args:
+          sess: Tensorflow session.
+          batch: Batch object where each article is repeated beam_size times in consecutive rows
+
+        Returns:
+          A dictionary of numpy arrays with one row per article, describing the best hypothesis of each article:
+            tokens: The decoded ids, excluding the [START] token. shape (num_articles, max_dec_steps)
+            lengths: The number of decoded ids. shape (num_articles)
+            log_probs: The log probability of each decoded id. shape (num_articles, max_dec_steps)
+            attn_dists: The attention distribution on each step. shape (num_articles, max_dec_steps, attn_length)
+            p_gens: The generation probability on each step. shape (num_articles, max_dec_steps). Only in pointer-generator mode.
+            steps: The number of decoder steps that were run.
+        """
+        feed_dict = self._make_feed_dict(batch, just_enc=True)
+        return sess.run(self._graph_beam_search, feed_dict)
+
+    def decode_onestep(self, sess, batch, latest_tokens, enc_states, enc_features, dec_init_states, prev_coverage):
         """For beam search decoding. Run the decoder for one step.
 
         Args:
           sess: Tensorflow session.
-          batch: Batch object containing single example repeated across the batch
+          batch: Batch object where each article is repeated beam_size times in consecutive rows
           latest_tokens: Tokens to be fed as input into the decoder for this timestep
-          enc_states: The encoder states.
-          dec_init_states: List of beam_size LSTMStateTuples; the decoder states from the previous timestep
+          enc_states: The encoder states, one row per article, as returned by run_encoder.
+          enc_features: The attention features of the encoder states, as returned by run_encoder.
+          dec_init_states: List of batch_size LSTMStateTuples; the decoder states from the previous timestep
           prev_coverage: List of np arrays. The coverage vectors from the previous timestep. List of None if not using coverage.
 
         Returns:
-          ids: top 2k ids. shape [beam_size, 2*beam_size]
-          probs: top 2k log probabilities. shape [beam_size, 2*beam_size]
-          new_states: new states of the decoder. a list length beam_size containing
+          ids: top 2k ids. shape [batch_size, 2*beam_size]
+          probs: top 2k log probabilities. shape [batch_size, 2*beam_size]
+          new_states: new states of the decoder. a list length batch_size containing
             LSTMStateTuples each of shape ([hidden_dim,],[hidden_dim,])
-          attn_dists: List length beam_size containing lists length attn_length.
-          p_gens: Generation probabilities for this step. A list length beam_size. List of None if in baseline mode.
+          attn_dists: List length batch_size containing lists length attn_length.
+          p_gens: Generation probabilities for this step. A list length batch_size. List of None if in baseline mode.
           new_coverage: Coverage vectors for this step. A list of arrays. List of None if coverage is not turned on.
+
+        With hps.stateful_decode, the decoder states and coverage vectors stay in the decode state variables.
+        dec_init_states are then the rows holding the state of each hypothesis' parent, and new_states are the rows holding the new states.
+        Only the latest tokens and these rows are fed, and only the top k are fetched: attn_dists, p_gens and new_coverage are lists of None.
         """
+        if self._hps.stateful_decode:
+            return self._decode_onestep_stateful(sess, batch, latest_tokens, dec_init_states)
 
-        beam_size = len(dec_init_states)
+        batch_size = len(dec_init_states)
 
         # Turn dec_init_states (a list of LSTMStateTuples) into a single LSTMStateTuple for the batch
         cells = [np.expand_dims(state.c, axis=0) for state in dec_init_states]
@@ -481,7 +1072,8 @@ class SummarizationModel(object):
         new_dec_in_state = tf.contrib.rnn.LSTMStateTuple(new_c, new_h)
 
         feed = {
-            self._enc_states: enc_states,
+            self._article_enc_states: enc_states,  # repeated beam_size times inside the graph
+            self._article_enc_features: enc_features,  # the attention features are not recomputed
             self._enc_padding_mask: batch.enc_padding_mask,
             self._dec_in_state: new_dec_in_state,
             self._dec_batch: np.transpose(np.array([latest_tokens])),
@@ -503,11 +1095,14 @@ class SummarizationModel(object):
             feed[self.prev_coverage] = np.stack(prev_coverage, axis=0)
             to_return['coverage'] = self.coverage
 
+        if self._hps.shortlist_size > 0:
+            feed[self._enc_batch] = batch.enc_batch[::self._beam_size]  # the article words of the vocabulary shortlist
+
         results = sess.run(to_return, feed_dict=feed)  # run the decoder step
 
         # Convert results['states'] (a single LSTMStateTuple) into a list of LSTMStateTuple -- one for each hypothesis
         new_states = [tf.contrib.rnn.LSTMStateTuple(results['states'].c[i, :], results['states'].h[i, :]) for i in
-                      range(beam_size)]
+                      range(batch_size)]
 
         # Convert singleton list containing a tensor to a list of k arrays
         assert len(results['attn_dists']) == 1
@@ -518,32 +1113,108 @@ class SummarizationModel(object):
             assert len(results['p_gens']) == 1
             p_gens = results['p_gens'][0].tolist()
         else:
-            p_gens = [None for _ in range(beam_size)]
+            p_gens = [None for _ in range(batch_size)]
 
         # Convert the coverage tensor to a list length k containing the coverage vector for each hypothesis
         if self._coverage:
             new_coverage = results['coverage'].tolist()
-            assert len(new_coverage) == beam_size
+            assert len(new_coverage) == batch_size
         else:
-            new_coverage = [None for _ in range(beam_size)]
+            new_coverage = [None for _ in range(batch_size)]
 
         return results['ids'], results['probs'], new_states, attn_dists, p_gens, new_coverage
 
+    def _decode_onestep_stateful(self, sess, batch, latest_tokens, beam_parents):
+        """Run the decoder for one step, reading and writing the decoder states in the decode state variables. See decode_onestep."""
+        batch_size = len(beam_parents)
+        feed = {
+            self._dec_batch: np.transpose(np.array([latest_tokens])),
+            self._beam_parents: beam_parents
+        }
+        if self._pointer_gen:
+            feed[self._max_art_oovs] = batch.max_art_oovs
+        to_return = {
+            "ids": self._topk_ids,
+            "probs": self._topk_log_probs,
+            "update": self._update_decode_state
+        }
+        results = sess.run(to_return, feed_dict=feed)  # run the decoder step
+
+        # The new state of the hypothesis in row i has been written to row i
+        new_states = list(range(batch_size))
+        nones = [None for _ in range(batch_size)]
+        return results['ids'], results['probs'], new_states, nones, nones, nones
+
+
+def _batch_gather(params, indices):
+    """Gathers from each row of params: result[i, j] = params[i, indices[i, j]]
+
+    Args:
+      params: tensor shape (batch_size, n)
+      indices: int32 tensor shape (batch_size, k)
+
+    Returns:
+      tensor shape (batch_size, k)
+    """
+    batch_nums = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1), [1, tf.shape(indices)[1]])
+    return tf.gather_nd(params, tf.stack((batch_nums, indices), axis=2))
+
+
+def _unique_per_row(ids, max_id):
+    """Number the distinct ids of each row
+
+    Args:
+      ids: int32 tensor shape (batch_size, n), with values in [0, max_id)
+      max_id: int32 scalar
+
+    Returns:
+      segments: The number of the distinct id of each row at each position, counting over the whole batch. shape (batch_size, n)
+      num_segments: The number of distinct ids, counting over the whole batch. int32 scalar
+      is_first: Whether each position holds the first occurrence of its id in its row. shape (batch_size, n)
+    """
+    keys = tf.expand_dims(tf.to_int64(tf.range(tf.shape(ids)[0])), 1) * tf.to_int64(max_id) + tf.to_int64(ids)
+    unique_keys, segments = tf.unique(tf.reshape(keys, [-1]))
+    num_segments = tf.size(unique_keys)
+    positions = tf.range(tf.size(segments))
+    is_first = tf.equal(positions, tf.gather(tf.unsorted_segment_min(positions, segments, num_segments), segments))
+    return tf.reshape(segments, tf.shape(ids)), num_segments, tf.reshape(is_first, tf.shape(ids))
+
+
+def _gold_probs(log_vocab_probs, in_vocab, p_gens, attn_dists, enc_batch_extend_vocab, target_batch):
+    """The final probabilities of the target words in the pointer-generator model, without the final distributions:
+    p_gen times the vocabulary probability of the target word, plus (1-p_gen) times the attention on the encoder positions that hold it.
+
+    Args:
+      log_vocab_probs: The log vocabulary probabilities of the target words. shape (batch_size, dec_steps)
+      in_vocab: Whether the target words are in the vocabulary, rather than in-article OOVs. shape (batch_size, dec_steps)
+      p_gens: The generation probabilities. shape (batch_size, dec_steps, 1)
+      attn_dists: The attention distributions. shape (batch_size, dec_steps, attn_len)
+      enc_batch_extend_vocab: The encoder ids, where in-article OOVs are represented by their temporary OOV ids. shape (batch_size, attn_len)
+      target_batch: The target ids. shape (batch_size, dec_steps)
+
+    Returns:
+      tensor shape (batch_size, dec_steps)
+    """
+    p_gens = p_gens[:, :, 0]
+    vocab_probs = tf.where(in_vocab, tf.exp(log_vocab_probs), tf.zeros_like(log_vocab_probs))
+    is_target = tf.equal(tf.expand_dims(enc_batch_extend_vocab, 1), tf.expand_dims(target_batch, 2))  # shape (batch_size, dec_steps, attn_len)
+    copy_probs = tf.reduce_sum(attn_dists * tf.to_float(is_target), axis=2)
+    return p_gens * vocab_probs + (1 - p_gens) * copy_probs
+
 
 def _mask_and_avg(values, padding_mask):
     """Applies mask to values then returns overall average (a scalar)
 
     Args:
-      values: a list length max_dec_steps containing arrays shape (batch_size).
-      padding_mask: tensor shape (batch_size, max_dec_steps) containing 1s and 0s.
+      values: tensor shape (batch_size, dec_steps).
+      padding_mask: tensor shape (batch_size, dec_steps) containing 1s and 0s.
 
     Returns:
       a scalar
     """
 
     dec_lens = tf.reduce_sum(padding_mask, axis=1)  # shape batch_size. float32
-    values_per_step = [v * padding_mask[:, dec_step] for dec_step, v in enumerate(values)]
-    values_per_ex = sum(values_per_step) / dec_lens  # shape (batch_size); normalized value for each batch member
+    values_per_ex = tf.reduce_sum(values * padding_mask, axis=1) / dec_lens  # shape (batch_size); normalized value for each batch member
     return tf.reduce_mean(values_per_ex)  # overall average
 
 
@@ -551,17 +1222,13 @@ def _coverage_loss(attn_dists, padding_mask):
     """Calculates the coverage loss from the attention distributions.
 
     Args:
-      attn_dists: The attention distributions for each decoder timestep. A list length max_dec_steps containing shape (batch_size, attn_length)
-      padding_mask: shape (batch_size, max_dec_steps).
+      attn_dists: The attention distributions for each decoder timestep. shape (batch_size, dec_steps, attn_length)
+      padding_mask: shape (batch_size, dec_steps).
 
     Returns:
       coverage_loss: scalar
     """
-    coverage = tf.zeros_like(attn_dists[0])  # shape (batch_size, attn_length). Initial coverage is zero.
-    covlosses = []  # Coverage loss per decoder timestep. Will be list length max_dec_steps containing shape (batch_size).
-    for a in attn_dists:
-        covloss = tf.reduce_sum(tf.minimum(a, coverage), [1])  # calculate the coverage loss for this step
-        covlosses.append(covloss)
-        coverage += a  # update the coverage vector
+    coverage = tf.cumsum(attn_dists, axis=1, exclusive=True)  # coverage vector before each step. Initial coverage is zero.
+    covlosses = tf.reduce_sum(tf.minimum(attn_dists, coverage), [2])  # coverage loss per decoder timestep. shape (batch_size, dec_steps)
     coverage_loss = _mask_and_avg(covlosses, padding_mask)
     return coverage_loss
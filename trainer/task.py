@@ -22,7 +22,7 @@ import argparse
 import tensorflow as tf
 from tensorflow import logging as log
 import numpy as np
-from trainer.data import Vocab
+from trainer.data import load_vocab
 from trainer.batcher import Batcher
 from trainer.model import SummarizationModel
 from trainer.decode import BeamSearchDecoder
@@ -148,7 +148,7 @@ def __session(checkpoint_dir, debug, conf, local_init_ops):
             saver=tf.train.Saver(max_to_keep=conf.keep_checkpoint_max),
             # Dataset initializer needs to run on each worker as they start
             # see https://github.com/tensorflow/tensorflow/issues/12859
-            local_init_op=tf.group(tf.local_variables_initializer(), *local_init_ops)
+            local_init_op=tf.group(tf.local_variables_initializer(), tf.tables_initializer(), *local_init_ops)
         )
     )
     if debug:  # start the tensorflow debugger
@@ -157,18 +157,88 @@ def __session(checkpoint_dir, debug, conf, local_init_ops):
     return sess
 
 
+def __dataset(data_dir, batch_size, hps, shuffle=False, repeat=False):
+    """Input dataset of training and eval mode: encoded token ids if hps.encoded_data, otherwise text.
+    Unless it repeats, as in eval mode, the partial batches are kept so that every example is read."""
+    bucket_boundaries, bucket_batch_sizes = __buckets(hps)
+    if hps.encoded_data:
+        return etl.encoded_dataset(data_dir, hps.vocab_version, batch_size, shuffle=shuffle, repeat=repeat,
+                                   bucket_boundaries=bucket_boundaries,
+                                   bucket_batch_sizes=bucket_batch_sizes,
+                                   input_options=__input_options(hps),
+                                   drop_remainder=repeat)
+    return etl.dataset(data_dir, batch_size, shuffle=shuffle, repeat=repeat,
+                       preprocess_processes=hps.preprocess_processes,
+                       preprocess_batch_size=hps.preprocess_batch_size,
+                       bucket_boundaries=bucket_boundaries,
+                       bucket_batch_sizes=bucket_batch_sizes,
+                       input_options=__input_options(hps),
+                       drop_remainder=repeat)
+
+
+def __input_options(hps):
+    """How the input files of training and eval mode are read, shuffled and prefetched"""
+    return etl.InputOptions(
+        parallel_reads=hps.parallel_reads,
+        parallel_calls=hps.parallel_calls,
+        shuffle_buffer_size=hps.shuffle_buffer_size,
+        prefetch_batches=hps.prefetch_batches)
+
+
+def __int_list(value):
+    """List of the ints in the comma separated string value"""
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def __buckets(hps):
+    """Bucket boundaries and batch sizes of the training and eval data, with a token budget if hps.batch_tokens"""
+    bucket_boundaries = __int_list(hps.bucket_boundaries)
+    if hps.batch_tokens:
+        # each article also runs the decoder for up to max_dec_steps, whatever its length
+        return etl.token_budget_buckets(hps.batch_tokens, hps.max_enc_steps, bucket_boundaries,
+                                        decoder_length=hps.max_dec_steps)
+    return bucket_boundaries, __int_list(hps.bucket_batch_sizes)
+
+
+def __model_input_fn(data_dir, batch_size, hps, shuffle=False, repeat=False):
+    """Function of the vocab and pointer_gen that makes the dataset of model inputs, if hps.graph_input.
+    Unless it repeats, as in eval mode, the partial batches are kept so that every example is read."""
+    if not hps.graph_input:
+        return None
+    bucket_boundaries, bucket_batch_sizes = __buckets(hps)
+    return lambda vocab, pointer_gen: etl.model_input_dataset(
+        data_dir, vocab, batch_size,
+        max_enc_steps=hps.max_enc_steps,
+        max_dec_steps=hps.max_dec_steps,
+        pointer_gen=pointer_gen,
+        shuffle=shuffle,
+        repeat=repeat,
+        preprocess_processes=hps.preprocess_processes,
+        preprocess_batch_size=hps.preprocess_batch_size,
+        bucket_boundaries=bucket_boundaries,
+        bucket_batch_sizes=bucket_batch_sizes,
+        input_options=__input_options(hps),
+        drop_remainder=repeat)
+
+
 def __run_training(model, data_dir, coverage, debug, conf, hps):
     """Repeatedly runs training iterations, logging loss to screen and writing summaries"""
     log.debug("starting run_training")
     checkpoint_dir = os.path.join(conf.model_dir, 'train')
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
-    with model.build_graph().as_default():
+    input_fn = __model_input_fn(data_dir, hps.batch_size, hps, shuffle=True, repeat=True)
+    with model.build_graph(input_fn).as_default():
         summary_writer = tf.summary.FileWriterCache.get(checkpoint_dir)
-        ds = etl.dataset(data_dir, hps.batch_size, shuffle=True, repeat=True)
-        iterator = ds.make_one_shot_iterator()
-        ds_init_op = iterator.make_initializer(ds)
-        next_batch = iterator.get_next()
+        if input_fn is not None:
+            # the model reads its inputs from the graph
+            ds_init_op = model.iterator_initializer()
+            next_batch = None
+        else:
+            ds = __dataset(data_dir, hps.batch_size, hps=hps, shuffle=True, repeat=True)
+            iterator = ds.make_one_shot_iterator()
+            ds_init_op = iterator.make_initializer(ds)
+            next_batch = iterator.get_next()
         with __session(
                 checkpoint_dir=checkpoint_dir,
                 debug=debug,
@@ -189,6 +259,7 @@ def __run_training(model, data_dir, coverage, debug, conf, hps):
                 if coverage:
                     coverage_loss = results['coverage_loss']
                     msg += ", coverage_loss={:.4f}".format(coverage_loss)
+                msg += ", padding_efficiency={:.2f}".format(results['padding_efficiency'])
                 log.info(msg)
                 # get the summaries and iteration number so we can write summaries to tensorboard
                 summaries = results['summaries']
@@ -196,7 +267,7 @@ def __run_training(model, data_dir, coverage, debug, conf, hps):
     log.info('training done')
 
 
-def __run_eval(model, data_dir, coverage, conf, batch_size):
+def __run_eval(model, data_dir, coverage, conf, batch_size, hps):
     checkpoint_dir = os.path.join(conf.model_dir, 'eval')  # make a subdir of the root dir for eval data
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
@@ -206,9 +277,16 @@ def __run_eval(model, data_dir, coverage, conf, batch_size):
     step = 0
     seen_steps = set()
     do_eval = True
-    with model.build_graph().as_default():
-        ds = etl.dataset(data_dir, batch_size)
-        iterator = ds.make_initializable_iterator()
+    input_fn = __model_input_fn(data_dir, batch_size, hps)
+    with model.build_graph(input_fn).as_default():
+        if input_fn is not None:
+            # the model reads its inputs from the graph
+            ds_init_op = model.iterator_initializer()
+        else:
+            ds = __dataset(data_dir, batch_size, hps=hps)
+            iterator = ds.make_initializable_iterator()
+            ds_init_op = iterator.initializer
+        tables_init_op = tf.tables_initializer()
         saver = tf.train.Saver(max_to_keep=3)  # we will keep 3 best checkpoints at a time
         summary_writer = tf.summary.FileWriter(checkpoint_dir)
         with tf.Session(config=conf.session_config) as sess:
@@ -218,8 +296,8 @@ def __run_eval(model, data_dir, coverage, conf, batch_size):
                 util.load_ckpt(saver, sess, log_root=conf.model_dir)
                 running_avg_loss = 0
                 # init new epoch
-                sess.run(iterator.initializer)
-                next_batch = iterator.get_next()
+                sess.run([ds_init_op, tables_init_op])
+                next_batch = iterator.get_next() if input_fn is None else None
                 batch_count = 0
                 t0 = time.time()
                 try:
@@ -250,6 +328,7 @@ def __run_eval(model, data_dir, coverage, conf, batch_size):
                         if coverage:
                             coverage_loss = results['coverage_loss']
                             msg += ", coverage_loss={:.4f}".format(coverage_loss)
+                        msg += ", padding_efficiency={:.2f}".format(results['padding_efficiency'])
                         log.info(msg)
                         # flush the summary writer every so often
                         if batch_count % 10 == 0:
@@ -316,8 +395,8 @@ def __main(
 ):
     __log_verbosity(verbosity)
     log.info('Starting seq2seq_attention in %s mode...', mode)
-    vocab = Vocab(vocab_path, vocab_size)  # create a vocabulary
-    hps = __hparams(**hparams)
+    vocab = load_vocab(vocab_path, vocab_size)  # create a vocabulary
+    hps = __hparams(vocab_version=vocab.version(), **hparams)
     conf = util.run_config(model_dir=job_dir, random_seed=random_seed)
     log.info('hps={}\nconf={}'.format(repr(hps), util.repr_run_config(conf)))
     model = SummarizationModel(
@@ -326,6 +405,7 @@ def __main(
         mode=mode,
         pointer_gen=pointer_gen,
         coverage=coverage,
+        beam_size=beam_size,
         conf=conf
     )
     if mode == Modes.TRAIN:
@@ -346,7 +426,8 @@ def __main(
             conf=conf,
             batch_size=hps.batch_size,
             data_dir=data_dir,
-            coverage=coverage
+            coverage=coverage,
+            hps=hps
         )
         return
     if mode == Modes.PREDICT:
@@ -385,7 +466,7 @@ if __name__ == '__main__':
         '--vocab_path',
         type=str,
         required=True,
-        help='Path expression to text vocabulary file.')
+        help='Path expression to text vocabulary file, or to a local compiled vocabulary file (vocab.bin).')
     modes = [Modes.TRAIN, Modes.EVAL, Modes.PREDICT]
     parser.add_argument(
         '--mode',
@@ -448,6 +529,177 @@ if __name__ == '__main__':
         type=int,
         default=4,
         help='beam size for beam search decoding.')
+    parser.add_argument(
+        '--decode_batch_articles',
+        type=int,
+        default=1,
+        help="""\
+        For decode mode only.
+        Number of articles decoded together. Each decoder step extends the hypotheses of all
+        these articles in a single batch of decode_batch_articles * beam_size rows.\
+        """)
+    parser.add_argument(
+        '--stateful_decode',
+        type=bool,
+        default=False,
+        help="""\
+        For decode mode only.
+        If True, keep the encoder outputs and the decoder state of each hypothesis in graph variables between
+        beam search steps, so that each step only feeds the latest tokens and the parent row of each hypothesis.\
+        """)
+    parser.add_argument(
+        '--graph_beam_search',
+        type=bool,
+        default=False,
+        help="""\
+        For decode mode only.
+        If True, run the whole beam search as a loop inside the graph, so that each batch of articles
+        is decoded with a single session run.\
+        """)
+    parser.add_argument(
+        '--sparse_final_dist',
+        type=bool,
+        default=False,
+        help="""\
+        For decode mode and pointer-generator model only.
+        If True, take the top candidates of each decoder step from the most likely words of the vocabulary distribution
+        and from the article words, instead of from the final distribution over the whole extended vocabulary.
+        The candidates and their probabilities are the same.\
+        """)
+    parser.add_argument(
+        '--encoded_data',
+        type=bool,
+        default=False,
+        help="""\
+        For train and eval modes.
+        If True, data_dir contains token ids encoded by vocab.py --encode with the same vocabulary,
+        instead of text.\
+        """)
+    parser.add_argument(
+        '--graph_input',
+        type=bool,
+        default=False,
+        help="""\
+        For train and eval modes.
+        If True, map words to ids, pad and mask the batches in the input pipeline of the graph,
+        instead of making batches in python and feeding them to the model.\
+        """)
+    parser.add_argument(
+        '--preprocess_processes',
+        type=int,
+        default=0,
+        help="""\
+        For train and eval modes.
+        Number of worker processes that tokenize the articles and abstracts of the input dataset.
+        If 0, tokenize in the training process.\
+        """)
+    parser.add_argument(
+        '--preprocess_batch_size',
+        type=int,
+        default=64,
+        help="""\
+        For train and eval modes.
+        Number of examples of the input dataset that are tokenized together.\
+        """)
+    parser.add_argument(
+        '--parallel_reads',
+        type=int,
+        default=4,
+        help="""\
+        For train and eval modes.
+        Number of input files read at the same time, whose records are interleaved.
+        In train mode, the files are also read in random order.\
+        """)
+    parser.add_argument(
+        '--parallel_calls',
+        type=int,
+        default=4,
+        help="""\
+        For train and eval modes.
+        Number of input records parsed and mapped to model inputs in parallel.\
+        """)
+    parser.add_argument(
+        '--shuffle_buffer_size',
+        type=int,
+        default=1000,
+        help="""\
+        For train mode only.
+        Number of input records from which each training example is drawn at random.\
+        """)
+    parser.add_argument(
+        '--prefetch_batches',
+        type=int,
+        default=2,
+        help="""\
+        For train and eval modes.
+        Number of batches made ahead, while the model runs a step on the current batch. If 0, do not prefetch.\
+        """)
+    parser.add_argument(
+        '--bucket_boundaries',
+        type=str,
+        default='',
+        help="""\
+        For train and eval modes.
+        Comma separated, increasing article lengths (in words) at which to split the input data into buckets,
+        e.g. 100,200,300. Each batch is made of articles of one bucket, which reduces padding.
+        If empty, do not bucket.\
+        """)
+    parser.add_argument(
+        '--bucket_batch_sizes',
+        type=str,
+        default='',
+        help="""\
+        For train and eval modes.
+        Comma separated batch sizes of the buckets given by --bucket_boundaries, one more than the boundaries.
+        If empty, all buckets have batches of --batch_size.\
+        """)
+    parser.add_argument(
+        '--batch_tokens',
+        type=int,
+        default=0,
+        help="""\
+        For train and eval modes.
+        If greater than 0, fill each batch with articles of similar length up to this many tokens,
+        counting the padded article tokens and --max_dec_steps abstract tokens per article,
+        instead of making batches of --batch_size articles. Buckets are made at --bucket_boundaries if given,
+        otherwise at lengths that grow by 10%% up to --max_enc_steps.\
+        """)
+    parser.add_argument(
+        '--example_processes',
+        type=int,
+        default=0,
+        help="""\
+        For decode mode only.
+        If greater than 0, tokenize the examples and map them to ids in this many worker processes,
+        instead of in threads of the batcher.\
+        """)
+    parser.add_argument(
+        '--beam_early_stop',
+        type=bool,
+        default=False,
+        help="""\
+        For decode mode only.
+        If True, stop beam search on an article as soon as none of its live hypotheses can beat its best finished
+        hypothesis. Not used with graph_beam_search.\
+        """)
+    parser.add_argument(
+        '--beam_prune_relative',
+        type=float,
+        default=0.0,
+        help="""\
+        For decode mode only.
+        If greater than 0, prune hypotheses whose probability is less than this fraction of the probability
+        of the best hypothesis in the beam. Not used with graph_beam_search.\
+        """)
+    parser.add_argument(
+        '--beam_prune_absolute',
+        type=float,
+        default=0.0,
+        help="""\
+        For decode mode only.
+        If greater than 0, prune hypotheses whose log probability is more than this much lower than the log probability
+        of the best hypothesis in the beam. Not used with graph_beam_search.\
+        """)
     parser.add_argument(
         '--min_dec_steps',
         type=int,
@@ -513,6 +765,26 @@ if __name__ == '__main__':
         Weight of coverage loss (lambda in the paper). 
         If zero, then no incentive to minimize coverage loss.\
         """)
+    parser.add_argument(
+        '--sampled_softmax',
+        type=int,
+        default=0,
+        help="""\
+        For train mode only.
+        If greater than 0, compute the training loss with a softmax over the target word and this many words
+        sampled from the vocabulary, instead of a softmax over the whole vocabulary.
+        Eval mode always uses the whole vocabulary.\
+        """)
+    parser.add_argument(
+        '--shortlist_size',
+        type=int,
+        default=0,
+        help="""\
+        For decode mode only.
+        If greater than 0, compute the vocabulary distribution of each decoder step over a shortlist only:
+        this many most frequent words of the vocabulary, which include the special tokens, and the words of the article.
+        Run trainer/compare_decodes.py on a single_pass decode with and without it to check the accuracy.\
+        """)
     parser.add_argument(
         '--convert_to_coverage_model',
         type=bool,
@@ -550,10 +822,50 @@ if __name__ == '__main__':
     args = parser.parse_args()
     if args.single_pass and args.mode != Modes.PREDICT:
         raise ValueError('--single_pass flag should only be True in {} mode'.format(repr(Modes.PREDICT)))
-    # If in decode mode, set batch_size = beam_size
-    # Reason: in decode mode, we decode one example at a time.
-    # On each step, we have beam_size-many hypotheses in the beam,
+    # If in decode mode, set batch_size = beam_size * decode_batch_articles
+    # Reason: in decode mode, we decode decode_batch_articles examples at a time.
+    # On each step, we have beam_size-many hypotheses in the beam of each example,
     # so we need to make a batch of these hypotheses.
+    if args.decode_batch_articles < 1:
+        raise ValueError('--decode_batch_articles must be at least 1')
+    if not 0.0 <= args.beam_prune_relative <= 1.0:
+        raise ValueError('--beam_prune_relative must be between 0 and 1')
+    if args.graph_input and args.encoded_data:
+        raise ValueError('--graph_input reads text data; it cannot be used with --encoded_data')
+    if args.preprocess_processes < 0:
+        raise ValueError('--preprocess_processes must not be negative')
+    if args.preprocess_batch_size < 1:
+        raise ValueError('--preprocess_batch_size must be at least 1')
+    if args.example_processes < 0:
+        raise ValueError('--example_processes must not be negative')
+    if args.beam_prune_absolute < 0.0:
+        raise ValueError('--beam_prune_absolute must not be negative')
+    bucket_boundaries = __int_list(args.bucket_boundaries)
+    bucket_batch_sizes = __int_list(args.bucket_batch_sizes)
+    if bucket_boundaries != sorted(set(bucket_boundaries)) or any(b < 1 for b in bucket_boundaries):
+        raise ValueError('--bucket_boundaries must be increasing positive lengths')
+    if bucket_batch_sizes and len(bucket_batch_sizes) != len(bucket_boundaries) + 1:
+        raise ValueError('--bucket_batch_sizes must have one more size than --bucket_boundaries')
+    if args.parallel_reads < 1:
+        raise ValueError('--parallel_reads must be at least 1')
+    if args.parallel_calls < 1:
+        raise ValueError('--parallel_calls must be at least 1')
+    if args.shuffle_buffer_size < 1:
+        raise ValueError('--shuffle_buffer_size must be at least 1')
+    if args.prefetch_batches < 0:
+        raise ValueError('--prefetch_batches must not be negative')
+    if args.sampled_softmax < 0:
+        raise ValueError('--sampled_softmax must not be negative')
+    if args.vocab_size > 0 and args.sampled_softmax >= args.vocab_size:
+        raise ValueError('--sampled_softmax must be smaller than --vocab_size')
+    if 0 < args.shortlist_size < 4:
+        raise ValueError('--shortlist_size must be 0 or at least 4, the number of special tokens')
+    if args.batch_tokens < 0:
+        raise ValueError('--batch_tokens must not be negative')
+    if args.batch_tokens and bucket_batch_sizes:
+        raise ValueError('--bucket_batch_sizes cannot be used with --batch_tokens')
+    if 0 < args.batch_tokens < args.max_enc_steps + args.max_dec_steps:
+        raise ValueError('--batch_tokens must be at least --max_enc_steps + --max_dec_steps')
     if args.mode == Modes.PREDICT:
-        args.batch_size = args.beam_size
+        args.batch_size = args.beam_size * args.decode_batch_articles
     __main(**vars(args))
@@ -1,15 +1,29 @@
 import argparse
+import hashlib
+import json
 import logging as log
 import sys
 import os
 import time
 import datetime
 import collections
+import itertools
+from multiprocessing import Pool
 import tensorflow as tf
 from trainer import etl
+from trainer.data import Vocab, compile_vocab
 
 ENCODING = 'utf-8'
 
+# Incremental ETL state in out_dir: for each story (input path), the hash of its content, and its split, shard and index
+# in the shard; and the vocab counts of all stories
+STATE_FILE = 'etl_state.json'
+# Journal of the shards rewritten by the current incremental run, one json line per shard,
+# which is replayed onto the state if the run is interrupted before it saves the state
+JOURNAL_FILE = 'etl_state.journal'
+
+SPLITS = ['train', 'val', 'test']
+
 log.basicConfig(
     format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s",
     handlers=[log.StreamHandler(sys.stdout)],
@@ -29,9 +43,11 @@ def __save_vocab_file(out_dir, vocab_counter, vocab_size):
     log.info('Saving vocab file...')
     _path = os.path.join(out_dir, 'vocab.tsv')
     with open(_path, 'w', encoding=ENCODING) as w:
-        for word, count in vocab_counter.most_common(vocab_size):
+        # sort ties by word, so that the vocab does not depend on the order in which stories were counted
+        for word, count in sorted(vocab_counter.items(), key=lambda wc: (-wc[1], wc[0]))[:vocab_size]:
             w.write(word + '\t' + str(count) + '\n')
     log.info('Saved vocab file [%s]', repr(_path))
+    return _path
 
 
 def __article_abstract_tuple(file_path):
@@ -63,11 +79,32 @@ def __clean(directory):
         os.remove(os.path.join(directory, name))
 
 
-def __save_tfrecord(file_path, article, abstract):
+def __save_tfrecord(writer, article, abstract):
     example = etl.article_example(article, abstract)
     log.debug('example={}'.format(repr(example)))
-    with tf.python_io.TFRecordWriter(file_path) as writer:
+    return writer.write(example.SerializeToString())
+
+
+def __tokens_example(art_tokens, abs_tokens):
+    sep = ' '
+    return tf.train.Example(features=tf.train.Features(feature={
+        'article_tokens': tf.train.Feature(bytes_list=tf.train.BytesList(value=[sep.join(art_tokens).encode(ENCODING)])),
+        'abstract_tokens': tf.train.Feature(bytes_list=tf.train.BytesList(value=[sep.join(abs_tokens).encode(ENCODING)]))
+    }))
+
+
+def __encode(tokens_path, vocab, writer):
+    """Write the tokens saved by __preprocess as id-encoded tfrecords"""
+    log.info('Encoding [%s]...', repr(tokens_path))
+    count = 0
+    for record in tf.python_io.tf_record_iterator(tokens_path):
+        features = tf.train.Example.FromString(record).features.feature
+        art_tokens = features['article_tokens'].bytes_list.value[0].decode(ENCODING).split()
+        abs_tokens = features['abstract_tokens'].bytes_list.value[0].decode(ENCODING).split()
+        example = etl.encoded_example(art_tokens, abs_tokens, vocab)
         writer.write(example.SerializeToString())
+        count += 1
+    log.info('Encoded %i stories', count)
 
 
 def __save_article_and_abstract(file_path, article, abstract):
@@ -85,26 +122,34 @@ def __out_filename(in_path, ext):
     return res
 
 
+def __vocab_terms(terms):
+    return [t for t in terms if not etl.contains_number(t)]
+
+
 def __update_vocab(vocab_counter, terms):
-    terms = [t for t in terms if not etl.contains_number(t)]
-    vocab_counter.update(terms)
+    vocab_counter.update(__vocab_terms(terms))
 
 
-def __preprocess(paths, vocab_counter, batch_size, out_dir, save_article_and_abstract):
+def __preprocess(paths, vocab_counter, batch_size, out_dir, writer, save_article_and_abstract, tokens_writer=None):
+    """Returns the shard name and index in the shard of each story, and the hash of its file, as a dict keyed by path"""
+    locations = {}
     count = 0
     t0 = time.time()
     _len = len(paths)
-    for _path in paths:
+    for _path in sorted(paths):  # sorted, so that the shards are the same for the same split
         article, abstract = __article_abstract_tuple(_path)
         if save_article_and_abstract:
             out_path = os.path.join(out_dir, __out_filename(_path, ext='txt'))
             __save_article_and_abstract(out_path, article, abstract)
-        out_path = os.path.join(out_dir, __out_filename(_path, ext='tfrecord'))
-        __save_tfrecord(out_path, article, abstract)
+        name, index = __save_tfrecord(writer, article, abstract)
+        locations[_path] = (name, index, __file_hash(_path))
         art_tokens = etl.preprocess(article)
         __update_vocab(vocab_counter, art_tokens)
         abs_tokens = etl.preprocess(abstract)
         __update_vocab(vocab_counter, abs_tokens)
+        if tokens_writer is not None:
+            # keep the tokens, to be encoded once the vocab is built
+            tokens_writer.write(__tokens_example(art_tokens, abs_tokens).SerializeToString())
         count += 1
         if count % batch_size == 0:
             t1 = time.time()
@@ -113,58 +158,271 @@ def __preprocess(paths, vocab_counter, batch_size, out_dir, save_article_and_abs
             t0 = time.time()
     t1 = time.time()
     log.info('story [%i of %i] - %.2f percent done (%i s)' % (
-        count, _len, float(count) * 100.0 / float(_len), int(t1 - t0)))
+        count, _len, float(count) * 100.0 / max(float(_len), 1.0), int(t1 - t0)))
+    return locations
+
+
+def __preprocess_part(split, part, paths, out_dir, batch_size, save_article_and_abstract, records_per_shard,
+                      bytes_per_shard, tokens_dir):
+    """Preprocess one part of the stories of a split, writing its own shards (and tokens file, if tokens_dir is given).
+    part is a string that is unique among the parts of the split.
+    Returns the vocab counter of the part, the shards it wrote and the location and hash of each story."""
+    vocab_counter = collections.Counter()
+    prefix = '%s-%s' % (split, part)
+    tokens_writer = None
+    if tokens_dir is not None:
+        tokens_writer = tf.python_io.TFRecordWriter(os.path.join(tokens_dir, prefix + '.tfrecord'))
+    split_dir = os.path.join(out_dir, split)
+    writer = etl.ShardWriter(split_dir, prefix, records_per_shard, bytes_per_shard, write_manifest=False)
+    locations = __preprocess(
+        paths,
+        vocab_counter=vocab_counter,
+        batch_size=batch_size,
+        out_dir=split_dir,
+        writer=writer,
+        save_article_and_abstract=save_article_and_abstract,
+        tokens_writer=tokens_writer
+    )
+    shards = writer.close()
+    if tokens_writer is not None:
+        tokens_writer.close()
+    return vocab_counter, shards, locations
+
+
+def __encode_part(split, part, tokens_dir, vocab, out_dir, records_per_shard, bytes_per_shard):
+    """Encode the tokens file of one part of a split. Returns the shards it wrote."""
+    prefix = '%s-%s' % (split, part)
+    writer = etl.ShardWriter(os.path.join(out_dir, 'encoded', split), prefix, records_per_shard, bytes_per_shard,
+                             write_manifest=False)
+    __encode(os.path.join(tokens_dir, prefix + '.tfrecord'), vocab, writer)
+    return writer.close()
+
+
+def __parts(paths, processes):
+    """Split the paths, sorted, into one contiguous part for each process"""
+    paths = sorted(paths)
+    size = max(-(-len(paths) // processes), 1)  # ceiling division
+    return [paths[i:i + size] for i in range(0, len(paths), size)]
+
+
+def __file_hash(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def __map(pool, func, items):
+    """pool.map, or map in this process if there is no pool"""
+    return pool.map(func, items) if pool is not None else list(map(func, items))
+
+
+def __starmap(pool, func, tasks):
+    """pool.starmap, or starmap in this process if there is no pool"""
+    return pool.starmap(func, tasks) if pool is not None else list(itertools.starmap(func, tasks))
+
+
+def __load_state(out_dir):
+    """Load the state, and replay onto it the journal of a run that was interrupted after rewriting shards"""
+    _path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(_path):
+        return None
+    with open(_path, 'r', encoding=ENCODING) as f:
+        state = json.load(f)
+    journal_path = os.path.join(out_dir, JOURNAL_FILE)
+    if os.path.exists(journal_path):
+        with open(journal_path, 'r', encoding=ENCODING) as f:
+            # a run that saved the state before it could remove its journal is already in the state
+            entries = [e for e in (json.loads(line) for line in f if line.strip()) if e['run'] > state['run']]
+        if entries:
+            log.info('Replaying %i shard rewrites of interrupted run %i', len(entries), entries[-1]['run'])
+            vocab_counter = collections.Counter(state['vocab_counts'])
+            for entry in entries:
+                for story_path in entry['removed']:
+                    state['stories'].pop(story_path, None)
+                for story_path, index in entry['indices'].items():
+                    state['stories'][story_path]['index'] = index
+                vocab_counter.subtract(entry['terms'])
+            state['vocab_counts'] = {t: count for t, count in vocab_counter.items() if count > 0}
+            state['run'] = entries[-1]['run']  # the shards that the interrupted run wrote are not reused
+            __save_state(out_dir, state)  # which removes the journal
+        else:
+            os.remove(journal_path)
+    return state
+
+
+def __save_state(out_dir, state):
+    """Write the state to a temporary file first, so that an interrupted run never leaves a partial state file"""
+    _path = os.path.join(out_dir, STATE_FILE)
+    with open(_path + '.tmp', 'w', encoding=ENCODING) as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(_path + '.tmp', _path)
+    log.info('Saved ETL state [%s]', repr(_path))
+    # the journal of this run is now in the state
+    journal_path = os.path.join(out_dir, JOURNAL_FILE)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+
+def __append_journal(out_dir, entry):
+    with open(os.path.join(out_dir, JOURNAL_FILE), 'a', encoding=ENCODING) as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def __record_terms(record):
+    """The vocab terms of the article and abstract of a tfrecord written by __save_tfrecord"""
+    features = tf.train.Example.FromString(record).features.feature
+    terms = collections.Counter(__vocab_terms(etl.preprocess(features['article'].bytes_list.value[0])))
+    terms.update(__vocab_terms(etl.preprocess(features['abstract'].bytes_list.value[0])))
+    return terms
+
+
+def __remove_stories(out_dir, state, paths, vocab_counter, pool):
+    """Remove the records of the stories from their shards, and subtract their terms from the vocab counts.
+    The shards are rewritten without these records, and the locations of the remaining stories are updated.
+    The removed records are tokenized by the pool, if any. Each rewritten shard is recorded in the journal,
+    so that the state can be brought up to date with the shards on disk if the run is interrupted."""
+    removed = collections.defaultdict(dict)  # (split, shard name) -> path of each record to remove, by index
+    for _path in paths:
+        story = state['stories'][_path]
+        removed[(story['split'], story['shard'])][story['index']] = _path
+    # the remaining stories of each affected shard, by index
+    remaining = collections.defaultdict(dict)
+    for _path, story in state['stories'].items():
+        if (story['split'], story['shard']) in removed:
+            remaining[(story['split'], story['shard'])][story['index']] = _path
+    for (split, name), removed_paths in sorted(removed.items()):
+        split_dir = os.path.join(out_dir, split)
+        shard_path = os.path.join(split_dir, name)
+        records = list(tf.python_io.tf_record_iterator(shard_path))
+        kept = []
+        indices = {}
+        for i, record in enumerate(records):
+            if i in removed_paths:
+                continue
+            indices[remaining[(split, name)][i]] = len(kept)
+            kept.append(record)
+        terms = collections.Counter()
+        for record_terms in __map(pool, __record_terms, [records[i] for i in sorted(removed_paths)]):
+            terms.update(record_terms)
+        shards = etl.read_manifest(split_dir)
+        shard = [sh for sh in shards if sh['name'] == name][0]
+        if len(kept) == 0:
+            os.remove(shard_path)
+            shards.remove(shard)
+        else:
+            with tf.python_io.TFRecordWriter(shard_path + '.tmp') as writer:
+                for record in kept:
+                    writer.write(record)
+            os.replace(shard_path + '.tmp', shard_path)
+            shard['records'] = len(kept)
+            shard['bytes'] = sum(len(record) + etl.ShardWriter.RECORD_OVERHEAD_BYTES for record in kept)
+        etl.write_manifest(split_dir, shards)
+        __append_journal(out_dir, {'run': state['run'], 'split': split, 'shard': name,
+                                   'removed': sorted(removed_paths.values()), 'indices': indices, 'terms': terms})
+        for _path in removed_paths.values():
+            del state['stories'][_path]
+        for _path, index in indices.items():
+            state['stories'][_path]['index'] = index
+        vocab_counter.subtract(terms)
+    # drop the terms that no longer occur
+    for term in [t for t, count in vocab_counter.items() if count <= 0]:
+        del vocab_counter[term]
 
 
-def __main(in_dirs, out_dir, vocab_size, batch_size, save_article_and_abstract):
+def __main(in_dirs, out_dir, vocab_size, batch_size, save_article_and_abstract, encode, encode_vocab_size,
+           records_per_shard, bytes_per_shard, processes, incremental, save_compiled_vocab):
     log.info('Args\nin_dirs={}\nout_dir={}'.format(repr(in_dirs), repr(out_dir)))
-    train_dir = os.path.join(out_dir, 'train')
-    __clean(train_dir)
-    val_dir = os.path.join(out_dir, 'val')
-    __clean(val_dir)
-    test_dir = os.path.join(out_dir, 'test')
-    __clean(test_dir)
-    train = set()
-    val = set()
-    test = set()
+    state = __load_state(out_dir) if incremental else None
+    if incremental and encode:
+        raise ValueError('--encode re-encodes every story whenever the vocab changes, so it cannot be incremental')
+    if state is None:
+        # full build
+        state = {'run': 0, 'stories': {}, 'vocab_counts': {}}
+        for split in SPLITS:
+            __clean(os.path.join(out_dir, split))
+            etl.write_manifest(os.path.join(out_dir, split), [])
+    else:
+        state['run'] += 1
+    tokens_dir = None
+    if encode:
+        tokens_dir = os.path.join(out_dir, 'tokens')
+        __clean(tokens_dir)
+        for split in SPLITS:
+            __clean(os.path.join(out_dir, 'encoded', split))
+    pool = Pool(processes=processes) if processes > 1 else None
+
+    # Find the stories that are new, changed or deleted since the last run. Changed stories keep their split.
+    input_paths = collections.defaultdict(list)
     for in_dir in in_dirs:
-        paths = []
         names = os.listdir(in_dir)
         for name in names:
             if name.startswith('.'):
                 continue
-            paths.append(os.path.join(in_dir, name))
+            input_paths[in_dir].append(os.path.join(in_dir, name))
+    all_paths = set(p for paths in input_paths.values() for p in paths)
+    stories = state['stories']
+    # Only the stories of earlier runs are hashed here, to find the changed ones (none in a full build).
+    # The new stories are hashed as they are preprocessed.
+    known = sorted(p for p in all_paths if p in stories)
+    changed = [p for p, h in zip(known, __map(pool, __file_hash, known)) if stories[p]['hash'] != h]
+    deleted = [p for p in stories if p not in all_paths]
+    splits = {split: set() for split in SPLITS}
+    for _path in changed:
+        splits[stories[_path]['split']].add(_path)
+    for in_dir, paths in input_paths.items():
+        paths = [p for p in paths if p not in stories]
+        if len(paths) == 0:
+            continue
         _train, _val, _test = etl.split_train_val_test(paths, train_size=0.95, test_size=0.01)
-        train = train.union(_train)
-        val = val.union(_val)
-        test = test.union(_test)
-    log.info('len(train)={}, len(val)={}, len(test)={}'.format(repr(len(train)), repr(len(val)), repr(len(test))))
-    vocab_counter = collections.Counter()
-    __preprocess(
-        train,
-        vocab_counter=vocab_counter,
-        batch_size=batch_size,
-        out_dir=train_dir,
-        save_article_and_abstract=save_article_and_abstract
-    )
-    log.info('train set done')
-    __preprocess(
-        val,
-        vocab_counter=vocab_counter,
-        batch_size=batch_size,
-        out_dir=val_dir,
-        save_article_and_abstract=save_article_and_abstract
-    )
-    log.info('val set done')
-    __preprocess(
-        test,
-        vocab_counter=vocab_counter,
-        batch_size=batch_size,
-        out_dir=test_dir,
-        save_article_and_abstract=save_article_and_abstract
-    )
-    log.info('test set done')
-    __save_vocab_file(out_dir=out_dir, vocab_counter=vocab_counter, vocab_size=vocab_size)
+        splits['train'] |= _train
+        splits['val'] |= _val
+        splits['test'] |= _test
+    log.info('run={}, new or changed: len(train)={}, len(val)={}, len(test)={}, changed={}, deleted={}'.format(
+        state['run'], len(splits['train']), len(splits['val']), len(splits['test']), len(changed), len(deleted)))
+
+    vocab_counter = collections.Counter(state['vocab_counts'])
+    __remove_stories(out_dir, state, changed + deleted, vocab_counter, pool)
+
+    # Each split is divided into parts that are preprocessed by a pool of processes.
+    # Their vocab counters are merged, and their shards are added to the manifest of the split in order of part.
+    tasks = []
+    for split in SPLITS:
+        for part, part_paths in enumerate(__parts(splits[split], processes)):
+            tasks.append((split, '%05d-%03d' % (state['run'], part), part_paths, out_dir, batch_size,
+                          save_article_and_abstract, records_per_shard, bytes_per_shard, tokens_dir))
+    results = __starmap(pool, __preprocess_part, tasks)
+    for split in SPLITS:
+        split_dir = os.path.join(out_dir, split)
+        shards = etl.read_manifest(split_dir)
+        for task, (part_counter, part_shards, locations) in zip(tasks, results):
+            if task[0] != split:
+                continue
+            vocab_counter.update(part_counter)
+            shards.extend(part_shards)
+            for _path, (name, index, file_hash) in locations.items():
+                stories[_path] = {'hash': file_hash, 'split': split, 'shard': name, 'index': index}
+        etl.write_manifest(split_dir, shards)
+        log.info('%s set done', split)
+    state['vocab_counts'] = dict(vocab_counter)
+    vocab_path = __save_vocab_file(out_dir=out_dir, vocab_counter=vocab_counter, vocab_size=vocab_size)
+    __save_state(out_dir, state)
+    if save_compiled_vocab:
+        compile_vocab(Vocab(vocab_path, encode_vocab_size), os.path.join(out_dir, 'vocab.bin'))
+    if encode:
+        vocab = Vocab(vocab_path, encode_vocab_size)
+        log.info('Encoding with vocab version %s', vocab.version())
+        encode_tasks = [(task[0], task[1], tokens_dir, vocab, out_dir, records_per_shard, bytes_per_shard)
+                        for task in tasks]
+        results = __starmap(pool, __encode_part, encode_tasks)
+        for split in SPLITS:
+            shards = [s for task, part_shards in zip(encode_tasks, results) if task[0] == split for s in part_shards]
+            etl.write_manifest(os.path.join(out_dir, 'encoded', split), shards)
+        __clean(tokens_dir)
+        os.rmdir(tokens_dir)
+    if pool is not None:
+        pool.close()
+        pool.join()
     log.info('Done!')
 
 
@@ -201,5 +459,49 @@ if __name__ == '__main__':
         help='Save extracted article and abstract as .txt files',
         default=False
     )
+    parser.add_argument(
+        '--encode',
+        type=bool,
+        help='Also save the articles and abstracts as token ids, in out_dir/encoded/{train,val,test}',
+        default=False
+    )
+    parser.add_argument(
+        '--encode_vocab_size',
+        type=int,
+        help='Size of the vocabulary used to encode token ids and to compile vocab.bin. '
+             'Must be the same as --vocab_size in training.',
+        default=50000
+    )
+    parser.add_argument(
+        '--records_per_shard',
+        type=int,
+        help='Maximum number of stories in each tfrecord shard file (0 for no limit)',
+        default=1000
+    )
+    parser.add_argument(
+        '--bytes_per_shard',
+        type=int,
+        help='Start a new tfrecord shard file once a shard has this many bytes (0 for no limit)',
+        default=0
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        help='Number of processes that preprocess the stories',
+        default=1
+    )
+    parser.add_argument(
+        '--incremental',
+        type=bool,
+        help='Only process the stories that are new or changed since the last run in out_dir. '
+             'Stories of the last run that are no longer in in_dirs are removed.',
+        default=False
+    )
+    parser.add_argument(
+        '--save_compiled_vocab',
+        type=bool,
+        help='Also save the vocab in the compiled format as vocab.bin, which loads faster in training and decoding',
+        default=False
+    )
     args = parser.parse_args()
     __main(**vars(args))